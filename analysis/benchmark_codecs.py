@@ -0,0 +1,57 @@
+import csv
+import math
+import os
+import sys
+import time
+
+# Make the erasure_codes package importable when run from the analysis folder
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from erasure_codes.codec import CODECS, get_codec
+from erasure_codes.reedsolomon import coefficient_vectors, STORAGE_NODES_NUM
+
+iterations = 10
+file_sizes = {'10KB': 10 * 1000, '100KB': 100 * 1000, '1MB': 1000 * 1000, '10MB': 10 * 1000 * 1000}
+result_file = "results_codecs.csv"
+fields = ['codec', 'file_size', 'max_erasures', 'encode_time', 'decode_time']
+
+# Open csv file
+with open(f'./results/{result_file}', 'w') as csvfile:
+    csv_writer = csv.writer(csvfile)
+
+    # Write first row of csv
+    csv_writer.writerow(fields)
+
+    for codec_name in CODECS:
+        try:
+            codec = get_codec(codec_name)
+        except ImportError as e:
+            print("Skipping codec %s: %s" % (codec_name, e))
+            continue
+
+        for max_erasures in [1, 2]:
+            # One coded fragment per storage node
+            symbols = STORAGE_NODES_NUM - max_erasures
+            coefficients = coefficient_vectors(max_erasures, fragment_count=STORAGE_NODES_NUM)
+
+            for file, size in file_sizes.items():
+                data = bytearray(os.urandom(size))
+                symbol_size = math.ceil(size / symbols)
+
+                for i in range(iterations):
+                    # Encode all fragments
+                    start_time = time.time()
+                    coded = codec.encode(data, coefficients, symbols, symbol_size)
+                    encode_time = time.time() - start_time
+
+                    # Decode from the last 'symbols' fragments
+                    start_time = time.time()
+                    decoded, rank = codec.decode(coefficients[-symbols:], coded[-symbols:],
+                                                 symbols, symbol_size)
+                    decode_time = time.time() - start_time
+                    assert decoded[:size] == data
+
+                    # Save entry in CSV
+                    csv_writer.writerow([codec_name, file, max_erasures, encode_time, decode_time])
+
+                print("%s, %s, max_erasures=%d done" % (codec_name, file, max_erasures))
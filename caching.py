@@ -0,0 +1,159 @@
+import collections
+import threading
+import time
+
+import metrics
+
+
+class ByteLRUCache:
+    """
+    Thread safe LRU cache of byte strings, bounded by the total size of the cached values.
+    Values larger than 'max_item_bytes' are not admitted, so a few huge objects can't
+    flush the cache. Hits, misses, evictions and rejected values are counted in the
+    metrics module as '<name>_hits', '<name>_misses', '<name>_evictions' and '<name>_rejections'.
+    """
+
+    def __init__(self, name, max_bytes, max_item_bytes):
+        """
+        :param name: Name of the cache, used as the prefix of its metrics
+        :param max_bytes: Maximum total size of the cached values in bytes
+        :param max_item_bytes: Maximum size of a single cached value in bytes
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.size = 0
+        # Key -> value, from least to most recently used
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: The key of the value
+        :return: The cached value, or None if it is not cached
+        """
+        with self.__lock:
+            value = self.__entries.get(key)
+            if value is not None:
+                self.__entries.move_to_end(key)
+
+        metrics.increment(self.name + ('_hits' if value is not None else '_misses'))
+        return value
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting the least recently used values if the cache is full
+
+        :param key: The key of the value
+        :param value: A bytes-like object. It must not be modified while it is cached.
+        """
+        if len(value) > self.max_item_bytes:
+            metrics.increment(self.name + '_rejections')
+            return
+
+        evicted = 0
+        with self.__lock:
+            self.__remove(key)
+            self.__entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted_value = self.__entries.popitem(last=False)
+                self.size -= len(evicted_value)
+                evicted += 1
+
+        if evicted:
+            metrics.increment(self.name + '_evictions', evicted)
+
+    def invalidate(self, key):
+        """
+        Remove a value from the cache, e.g. when the object it belongs to is deleted
+
+        :param key: The key of the value
+        """
+        with self.__lock:
+            self.__remove(key)
+
+    def __remove(self, key):
+        value = self.__entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+#
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache of at most 'max_items' values, where every value expires
+    'ttl' seconds after it was cached. Hits and misses are counted in the metrics
+    module as '<name>_hits' and '<name>_misses'.
+
+    To cache a value loaded from elsewhere, take the 'generation()' before loading it
+    and pass it to 'put', so the value is not cached if it was invalidated meanwhile.
+    """
+
+    def __init__(self, name, max_items, ttl):
+        """
+        :param name: Name of the cache, used as the prefix of its metrics
+        :param max_items: Maximum number of cached values
+        :param ttl: How long a value stays cached in seconds
+        """
+        self.name = name
+        self.max_items = max_items
+        self.ttl = ttl
+        # Key -> (expiry time, value), from least to most recently used
+        self.__entries = collections.OrderedDict()
+        # Incremented by every invalidation
+        self.__generation = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: The key of the value
+        :return: The cached value, or None if it is not cached or has expired
+        """
+        value = None
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    value = entry[1]
+                    self.__entries.move_to_end(key)
+                else:
+                    del self.__entries[key]
+
+        metrics.increment(self.name + ('_hits' if value is not None else '_misses'))
+        return value
+
+    def generation(self):
+        """
+        :return: The current invalidation generation, see put
+        """
+        with self.__lock:
+            return self.__generation
+
+    def put(self, key, value, generation=None):
+        """
+        Cache a value, evicting the least recently used value if the cache is full
+
+        :param key: The key of the value
+        :param value: The value to cache
+        :param generation: The generation() taken before the value was loaded. If anything
+                           was invalidated since, the value may be stale and is not cached.
+        """
+        with self.__lock:
+            if generation is not None and generation != self.__generation:
+                return
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            if len(self.__entries) > self.max_items:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove a value from the cache, e.g. when it was changed or deleted
+
+        :param key: The key of the value
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__generation += 1
+#
@@ -0,0 +1,311 @@
+"""
+Codec backends for the GF(2^8) linear codes used by the Reed Solomon and RLNC modules.
+Two backends are available:
+- 'kodo': the kodo-python bindings (default, if installed)
+- 'numpy': a vectorized NumPy implementation based on log/exp tables
+
+The backend can be selected with the ERASURE_CODEC environment variable.
+Both backends use the same finite field, so data coded with one of them can be
+decoded with the other.
+"""
+import os
+
+from erasure_codes import gf256
+
+try:
+    import kodo
+except ImportError:
+    kodo = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Codec:
+    """
+    Interface of a codec backend. Coefficient vectors and symbols are passed as
+    bytes-like objects, coded symbols are returned as bytearrays.
+    """
+
+    name = None
+
+    def encode(self, data, coefficients, symbols, symbol_size, with_coefficients=False):
+        """
+        Generate one coded symbol for each coefficient vector. 'data' is split into
+        'symbols' source symbols of 'symbol_size' bytes (the last one is zero padded).
+
+        :param data: The data to encode
+        :param coefficients: List of coefficient vectors, 'symbols' long each
+        :param symbols: Number of source symbols
+        :param symbol_size: Size of one symbol in bytes
+        :param with_coefficients: Return every coded symbol with its coefficient vector
+                                  in front, as stored on the storage nodes
+        :return: List of coded symbols
+        """
+        raise NotImplementedError()
+
+    def combine(self, coefficients, rows):
+        """
+        Compute linear combinations of equally long rows
+
+        :param coefficients: List of coefficient vectors, len(rows) long each
+        :param rows: The rows to combine
+        :return: One combined row for each coefficient vector
+        """
+        raise NotImplementedError()
+
+    def decode(self, coefficients, symbols, symbol_count, symbol_size):
+        """
+        Decode the source data from coded symbols
+
+        :param coefficients: The coefficient vector of each coded symbol
+        :param symbols: The coded symbols
+        :param symbol_count: Number of source symbols
+        :param symbol_size: Size of one symbol in bytes
+        :return: The decoded data and the rank of the decoder. The data is only
+                 complete if the rank equals symbol_count.
+        """
+        raise NotImplementedError()
+
+    def recode(self, symbols, symbol_count, output_symbol_count):
+        """
+        Generate new random linear combinations of coded symbols
+
+        :param symbols: coded symbols that contain both the coefficients and symbol data
+        :param symbol_count: number of source symbols
+        :param output_symbol_count: number of symbols to create
+        :return: the recoded symbols (coefficients and symbol data)
+        """
+        raise NotImplementedError()
+
+    def random_coefficients(self, symbol_count):
+        """
+        :param symbol_count: number of source symbols
+        :return: A coefficient vector with uniformly random coefficients
+        """
+        raise NotImplementedError()
+#
+
+
+class KodoCodec(Codec):
+    """
+    Codec backend based on the kodo-python bindings
+    """
+
+    name = 'kodo'
+
+    def __init__(self):
+        if kodo is None:
+            raise ImportError("kodo is not installed")
+        self.field = kodo.FiniteField.binary8
+
+    def encode(self, data, coefficients, symbols, symbol_size, with_coefficients=False):
+        # Kodo RLNC encoder using 2^8 finite field
+        encoder = kodo.block.Encoder(self.field)
+        encoder.configure(symbols, symbol_size)
+        encoder.set_symbols_storage(data)
+
+        # The bindings only encode into bytearrays, with coefficients the symbols are
+        # encoded into one scratch buffer and copied once behind their coefficients
+        scratch = bytearray(encoder.symbol_bytes)
+
+        coded_symbols = []
+        for vector in coefficients:
+            if not with_coefficients:
+                symbol = bytearray(encoder.symbol_bytes)
+                encoder.encode_symbol(symbol, bytearray(vector))
+            else:
+                encoder.encode_symbol(scratch, bytearray(vector))
+                symbol = bytearray(len(vector) + encoder.symbol_bytes)
+                symbol[:len(vector)] = vector
+                symbol[len(vector):] = scratch
+            coded_symbols.append(symbol)
+
+        return coded_symbols
+
+    def combine(self, coefficients, rows):
+        # An encoder computes linear combinations of its source symbols
+        return self.encode(bytearray().join(rows), coefficients, len(rows), len(rows[0]))
+
+    def decode(self, coefficients, symbols, symbol_count, symbol_size):
+        decoder = kodo.block.Decoder(self.field)
+        decoder.configure(symbol_count, symbol_size)
+        data_out = bytearray(decoder.block_bytes)
+        decoder.set_symbols_storage(data_out)
+
+        for vector, symbol in zip(coefficients, symbols):
+            decoder.decode_symbol(bytearray(symbol), bytearray(vector))
+
+        return data_out, decoder.rank
+
+    def recode(self, symbols, symbol_count, output_symbol_count):
+        # Examples of different techiques to recode using Kodo can be found here:
+        # https://github.com/steinwurf/kodo-python/blob/master/examples/pure_recode_symbol_api.py
+        symbol_size = len(symbols[0]) - symbol_count #subtract the coefficients' size
+        # Set up the recoder
+        recoder = kodo.block.Decoder(self.field)
+        recoder.configure(symbol_count, symbol_size)
+        recoder_internal_storage = bytearray(recoder.block_bytes)
+        recoder.set_symbols_storage(recoder_internal_storage)
+
+        # Random coefficient generator, will be used for the recoded symbols
+        generator = kodo.block.generator.RandomUniform(self.field)
+        generator.configure(symbol_count)
+
+        # Allocate buffers for where the recoded symbols (coeffs and data) will be produced
+        # Recoding requires 2 coefficient buffers
+        recoding_coefficients = bytearray(generator.max_coefficients_bytes)
+        coefficients_out = bytearray(generator.max_coefficients_bytes)
+        recoded_symbol = bytearray(symbol_size)
+
+        # Feed the provided symbols to the Recoder
+        for symbol in symbols:
+            # Separate the coefficients from the symbol data
+            coefficients = bytearray(symbol[:symbol_count])
+            symbol_data = bytearray(symbol[symbol_count:])
+            # Feed it to the recoder
+            recoder.decode_symbol(symbol_data, coefficients)
+
+        # Generate new recoded symbols
+        output_symbols = []
+        for i in range(output_symbol_count):
+            # Generate fresh recoding multipliers
+            generator.generate_recode(recoding_coefficients, recoder)
+            # Perform recoding, capture the final coefficients that produced the recoded symbol
+            recoder.recode_symbol(recoded_symbol, coefficients_out, recoding_coefficients)
+            # Save the new recoded symbol and its coeffs to output_symbols
+            output_symbols.append(coefficients_out + recoded_symbol)
+
+        return output_symbols
+
+    def random_coefficients(self, symbol_count):
+        generator = kodo.block.generator.RandomUniform(self.field)
+        generator.configure(symbol_count)
+        coefficients = bytearray(generator.max_coefficients_bytes)
+        generator.generate(coefficients)
+        return coefficients
+#
+
+
+class NumpyCodec(Codec):
+    """
+    Pure NumPy codec backend. Every coded symbol is a matrix-vector product over
+    GF(2^8); all products are computed in one batched pass using a multiplication
+    table derived from the log/exp tables, processing the data in column blocks.
+    """
+
+    name = 'numpy'
+
+    # Number of bytes per row that are combined in one batch (bounds temporary memory)
+    BLOCK_SIZE = 16384
+
+    def __init__(self):
+        if np is None:
+            raise ImportError("numpy is not installed")
+        exp = np.array(gf256.EXP, dtype=np.uint8)
+        log = np.array(gf256.LOG, dtype=np.int32)
+        # MUL[a, b] = a*b, built from the log/exp tables
+        self.mul_table = exp[log[:, None] + log[None, :]]
+        self.mul_table[0, :] = 0
+        self.mul_table[:, 0] = 0
+
+    def __matrix(self, coefficients):
+        """
+        :param coefficients: List of coefficient vectors
+        :return: The coefficient vectors as the rows of a NumPy matrix
+        """
+        return np.array([list(vector) for vector in coefficients], dtype=np.uint8)
+
+    def __combine(self, matrix, rows, prefixes=None):
+        """
+        :param matrix: Coefficient matrix (m x k) as a NumPy array
+        :param rows: Rows to combine (k x L) as a NumPy array
+        :param prefixes: Equally long byte strings to put in front of each combined row
+        :return: The m combined rows as bytearrays
+        """
+        length = rows.shape[1]
+        offset = len(prefixes[0]) if prefixes else 0
+        # Every row is written into one preallocated buffer, after its prefix
+        output = [bytearray(offset + length) for _ in range(len(matrix))]
+        for row, prefix in zip(output, prefixes or ()):
+            row[:offset] = prefix
+        output_arrays = [np.frombuffer(row, dtype=np.uint8)[offset:] for row in output]
+        if not output:
+            # No coefficient vectors, e.g. the parity of a systematic code without parity
+            return output
+
+        for start in range(0, length, self.BLOCK_SIZE):
+            block = rows[:, start:start + self.BLOCK_SIZE]
+            # products[i, j, :] = matrix[i, j] * block[j, :]
+            products = self.mul_table[matrix[:, :, None], block[None, :, :]]
+            combined = np.bitwise_xor.reduce(products, axis=1)
+            for array, combined_row in zip(output_arrays, combined):
+                array[start:start + self.BLOCK_SIZE] = combined_row
+
+        return output
+
+    def encode(self, data, coefficients, symbols, symbol_size, with_coefficients=False):
+        if len(data) == symbols * symbol_size:
+            block = np.frombuffer(data, dtype=np.uint8)
+        else:
+            # Zero pad the last symbol
+            block = np.zeros(symbols * symbol_size, dtype=np.uint8)
+            block[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        return self.__combine(self.__matrix(coefficients), block.reshape(symbols, symbol_size),
+                              coefficients if with_coefficients else None)
+
+    def combine(self, coefficients, rows):
+        rows = np.stack([np.frombuffer(row, dtype=np.uint8) for row in rows])
+        return self.__combine(self.__matrix(coefficients), rows)
+
+    def decode(self, coefficients, symbols, symbol_count, symbol_size):
+        # Pick symbols with linearly independent coefficient vectors
+        selected = gf256.independent_rows(coefficients, symbol_count)
+        rank = len(selected)
+        if rank < symbol_count:
+            return bytearray(symbol_count * symbol_size), rank
+
+        # The source symbols are the inverse coefficient matrix applied to the coded symbols
+        inverse = gf256.invert_matrix([coefficients[i] for i in selected])
+        decoded = self.combine(inverse, [symbols[i] for i in selected])
+
+        return bytearray().join(decoded), rank
+
+    def recode(self, symbols, symbol_count, output_symbol_count):
+        # Random linear combinations of the coded symbols (coefficients included)
+        recoding_coefficients = [bytearray(os.urandom(len(symbols)))
+                                 for _ in range(output_symbol_count)]
+        return self.combine(recoding_coefficients, symbols)
+
+    def random_coefficients(self, symbol_count):
+        return bytearray(os.urandom(symbol_count))
+#
+
+
+CODECS = {
+    KodoCodec.name: KodoCodec,
+    NumpyCodec.name: NumpyCodec,
+}
+
+__codecs = {}
+
+
+def get_codec(name=None):
+    """
+    Returns the codec backend with the given name. If no name is given, the
+    ERASURE_CODEC environment variable is used, falling back to kodo if it is
+    installed and to numpy otherwise.
+
+    :param name: 'kodo' or 'numpy'
+    :return: A Codec instance
+    """
+    if name is None:
+        name = os.environ.get('ERASURE_CODEC', 'kodo' if kodo is not None else 'numpy')
+
+    if name not in __codecs:
+        __codecs[name] = CODECS[name]()
+
+    return __codecs[name]
+#
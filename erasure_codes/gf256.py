@@ -0,0 +1,140 @@
+"""
+Arithmetic in the finite field GF(2^8) based on log/exp tables.
+The field is generated by the same prime polynomial as Kodo's binary8 field
+(x^8 + x^4 + x^3 + x^2 + 1), so symbols coded by one codec backend can be
+decoded by the other.
+"""
+
+PRIME_POLYNOMIAL = 0x11D
+
+def __generate_tables():
+    """
+    Generate the exp and log tables of the field
+
+    :return: EXP, where EXP[i] = 2^i (doubled in length, so EXP[LOG[a] + LOG[b]] never
+             needs a modulo), and LOG, where LOG[2^i] = i (LOG[0] is undefined and left as 0)
+    """
+    exp = [0] * 512
+    log = [0] * 256
+
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= PRIME_POLYNOMIAL
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+
+    return exp, log
+#
+
+
+EXP, LOG = __generate_tables()
+
+
+def mul(a, b):
+    """
+    Multiply two field elements
+
+    :param a: A field element (0-255)
+    :param b: A field element (0-255)
+    :return: The product a*b
+    """
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+#
+
+
+def inv(a):
+    """
+    Multiplicative inverse of a field element
+
+    :param a: A non-zero field element (1-255)
+    :return: The element b for which a*b = 1
+    """
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(2^8)")
+    return EXP[255 - LOG[a]]
+#
+
+
+def independent_rows(matrix, limit=None):
+    """
+    Select linearly independent rows of a matrix, in order. Gaussian elimination is
+    performed on the rows one by one and the rows that increase the rank are kept.
+
+    :param matrix: A list of rows (bytearrays or lists of field elements)
+    :param limit: Stop when this many rows were selected (default: no limit)
+    :return: The indexes of the selected rows
+    """
+    # Reduced rows of the basis, each with a 1 at its pivot position
+    basis = []
+    selected = []
+
+    for index, row in enumerate(matrix):
+        row = list(row)
+        for pivot, basis_row in basis:
+            factor = row[pivot]
+            if factor:
+                row = [r ^ mul(factor, b) for r, b in zip(row, basis_row)]
+
+        pivot = next((i for i, value in enumerate(row) if value), None)
+        if pivot is None:
+            # Linearly dependent on the rows we already have
+            continue
+
+        factor = inv(row[pivot])
+        basis.append((pivot, [mul(factor, r) for r in row]))
+        selected.append(index)
+        if limit is not None and len(selected) == limit:
+            break
+
+    return selected
+#
+
+
+def invert_matrix(matrix):
+    """
+    Invert a square matrix with Gauss-Jordan elimination
+
+    :param matrix: A list of rows (bytearrays or lists of field elements)
+    :return: The inverse matrix as a list of bytearrays
+    """
+    size = len(matrix)
+    # Augment the matrix with the identity matrix
+    rows = [list(row) + [1 if i == j else 0 for j in range(size)]
+            for i, row in enumerate(matrix)]
+
+    for col in range(size):
+        pivot = next((r for r in range(col, size) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+
+        factor = inv(rows[col][col])
+        rows[col] = [mul(factor, value) for value in rows[col]]
+
+        for r in range(size):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [a ^ mul(factor, b) for a, b in zip(rows[r], rows[col])]
+
+    return [bytearray(row[size:]) for row in rows]
+#
+
+
+def cauchy_matrix(rows, cols):
+    """
+    Generate a Cauchy matrix with elements 1 / (x_i + y_j), where x_i = i and
+    y_j = rows + j. Every square submatrix of a Cauchy matrix is invertible.
+
+    :param rows: Number of rows
+    :param cols: Number of columns (rows + cols must not exceed 256)
+    :return: The matrix as a list of bytearrays
+    """
+    assert(rows + cols <= 256)
+    return [bytearray(inv(i ^ (rows + j)) for j in range(cols)) for i in range(rows)]
+#
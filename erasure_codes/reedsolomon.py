@@ -1,13 +1,15 @@
-import kodo
 import math
 import random
-import copy # for deepcopy
-from utils import random_string
+from utils import random_string, STORAGE_NODES_NUM
 from models import messages_pb2
-import json
-
-STORAGE_NODES_NUM = 4
-
+from erasure_codes.codec import get_codec
+from erasure_codes import gf256
+from erasure_codes.repair import check_files, node_address, repair_files, run_coding, stripe_files, \
+    wait_for_acknowledgements
+import metrics
+
+# The coefficients of the files stored before the number of fragments was configurable,
+# when every file had one fragment on each of 4 storage nodes
 RS_CAUCHY_COEFFS = [
     bytearray([253, 126, 255, 127]),
     bytearray([126, 253, 127, 255]),
@@ -15,43 +17,113 @@ RS_CAUCHY_COEFFS = [
     bytearray([127, 255, 126, 253])
 ]
 
-def store_file(file_data, max_erasures, send_task_socket, response_socket):
+def coefficient_vectors(max_erasures, systematic=False, fragment_count=None):
     """
-    Store a file using Reed Solomon erasure coding, protecting it against 'max_erasures' 
-    unavailable storage nodes. 
-    The erasure coding part codes are the customized version of the 'encode_decode_using_coefficients'
-    example of kodo-python, where you can find a detailed description of each step.
+    Returns the Reed Solomon coefficient vector of each coded fragment: the rows of an
+    n x k Cauchy matrix, any k of which are linearly independent.
+    With a systematic code the first 'k' fragments hold the plain data (unit coefficient
+    vectors) and only the remaining parity fragments are coded, using the rows of a
+    Cauchy matrix.
 
-    :param file_data: The file contents to be stored as a Python bytearray 
     :param max_erasures: How many storage node failures should the data survive
-    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
-    :param response_socket: A ZMQ PULL socket where the storage nodes respond
-    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
+    :param systematic: Whether to use the systematic code
+    :param fragment_count: The number of coded fragments (n). None for files stored before it
+                           was recorded in the storage details, which use RS_CAUCHY_COEFFS
+    :return: A list with one coefficient vector per coded fragment
     """
+    legacy = fragment_count is None
+    if legacy:
+        fragment_count = len(RS_CAUCHY_COEFFS)
+    symbols = fragment_count - max_erasures
+    if not systematic:
+        if legacy:
+            # Trim the coeffs to the actual length we need
+            return [coefficients[:symbols] for coefficients in RS_CAUCHY_COEFFS]
+        return gf256.cauchy_matrix(fragment_count, symbols)
+
+    identity = [bytearray(1 if i == j else 0 for j in range(symbols)) for i in range(symbols)]
+    return identity + gf256.cauchy_matrix(max_erasures, symbols)
+#
+
 
-    # Make sure we can realize max_erasures with 4 storage nodes
+def __check_fragment_count(max_erasures, fragment_count):
+    # Every coded fragment is stored on a different node
+    assert(fragment_count <= STORAGE_NODES_NUM)
+    # Make sure we can realize max_erasures with the given number of fragments
     assert(max_erasures >= 0)
-    assert(max_erasures < STORAGE_NODES_NUM)
+    assert(max_erasures < fragment_count)
+#
+
+# Default size of one stripe (generation) when a file is stored in stripes
+STRIPE_SIZE = 1024 * 1024
+# How many stripes may be waiting for storage node acknowledgements at the same time
+MAX_STRIPES_IN_FLIGHT = 4
+# How many stripes are fetched ahead of the one being decoded when a file is read
+STRIPES_PREFETCH = 2
+# How many fragments are requested on top of the ones needed to decode, so a slow or
+# unavailable node does not stall a read. None requests all fragments.
+READ_SPARES = 1
+# How long to wait for the next fragment (in milliseconds) before requesting
+# alternate fragments, and before giving up when there are none left
+FRAGMENT_TIMEOUT = 2000
+# How long to wait for a chained repair to finish (in milliseconds)
+CHAIN_REPAIR_TIMEOUT = 30000
+
+def __encode_fragments(file_data, max_erasures, systematic, fragment_count):
+    """
+    Encode 'file_data' as a single generation, generating 'fragment_count' coded fragments.
+
+    :param file_data: The data to be encoded as a Python bytearray
+    :param max_erasures: How many storage node failures should the data survive
+    :param systematic: Whether to use the systematic code
+    :param fragment_count: The number of coded fragments (n)
+    :return: The coded fragments, each in one buffer with its coefficient vector in front
+    """
 
     # How many coded fragments (=symbols) will be required to reconstruct the encoded data. 
-    symbols = STORAGE_NODES_NUM - max_erasures
+    symbols = fragment_count - max_erasures
     # The size of one coded fragment (total size/number of symbols, rounded up)
     symbol_size = math.ceil(len(file_data)/symbols)
-    # Kodo RLNC encoder using 2^8 finite field
-    encoder = kodo.block.Encoder(kodo.FiniteField.binary8)
-    encoder.configure(symbols, symbol_size)
-    encoder.set_symbols_storage(file_data)
-    symbol = bytearray(encoder.symbol_bytes)
+    vectors = coefficient_vectors(max_erasures, systematic, fragment_count)
+
+    if not systematic:
+        # Generate one coded fragment for each Storage Node in one pass
+        return get_codec().encode(file_data, vectors, symbols, symbol_size, with_coefficients=True)
+
+    # The data fragments are plain slices of the data (zero padded), 
+    # only the parity fragments need to be encoded
+    data_fragments = []
+    for i, coefficients in enumerate(vectors[:symbols]):
+        fragment = bytearray(symbols + symbol_size)
+        fragment[:symbols] = coefficients
+        data_slice = memoryview(file_data)[i * symbol_size:(i + 1) * symbol_size]
+        fragment[symbols:symbols + len(data_slice)] = data_slice
+        data_fragments.append(fragment)
+    parity_fragments = get_codec().encode(file_data, vectors[symbols:], symbols, symbol_size,
+                                          with_coefficients=True)
+    return data_fragments + parity_fragments
+#
+
+def __send_coded_fragments(file_data, max_erasures, send_task_socket, systematic=False,
+                           fragment_count=STORAGE_NODES_NUM):
+    """
+    Encode 'file_data' as a single generation and send the coded fragments to the
+    Storage Nodes, one per node. Does not wait for the Storage Nodes to acknowledge the fragments.
+
+    :param file_data: The data to be encoded as a Python bytearray
+    :param max_erasures: How many storage node failures should the data survive
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes, wrapped with RequestChannel.socket
+    :param systematic: Whether to use the systematic code
+    :param fragment_count: The number of coded fragments (n)
+    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
+    """
+
+    coded_fragments = __encode_fragments(file_data, max_erasures, systematic, fragment_count)
 
     fragment_names = []
+    messages = []
 
-    # Generate one coded fragment for each Storage Node
-    for i in range(STORAGE_NODES_NUM):
-        # Select the next Reed Solomon coefficient vector 
-        coefficients = RS_CAUCHY_COEFFS[i]
-        # Generate a coded fragment with these coefficients 
-        # (trim the coeffs to the actual length we need)
-        encoder.encode_symbol(symbol, coefficients[:symbols])
+    for fragment in coded_fragments:
         # Generate a random name for it and save
         name = random_string(8)
         fragment_names.append(name)
@@ -64,21 +136,100 @@ def store_file(file_data, max_erasures, send_task_socket, response_socket):
         header = messages_pb2.header()
         header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
 
-        send_task_socket.send_multipart([
+        messages.append([
             header.SerializeToString(),
             task.SerializeToString(),
-            coefficients[:symbols] + bytearray(symbol)
+            fragment
         ])
+
+    # Send the fragments back to back, so the round-robin of the PUSH socket puts each one
+    # on a different node even when other files are stored at the same time. The fragment
+    # buffers are not modified after this, send them without copying
+    send_task_socket.send_batch(messages, copy=False)
+
+    return fragment_names
+#
+
+def store_file(file_data, max_erasures, send_task_socket, response_socket, systematic=False,
+               fragment_count=STORAGE_NODES_NUM):
+    """
+    Store a file using Reed Solomon erasure coding, protecting it against 'max_erasures' 
+    unavailable storage nodes. 
+    The erasure coding part codes are the customized version of the 'encode_decode_using_coefficients'
+    example of kodo-python, where you can find a detailed description of each step.
+
+    :param file_data: The file contents to be stored as a Python bytearray 
+    :param max_erasures: How many storage node failures should the data survive
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param systematic: Store the plain data in the first fragments and only code the parity fragments
+    :param fragment_count: The number of coded fragments (n), at most STORAGE_NODES_NUM
+    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
+    """
+
+    __check_fragment_count(max_erasures, fragment_count)
+
+    fragment_names = __send_coded_fragments(file_data, max_erasures, send_task_socket, systematic,
+                                            fragment_count)
     
     # Wait until we receive a response for every fragment
-    for task_nbr in range(STORAGE_NODES_NUM):
+    for task_nbr in range(fragment_count):
         resp = response_socket.recv_string()
         print('Received: %s' % resp)
 
     return fragment_names
 #
 
-def get_store_file_tasks(file_data, max_erasures):
+def store_file_stream(stream, max_erasures, stripe_size, send_task_socket, response_socket,
+                      fragment_count=STORAGE_NODES_NUM):
+    """
+    Store a file using Reed Solomon erasure coding without loading it into memory.
+    The stream is read in chunks of 'stripe_size' bytes and every chunk (stripe) is
+    encoded as its own generation. The coded fragments of a stripe are sent as soon
+    as they are produced, and at most MAX_STRIPES_IN_FLIGHT stripes are waiting for
+    acknowledgements at any time, so memory use is bounded by the stripe size.
+
+    :param stream: A file-like object to read the file contents from
+    :param max_erasures: How many storage node failures should the data survive
+    :param stripe_size: The size of one stripe in bytes
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param fragment_count: The number of coded fragments of each stripe (n), at most STORAGE_NODES_NUM
+    :return: A list with the coded fragment names of each stripe, and the total file size
+    """
+
+    __check_fragment_count(max_erasures, fragment_count)
+    assert(stripe_size > 0)
+
+    stripes = []
+    file_size = 0
+    pending_responses = 0
+
+    while True:
+        stripe = stream.read(stripe_size)
+        if not stripe:
+            break
+        file_size += len(stripe)
+
+        stripes.append(__send_coded_fragments(bytearray(stripe), max_erasures, send_task_socket,
+                                              fragment_count=fragment_count))
+        pending_responses += fragment_count
+
+        # Wait for the oldest stripes to be stored before reading any further
+        while pending_responses > (MAX_STRIPES_IN_FLIGHT - 1) * fragment_count:
+            resp = response_socket.recv_string()
+            print('Received: %s' % resp)
+            pending_responses -= 1
+
+    # Wait until we receive a response for every remaining fragment
+    for task_nbr in range(pending_responses):
+        resp = response_socket.recv_string()
+        print('Received: %s' % resp)
+
+    return stripes, file_size
+#
+
+def get_store_file_tasks(file_data, max_erasures, fragment_count=STORAGE_NODES_NUM):
     """
     Store a file using Reed Solomon erasure coding, protecting it against 'max_erasures'
     unavailable storage nodes.
@@ -87,36 +238,18 @@ def get_store_file_tasks(file_data, max_erasures):
 
     :param file_data: The file contents to be stored as a Python bytearray
     :param max_erasures: How many storage node failures should the data survive
-    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
-    :param response_socket: A ZMQ PULL socket where the storage nodes respond
-    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
+    :param fragment_count: The number of coded fragments (n), at most STORAGE_NODES_NUM
+    :return: The store data requests and the coded fragments
     """
 
-    # Make sure we can realize max_erasures with 4 storage nodes
-    assert (max_erasures >= 0)
-    assert (max_erasures < STORAGE_NODES_NUM)
+    __check_fragment_count(max_erasures, fragment_count)
 
-    # How many coded fragments (=symbols) will be required to reconstruct the encoded data.
-    symbols = STORAGE_NODES_NUM - max_erasures
-    # The size of one coded fragment (total size/number of symbols, rounded up)
-    symbol_size = math.ceil(len(file_data) / symbols)
-    # Kodo RLNC encoder using 2^8 finite field
-    encoder = kodo.block.Encoder(kodo.FiniteField.binary8)
-    encoder.configure(symbols, symbol_size)
-    encoder.set_symbols_storage(file_data)
-    symbol = bytearray(encoder.symbol_bytes)
+    coded_fragments = __encode_fragments(file_data, max_erasures, False, fragment_count)
 
     fragment_names = []
 
     tasks = []
-    data = []
-    # Generate one coded fragment for each Storage Node
-    for i in range(STORAGE_NODES_NUM):
-        # Select the next Reed Solomon coefficient vector
-        coefficients = RS_CAUCHY_COEFFS[i]
-        # Generate a coded fragment with these coefficients
-        # (trim the coeffs to the actual length we need)
-        encoder.encode_symbol(symbol, coefficients[:symbols])
+    for fragment in coded_fragments:
         # Generate a random name for it and save
         name = random_string(8)
         fragment_names.append(name)
@@ -126,114 +259,350 @@ def get_store_file_tasks(file_data, max_erasures):
         task.filename = name
 
         tasks.append(task)
-        data.append(coefficients[:symbols] + bytearray(symbol))
 
-    return tasks, data
+    return tasks, coded_fragments
 
 
 #
 
+def __concatenate_data_fragments(symbols):
+    """
+    If the given symbols are the plain data fragments of a systematic code (each has
+    a different unit coefficient vector), the data can be reconstructed without decoding.
+
+    :param symbols: coded symbols that contain both the coefficients and symbol data
+    :return: the data fragments concatenated in order, or None if decoding is needed
+    """
+
+    symbols_num = len(symbols)
+    data_fragments = [None] * symbols_num
+
+    for symbol in symbols:
+        coefficients = symbol['data'][:symbols_num]
+        positions = [i for i, c in enumerate(coefficients) if c != 0]
+        if (len(positions) != 1 or coefficients[positions[0]] != 1
+                or data_fragments[positions[0]] is not None):
+            return None
+        data_fragments[positions[0]] = symbol['data'][symbols_num:]
+
+    return bytearray().join(data_fragments)
+#
+
 def decode_file(symbols):
     """
     Decode a file using Reed Solomon decoder and the provided coded symbols.
-    The number of symbols must be the same as STORAGE_NODES_NUM - max_erasures.
+    The number of symbols must be the same as the number of coded fragments - max_erasures.
 
     :param symbols: coded symbols that contain both the coefficients and symbol data
     :return: the decoded file data
     """
 
-    # Reconstruct the original data with a decoder
     symbols_num = len(symbols)
+
+    # With a systematic code, healthy reads receive the plain data fragments
+    data_out = __concatenate_data_fragments(symbols)
+    if data_out is not None:
+        return data_out
+
+    # Reconstruct the original data with a decoder
     symbol_size = len(symbols[0]['data']) - symbols_num #subtract the coefficients' size
-    decoder = kodo.block.Decoder(kodo.FiniteField.binary8)
-    decoder.configure(symbols_num, symbol_size)
-    data_out = bytearray(decoder.block_bytes)
-    decoder.set_symbols_storage(data_out)
 
-    for symbol in symbols:
-        # Separate the coefficients from the symbol data
-        coefficients = symbol['data'][:symbols_num]
-        symbol_data = symbol['data'][symbols_num:]
-        # Feed it to the decoder
-        decoder.decode_symbol(symbol_data, coefficients)
+    # Separate the coefficients from the symbol data
+    coefficients = [symbol['data'][:symbols_num] for symbol in symbols]
+    symbol_data = [symbol['data'][symbols_num:] for symbol in symbols]
+    data_out, rank = get_codec().decode(coefficients, symbol_data, symbols_num, symbol_size)
 
     # Make sure the decoder successfully reconstructed the file
-    assert(decoder.is_complete())
+    assert(rank == symbols_num)
     print("File decoded successfully")
 
     return data_out
 #
 
 
-def get_file(coded_fragments, max_erasures, file_size,
-             data_req_socket, response_socket):
+def __request_fragments(coded_fragments, max_erasures, data_req_socket, systematic=False,
+                        spares=READ_SPARES):
     """
-    Implements retrieving a file that is stored with Reed Solomon erasure coding
+    Select the coded fragments needed to reconstruct the data, plus 'spares' extra
+    fragments, and request them from the storage nodes in parallel. The reader decodes
+    from the first fragments that arrive and ignores the rest.
 
     :param coded_fragments: Names of the coded fragments
-    :param max_erasures: Max erasures setting that was used when storing the file
-    :param file_size: The original data size. 
-    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
-    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
-    :return: A list of the random generated chunk names, e.g. (c1,c2), (c3,c4)
+    :param max_erasures: Max erasures setting that was used when storing the data
+    :param data_req_socket: A ZMQ PUB socket to request chunks from the storage nodes
+    :param systematic: Whether the data was stored with the systematic code, then
+                       only the data fragments are requested and 'spares' is ignored
+    :param spares: How many extra fragments to request (None: all of them)
+    :return: The names of the requested fragments
     """
-    
-    # We need 4-max_erasures fragments to reconstruct the file, select this many 
-    # by randomly removing 'max_erasures' elements from the given chunk names. 
-    fragnames = copy.deepcopy(coded_fragments)
-    for i in range(max_erasures):
-        fragnames.remove(random.choice(fragnames))
+
+    symbols = len(coded_fragments) - max_erasures
+    if spares is None:
+        spares = max_erasures
+    fragments_num = min(symbols + spares, len(coded_fragments))
+
+    if systematic:
+        # The first n-max_erasures fragments hold the plain data, which is concatenated
+        # without decoding. A parity fragment would usually arrive among the first ones
+        # and force a decode, so parity fragments are only requested after a deadline miss.
+        fragnames = coded_fragments[:symbols]
+    else:
+        # Randomly select the fragments to request from the given chunk names. 
+        fragnames = random.sample(coded_fragments, fragments_num)
     
     # Request the coded fragments in parallel
     for name in fragnames:
-        task = messages_pb2.getdata_request()
-        task.filename = name
+        __send_fragment_request(name, data_req_socket)
 
-        # Build header
-        header = messages_pb2.header()
-        header.request_type = messages_pb2.FRAGMENT_DATA_REQ
+    return fragnames
+#
 
-        print(f'Requesting fragment: {task.filename}')
-        data_req_socket.send_multipart([
-            header.SerializeToString(),
-            task.SerializeToString()
-            ])
 
-    # Receive all chunks and insert them into the symbols array
+def __send_fragment_request(name, data_req_socket):
+    """
+    Request a coded fragment from the storage nodes
+
+    :param name: Name of the coded fragment
+    :param data_req_socket: A ZMQ PUB socket to request chunks from the storage nodes
+    """
+
+    task = messages_pb2.getdata_request()
+    task.filename = name
+
+    # Build header
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.FRAGMENT_DATA_REQ
+
+    print(f'Requesting fragment: {task.filename}')
+    data_req_socket.send_multipart([
+        header.SerializeToString(),
+        task.SerializeToString()
+        ])
+#
+
+
+def __request_alternate_fragments(coded_fragments, fragnames, count, request_fragment):
+    """
+    Called when a deadline was missed: request up to 'count' fragments that were not
+    requested yet, in place of the ones that did not arrive in time.
+
+    :param coded_fragments: Names of all coded fragments
+    :param fragnames: Names of the requested fragments, the new ones are appended
+    :param count: How many fragments are still missing
+    :param request_fragment: Function that sends the request for a fragment name
+    """
+
+    metrics.increment('fragment_deadline_misses')
+
+    alternates = [name for name in coded_fragments if name not in fragnames][:count]
+    if not alternates:
+        metrics.increment('read_timeouts')
+        raise TimeoutError("Coded fragments did not arrive within %d ms" % FRAGMENT_TIMEOUT)
+
+    metrics.increment('degraded_reads')
+    for name in alternates:
+        print(f'Fragment deadline missed, requesting alternate fragment: {name}')
+        fragnames.append(name)
+        request_fragment(name)
+#
+
+
+def __fragment_size(file_size, symbols):
+    """
+    :param file_size: The size of the data encoded as a generation
+    :param symbols: The number of symbols of the generation (k)
+    :return: The size of each coded fragment, including its coefficients
+    """
+    return symbols + math.ceil(file_size / symbols)
+#
+
+
+def __receive_fragments(coded_fragments, fragnames, symbols_needed, request_fragment,
+                        response_socket, fragment_size):
+    """
+    Receive coded fragments until 'symbols_needed' valid ones arrived. Responses for
+    fragments that were not requested, duplicates and fragments with a different
+    size than 'fragment_size' are ignored. If no fragment arrives for FRAGMENT_TIMEOUT ms,
+    alternate fragments are requested, and when there are none left a TimeoutError is raised.
+
+    :param coded_fragments: Names of all coded fragments
+    :param fragnames: Names of the requested fragments
+    :param symbols_needed: How many fragments are needed to decode
+    :param request_fragment: Function that sends the request for a fragment name
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param fragment_size: The size of each coded fragment (see __fragment_size)
+    :return: The received coded symbols
+    """
+
+    fragnames = list(fragnames)
     symbols = []
-    for _ in range(len(fragnames)):
-        result = response_socket.recv_multipart()
-        # In this case we don't care about the received name, just use the 
-        # data from the second frame
+    received = set()
+    while len(symbols) < symbols_needed:
+        if not response_socket.poll(FRAGMENT_TIMEOUT):
+            __request_alternate_fragments(coded_fragments, fragnames,
+                                          symbols_needed - len(symbols), request_fragment)
+            continue
+
+        # The fragment data is used from the received buffer without copying
+        result = response_socket.recv_multipart(copy=False)
+        name = result[0].bytes.decode('utf-8')
+        if name not in fragnames or name in received:
+            continue
+        if len(result[1]) != fragment_size:
+            print(f'Ignoring fragment {name} with unexpected size {len(result[1])}')
+            continue
+
+        received.add(name)
         symbols.append({
-            "chunkname": result[0].decode('utf-8'), 
-            "data": bytearray(result[1])
+            "chunkname": name, 
+            "data": result[1].buffer
         })
-    print("All coded fragments received successfully")
 
-    #Reconstruct the original file data
-    file_data = decode_file(symbols)
-
-    return file_data[:file_size]
+    return symbols
 #
 
 
-def get_file_for_repair(fragments_to_retrieve, file_size,
-                        repair_socket, repair_response_socket):
+def get_file(coded_fragments, max_erasures, file_size,
+             data_req_socket, response_socket, systematic=False, spares=READ_SPARES):
     """
-    Implements retrieving a file that is stored with Reed Solomon erasure coding for use
-    in the repair process. Apart from the communication with the storage nodes, the
-    implementation is similar to how a file is retrieved using get_file.
+    Implements retrieving a file that is stored with Reed Solomon erasure coding.
+    More fragments than needed are requested (see READ_SPARES), and the file is
+    decoded from the first n-max_erasures fragments that arrive.
 
-    :param fragments_to_retrieve: Names of the coded fragments that should be retrieved
+    :param coded_fragments: Names of the coded fragments
+    :param max_erasures: Max erasures setting that was used when storing the file
     :param file_size: The original data size. 
     :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
-    :return: A list of the random generated chunk names, e.g. (c1,c2), (c3,c4)
+    :param systematic: Whether the file was stored with the systematic code
+    :param spares: How many extra fragments to request (None: all of them)
+    :return: The decoded file
     """
     
-    # Request the coded fragments in parallel.
-    for name in fragments_to_retrieve:
+    fragnames = __request_fragments(coded_fragments, max_erasures, data_req_socket,
+                                    systematic, spares)
+
+    # Receive the first chunks and insert them into the symbols array
+    symbols_needed = len(coded_fragments) - max_erasures
+    symbols = __receive_fragments(coded_fragments, fragnames, symbols_needed,
+                                  lambda name: __send_fragment_request(name, data_req_socket),
+                                  response_socket, __fragment_size(file_size, symbols_needed))
+    print("All coded fragments received successfully")
+
+    #Reconstruct the original file data, and drop the padding in place
+    file_data = decode_file(symbols)
+    del file_data[file_size:]
+
+    return file_data
+#
+
+
+def get_file_stream(stripes, max_erasures, file_size, stripe_size,
+                    data_req_socket, response_socket, start=0, end=None):
+    """
+    Implements retrieving a file that is stored in stripes with Reed Solomon erasure coding
+    as a generator. Every stripe is an independent generation, so it is decoded and yielded
+    as soon as its fragments arrive, while the fragments of the next STRIPES_PREFETCH stripes
+    are already being fetched. If a byte range is given, only the stripes covering that
+    range are fetched and decoded. Fragments whose size does not match their stripe are
+    ignored, and alternate fragments are requested in their place.
+
+    :param stripes: Names of the coded fragments of each stripe
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param file_size: The original data size.
+    :param stripe_size: The stripe size that was used when storing the file
+    :param data_req_socket: A ZMQ PUB socket to request chunks from the storage nodes
+    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param start: First byte of the requested range
+    :param end: End of the requested range (exclusive), defaults to the file size
+    :return: A generator yielding the decoded data of each stripe
+    """
+
+    if end is None:
+        end = file_size
+    if start >= end:
+        return
+
+    # The stripes covering the requested range
+    first_stripe = start // stripe_size
+    last_stripe = (end - 1) // stripe_size
+
+    symbols_needed = len(stripes[first_stripe]) - max_erasures
+    # The stripe each requested (but not yet received) fragment belongs to
+    requested_fragments = {}
+    # The requested fragments of each stripe
+    stripe_fragnames = {}
+    # The received coded fragments of each stripe
+    received_symbols = {}
+    next_stripe = first_stripe
+
+    def request_fragment(name, stripe):
+        requested_fragments[name] = stripe
+        __send_fragment_request(name, data_req_socket)
+
+    def fragment_size(stripe):
+        # The last stripe may be shorter
+        return __fragment_size(min(stripe_size, file_size - stripe * stripe_size), symbols_needed)
+
+    def request_next_stripe():
+        nonlocal next_stripe
+        fragnames = __request_fragments(stripes[next_stripe], max_erasures, data_req_socket)
+        for name in fragnames:
+            requested_fragments[name] = next_stripe
+        stripe_fragnames[next_stripe] = fragnames
+        received_symbols[next_stripe] = []
+        next_stripe += 1
+
+    # Fill the pipeline
+    while next_stripe <= min(first_stripe + STRIPES_PREFETCH - 1, last_stripe):
+        request_next_stripe()
+
+    for i in range(first_stripe, last_stripe + 1):
+        # Receive fragments until the current stripe can be decoded
+        while len(received_symbols[i]) < symbols_needed:
+            if not response_socket.poll(FRAGMENT_TIMEOUT):
+                __request_alternate_fragments(stripes[i], stripe_fragnames[i],
+                                              symbols_needed - len(received_symbols[i]),
+                                              lambda name: request_fragment(name, i))
+                continue
+
+            result = response_socket.recv_multipart(copy=False)
+            name = result[0].bytes.decode('utf-8')
+            stripe = requested_fragments.pop(name, None)
+            if stripe not in received_symbols or len(received_symbols[stripe]) == symbols_needed:
+                # A spare fragment of a stripe that has already enough fragments
+                continue
+            if len(result[1]) != fragment_size(stripe):
+                # A truncated or damaged fragment, request another one in its place
+                print(f'Ignoring fragment {name} with unexpected size {len(result[1])}')
+                alternates = [alternate for alternate in stripes[stripe]
+                              if alternate not in stripe_fragnames[stripe]]
+                if alternates:
+                    stripe_fragnames[stripe].append(alternates[0])
+                    request_fragment(alternates[0], stripe)
+                continue
+            received_symbols[stripe].append({
+                "chunkname": name,
+                "data": result[1].buffer
+            })
+
+        # Keep fetching later stripes while this one is decoded and sent
+        if next_stripe <= last_stripe:
+            request_next_stripe()
+
+        # Only send the part of the stripe that is inside the requested range,
+        # without the padding of the last symbol
+        stripe_start = i * stripe_size
+        stripe_fragnames.pop(i)
+        stripe_data = decode_file(received_symbols.pop(i))
+        yield bytes(memoryview(stripe_data)[max(start - stripe_start, 0):
+                                            min(end, file_size, stripe_start + stripe_size) - stripe_start])
+#
+
+
+def __retrieve_fragments_for_repair(fragments_to_retrieve, file_size, repair_socket,
+                                    repair_response_socket, alternate_fragments=()):
+    def request_fragment(name):
         task = messages_pb2.getdata_request()
         task.filename = name
         header = messages_pb2.header()
@@ -241,149 +610,320 @@ def get_file_for_repair(fragments_to_retrieve, file_size,
         repair_socket.send_multipart([b"all_nodes",
                                       header.SerializeToString(),
                                       task.SerializeToString()])
+    
+    # Request the coded fragments in parallel.
+    for name in fragments_to_retrieve:
+        request_fragment(name)
 
     # Receive all chunks and insert them into the symbols array
-    symbols = []
-    for _ in range(len(fragments_to_retrieve)):
-        result = repair_response_socket.recv_multipart()
-        # In this case we don't care about the received name, just use the 
-        # data from the second frame
-        symbols.append({
-            "chunkname": result[0].decode('utf-8'), 
-            "data": bytearray(result[1])
-        })
+    symbols = __receive_fragments(list(fragments_to_retrieve) + list(alternate_fragments),
+                                  fragments_to_retrieve, len(fragments_to_retrieve),
+                                  request_fragment, repair_response_socket,
+                                  __fragment_size(file_size, len(fragments_to_retrieve)))
     print(str(len(fragments_to_retrieve)) + " coded fragments received successfully")
+    return symbols
+#
+
 
-    #Reconstruct the original file data
+def __decode_for_repair(symbols, file_size):
+    #Reconstruct the original file data, and drop the padding in place
     file_data = decode_file(symbols)
+    del file_data[file_size:]
+    return file_data
+#
+
+
+def reencode_fragments(symbol_data, file_size, missing_vectors):
+    """
+    Decode a file from the retrieved coded fragments and re-encode its missing fragments.
+    Runs in the coding process pool of the repairs (see repair.run_coding).
+
+    :param symbol_data: The retrieved coded fragments as bytes
+    :param file_size: The original data size
+    :param missing_vectors: The coefficient vectors of the missing fragments
+    :return: The re-encoded fragments, prefixed with their coefficients
+    """
+    symbols = len(symbol_data)
+    file_data = __decode_for_repair([{"data": data} for data in symbol_data], file_size)
 
-    return file_data[:file_size]# Reconstruct the original data with a decoder
+    # The size of one coded fragment (total size/number of symbols, rounded up)
+    symbol_size = math.ceil(len(file_data)/symbols)
+    return get_codec().encode(file_data, missing_vectors, symbols, symbol_size,
+                              with_coefficients=True)
 #
 
 
-def start_repair_process(files, repair_socket, repair_response_socket):
+def start_repair_process(files, repair_socket, repair_dispatcher, expected_counts=None,
+                         chained=False):
     """
     Implements the repair process for Reed Solomon erasure coding. It receives a list
-    of files that are to be checked. For each file, it sends queries to the Storage
-    nodes to check that all coded fragments are stored safely. If it finds a missing
-    fragment, it determines which Storage node was supposed to store it and repairs it.
-    This happens by first retrieving the original file data, then re-encoding the missing
-    fragment. It also handles multiple missing fragments for a file, as long as their
-    number does not exceed `max_erasures`.
+    of files that are to be checked. It compares the inventories of the Storage nodes with
+    the catalogue, and queries the Storage nodes in batches to check that the coded fragments
+    of the suspicious files are stored safely (see repair.check_files). The files with
+    missing fragments are then repaired with repair_file, several at the same time
+    (see repair.repair_files).
 
     :param files: List of files to be checked
     :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_dispatcher: The ResponseDispatcher of the socket the storage nodes respond on
+    :param expected_counts: The expected subfragment count of every fragment in the catalogue
+                            (see repair.check_files)
+    :param chained: Rebuild the fragments on the storage nodes with repair_file_chained
+    :return: the number of missing fragments, the number of repaired fragments
+    """
+
+    # Check the fragments of all files at once
+    with repair_dispatcher.channel() as channel:
+        nodes, files, fragment_status = check_files(files, STORAGE_NODES_NUM,
+                                                    channel.socket(repair_socket, header_frame=1),
+                                                    channel, expected_counts)
+
+    repair_stripe = repair_file_chained if chained else repair_file
+
+    def repair(file, *args):
+        if file["storage_mode"] == 'erasure_coding_rs_striped':
+            return repair_file_striped(file, *args, repair_stripe=repair_stripe)
+        return repair_stripe(file, *args)
+
+    return repair_files(files, repair, nodes, fragment_status, repair_socket, repair_dispatcher)
+#
+
+
+def __find_missing_fragments(file, nodes, fragment_status):
+    """
+    :return: The existing fragments of the file, the missing fragments, and the available
+             nodes that store none of its fragments
+    """
+    print("Checking file with id: %s" % file["id"])
+
+    #Iterate over each coded fragment to check that it is not missing
+    nodes_with_fragment = set() # list of storage nodes with fragments
+    missing_fragments = [] # list of missing coded fragments
+    existing_fragments = [] # list of existing coded fragments
+    for fragment in file["storage_details"]["coded_fragments"]:
+        fragment_found = False
+        # The nodes that store the fragment
+        for node_id in fragment_status[fragment]:
+            nodes_with_fragment.add(node_id)
+            existing_fragments.append(fragment)
+            fragment_found = True
+
+        if fragment_found == False:
+            print("Fragment %s lost" % fragment)
+            missing_fragments.append(fragment)
+        else:
+            print("Fragment %s OK" % fragment)
+
+    # If we have lost fragments, we must figure out where they were stored
+    # We assume that each node has exactly 1 or 0 fragments
+    nodes_without_fragment = list(set(nodes).difference(nodes_with_fragment))
+    return existing_fragments, missing_fragments, nodes_without_fragment
+#
+
+
+def __can_repair(storage_details, missing_fragments, nodes_without_fragment):
+    """
+    :return: Whether the file has missing fragments that can be repaired
+    """
+    # Perform the actual repair, if necessary
+    if len(missing_fragments) == 0:
+        return False
+
+    # Check that enough fragments still remain to be able to repair
+    if len(missing_fragments) > storage_details["max_erasures"]:
+        print("Too many lost fragments: %s. Unable to repair file. " % len(missing_fragments))
+        return False
+    if len(missing_fragments) > len(nodes_without_fragment):
+        print("Not enough available nodes to store %s lost fragments" % len(missing_fragments))
+        return False
+    return True
+#
+
+
+def repair_file(file, nodes, fragment_status, repair_socket, repair_response_socket):
+    """
+    Repairs the missing fragments of a file stored with Reed Solomon erasure coding.
+    It determines which Storage node was supposed to store each missing fragment, retrieves
+    the original file data, re-encodes the missing fragments and stores them. It handles
+    multiple missing fragments, as long as their number does not exceed `max_erasures`.
+
+    :param file: The file to repair, as a dictionary (see File.to_dict)
+    :param nodes: The ids of the available storage nodes
+    :param fragment_status: For each coded fragment of the file, the nodes that store it
+                            (see repair.get_fragment_status)
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
     :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
     :return: the number of missing fragments, the number of repaired fragments
     """
 
-    number_of_missing_fragments = 0
-    number_of_repaired_fragments = 0
-
-    #Check that each file is actually stored on the storage nodes
-    for file in files:
-        print("Checking file with id: %s" % file["id"])
-        #We parse the JSON into a python dictionary
-        storage_details = json.loads(file["storage_details"])
-
-        #Iterate over each coded fragment to check that it is not missing
-        nodes = set() # list of all storage nodes
-        nodes_with_fragment = set() # list of storage nodes with fragments
-        coded_fragments = storage_details["coded_fragments"] # list of all coded fragments
-        missing_fragments = [] # list of missing coded fragments
-        existing_fragments = [] # list of existing coded fragments
-        for fragment in coded_fragments:
-            task = messages_pb2.fragment_status_request()
-            task.fragment_name = fragment
-            header = messages_pb2.header()
-            header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
-
-            repair_socket.send_multipart([b"all_nodes",
-                                          header.SerializeToString(),
-                                          task.SerializeToString()])
-
-            fragment_found = False
-            # Wait until we receive a response from each node
-            for task_nbr in range(STORAGE_NODES_NUM):
-                msg = repair_response_socket.recv()
-                response = messages_pb2.fragment_status_response()
-                response.ParseFromString(msg)
-                
-                nodes.add(response.node_id) #Build a set of nodes
-                if response.is_present == True:
-                    nodes_with_fragment.add(response.node_id)
-                    existing_fragments.append(fragment)
-                    fragment_found = True
-
-            if fragment_found == False:
-                print("Fragment %s lost" % fragment)
-                missing_fragments.append(fragment)
-                number_of_missing_fragments += 1
-            else:
-                print("Fragment %s OK" % fragment)
-
-        # If we have lost fragments, we must figure out where they were stored
-        # We assume that each node has exactly 1 or 0 fragments
-        nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
-
-
-        # Perform the actual repair, if necessary
-        if len(missing_fragments) > 0:
-            # Check that enough fragments still remain to be able to repair
-            if len(missing_fragments) > storage_details["max_erasures"]:
-                print("Too many lost fragments: %s. Unable to repair file. " % len(missing_fragments))
-                continue
+    storage_details = file["storage_details"]
+    coded_fragments = storage_details["coded_fragments"] # list of all coded fragments
+    existing_fragments, missing_fragments, nodes_without_fragment = \
+        __find_missing_fragments(file, nodes, fragment_status)
+    if not __can_repair(storage_details, missing_fragments, nodes_without_fragment):
+        return len(missing_fragments), 0
+
+    # Retrieve sufficient fragments
+    symbols = len(coded_fragments) - storage_details["max_erasures"]
+    try:
+        retrieved = __retrieve_fragments_for_repair(existing_fragments[:symbols], # only as many as necessary
+                                                    file["size"],
+                                                    repair_socket,
+                                                    repair_response_socket,
+                                                    existing_fragments[symbols:]
+        )
+    except TimeoutError as e:
+        print("Unable to retrieve file for repair: %s" % e)
+        return len(missing_fragments), 0
+
+    # Select the appropriate Reed Solomon coefficient vectors
+    systematic = file["storage_mode"] == 'erasure_coding_rs_systematic'
+    vectors = coefficient_vectors(storage_details["max_erasures"], systematic,
+                                  storage_details.get("n"))
+    missing_vectors = [vectors[coded_fragments.index(missing_fragment)]
+                       for missing_fragment in missing_fragments]
+    # Decode and re-encode each missing fragment in the coding processes
+    repaired_fragments = run_coding(reencode_fragments,
+                                    [bytes(symbol["data"]) for symbol in retrieved],
+                                    file["size"], missing_vectors)
+
+    for missing_fragment, fragment, node_id in zip(missing_fragments, repaired_fragments,
+                                                   nodes_without_fragment):
+        # Save with the same name as before
+        # Send a Protobuf STORE DATA request to the Storage Nodes
+        task = messages_pb2.storedata_request()
+        task.filename = missing_fragment
+
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+
+        #Use the node_id as the topic
+        repair_socket.send_multipart([node_id.encode('UTF-8'),
+                                      header.SerializeToString(),
+                                      task.SerializeToString(),
+                                      fragment
+        ], copy=False)
+
+    # Wait until we receive a response for every fragment
+    stored = wait_for_acknowledgements(missing_fragments, repair_response_socket, FRAGMENT_TIMEOUT)
+
+    return len(missing_fragments), len(stored)
+#
 
-            # Retrieve sufficient fragments and decode
-            symbols = STORAGE_NODES_NUM - storage_details["max_erasures"]
-            file_data = get_file_for_repair(existing_fragments[:symbols], # only as many as necessary
-                                            file["size"],
-                                            repair_socket,
-                                            repair_response_socket
-            )
-
-            #Build the encoder
-            # How many coded fragments (=symbols) will be required to reconstruct the encoded data. 
-            symbols = STORAGE_NODES_NUM - storage_details["max_erasures"]
-            # The size of one coded fragment (total size/number of symbols, rounded up)
-            symbol_size = math.ceil(len(file_data)/symbols)
-            # Kodo RLNC encoder using 2^8 finite field
-            encoder = kodo.block.Encoder(kodo.FiniteField.binary8)
-            encoder.configure(symbols, symbol_size)
-            encoder.set_symbols_storage(file_data)
-            symbol = bytearray(encoder.symbol_bytes)
-
-            # Re-encode each missing fragment: 
-            for missing_fragment in missing_fragments:
-                fragment_index = coded_fragments.index(missing_fragment)
-                # Select the appropriate Reed Solomon coefficient vector
-                coefficients = RS_CAUCHY_COEFFS[fragment_index]
-                # Generate a coded fragment with these coefficients
-                # (trim the coeffs to the actual length we need)
-                encoder.encode_symbol(symbol, coefficients[:symbols])
-
-                # Save with the same name as before
-                # Send a Protobuf STORE DATA request to the Storage Nodes
-                task = messages_pb2.storedata_request()
-                task.filename = missing_fragment
-
-                header = messages_pb2.header()
-                header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
-
-                node_id = nodes_without_fragment[number_of_repaired_fragments]
-
-                #Use the node_id as the topic
-                repair_socket.send_multipart([node_id.encode('UTF-8'),
-                                              header.SerializeToString(),
-                                              task.SerializeToString(),
-                                              coefficients[:symbols] + bytearray(symbol)
-                ])
-                number_of_repaired_fragments += 1
-
-            # Wait until we receive a response for every fragment
-            for task_nbr in range(len(missing_fragments)):
-                resp = repair_response_socket.recv_string()
-                print('Repaired fragment: %s' % resp)
-
-
-    return number_of_missing_fragments, number_of_repaired_fragments
+
+def repair_file_striped(file, nodes, fragment_status, repair_socket, repair_response_socket,
+                        repair_stripe=None):
+    """
+    Repairs the missing fragments of a file stored in stripes with Reed Solomon erasure
+    coding. Every stripe is an independent generation, so only the stripes with missing
+    fragments are retrieved and repaired, one at a time (see repair.stripe_files).
+
+    :param file: The file to repair, as a dictionary (see File.to_dict)
+    :param nodes: The ids of the available storage nodes
+    :param fragment_status: For each coded fragment of the file, the nodes that store it
+                            (see repair.get_fragment_status)
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param repair_stripe: The function that repairs a stripe (default: repair_file)
+    :return: the number of missing fragments, the number of repaired fragments
+    """
+
+    if repair_stripe is None:
+        repair_stripe = repair_file
+
+    fragments_missing = 0
+    fragments_repaired = 0
+    for stripe in stripe_files(file):
+        if all(fragment_status[name] for name in stripe["storage_details"]["coded_fragments"]):
+            continue
+        missing, repaired = repair_stripe(stripe, nodes, fragment_status,
+                                          repair_socket, repair_response_socket)
+        fragments_missing += missing
+        fragments_repaired += repaired
+
+    return fragments_missing, fragments_repaired
+#
+
+
+def repair_file_chained(file, nodes, fragment_status, repair_socket, repair_response_socket):
+    """
+    Repairs the missing fragments of a file like repair_file, but without sending the
+    fragments through the lead node. A missing fragment is a linear combination of any
+    'symbols' surviving fragments; the coefficients follow from inverting the coefficient
+    matrix of the survivors. The lead node only sends each survivor its coefficient: the
+    first survivor scales its fragment and sends it to the next one, which adds its own
+    scaled fragment, and so on. The last survivor sends the rebuilt fragment to the node
+    that stores it. Every node sends and receives one fragment per repaired fragment.
+
+    :param file: The file to repair, as a dictionary (see File.to_dict)
+    :param nodes: The ids of the available storage nodes
+    :param fragment_status: For each coded fragment of the file, the nodes that store it
+                            (see repair.get_fragment_status)
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: the number of missing fragments, the number of repaired fragments
+    """
+
+    storage_details = file["storage_details"]
+    coded_fragments = storage_details["coded_fragments"]
+    existing_fragments, missing_fragments, nodes_without_fragment = \
+        __find_missing_fragments(file, nodes, fragment_status)
+    if not __can_repair(storage_details, missing_fragments, nodes_without_fragment):
+        return len(missing_fragments), 0
+
+    symbols = len(coded_fragments) - storage_details["max_erasures"]
+    systematic = file["storage_mode"] == 'erasure_coding_rs_systematic'
+    vectors = coefficient_vectors(storage_details["max_erasures"], systematic,
+                                  storage_details.get("n"))
+
+    # The survivors that take part in the chain, and the inverse of their coefficient matrix
+    helpers = existing_fragments[:symbols]
+    inverse = gf256.invert_matrix([vectors[coded_fragments.index(helper)] for helper in helpers])
+
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.CHAIN_REPAIR_REQ
+
+    for missing_fragment, node_id in zip(missing_fragments, nodes_without_fragment):
+        # missing vector = coefficients * helper vectors, so coefficients = missing vector * inverse
+        missing_vector = vectors[coded_fragments.index(missing_fragment)]
+        coefficients = [0] * symbols
+        for factor, row in zip(missing_vector, inverse):
+            for j in range(symbols):
+                coefficients[j] ^= gf256.mul(factor, row[j])
+
+        task = messages_pb2.chain_repair_request()
+        task.fragment_name = missing_fragment
+        task.destination_address = node_address(node_id)
+        for helper, coefficient in zip(helpers, coefficients):
+            hop = task.hops.add()
+            hop.node_address = node_address(next(iter(fragment_status[helper])))
+            hop.fragment_name = helper
+            hop.coefficient = coefficient
+
+        # The first hop starts the chain, use its node_id as the topic
+        first_node_id = next(iter(fragment_status[helpers[0]]))
+        repair_socket.send_multipart([first_node_id.encode('UTF-8'),
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+
+    # Wait until the destination of every chain confirms the stored fragment
+    stored = wait_for_acknowledgements(missing_fragments, repair_response_socket, CHAIN_REPAIR_TIMEOUT)
+
+    return len(missing_fragments), len(stored)
+#
+
+
+def chain_combine(fragment, coefficient, partial=None):
+    """
+    One step of a chained repair (see repair_file_chained): scale a stored fragment and
+    add it to the partial combination received from the previous node.
+
+    :param fragment: The stored coded fragment, with its coefficients in front
+    :param coefficient: The coefficient of the fragment in the combination
+    :param partial: The partial combination of the previous nodes, None on the first node
+    :return: The new partial combination
+    """
+    if partial is None:
+        return get_codec().combine([bytearray([coefficient])], [fragment])[0]
+    return get_codec().combine([bytearray([coefficient, 1])], [fragment, partial])[0]
+#
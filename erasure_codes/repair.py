@@ -0,0 +1,411 @@
+"""
+Helpers shared by the repair processes of the Reed Solomon and RLNC modules.
+"""
+import concurrent.futures
+import multiprocessing
+import threading
+
+from models import messages_pb2
+from storage.fragment_index import INVENTORY_BUCKETS, inventory_bucket, inventory_digest
+
+# How many fragment names are sent in one batched status request
+STATUS_BATCH_SIZE = 1000
+# How many status batches may be waiting for responses at the same time.
+# Bounded, because PUB sockets drop messages above their high water mark.
+STATUS_BATCHES_IN_FLIGHT = 8
+# How long to wait for the next status response (in milliseconds) before
+# treating the nodes that did not respond as unavailable
+STATUS_TIMEOUT = 2000
+# How many files are repaired at the same time
+REPAIRS_IN_FLIGHT = 8
+# Number of processes that decode and re-encode the files being repaired
+# (None: one per CPU core)
+CODING_PROCESSES = None
+
+__coding_pool = None
+__coding_pool_lock = threading.Lock()
+
+# The last address each storage node reported in a status response, by node id
+__node_addresses = dict()
+
+
+def __send_status_batch(fragment_names, batch, repair_socket):
+    task = messages_pb2.fragment_status_batch_request()
+    task.fragment_names[:] = fragment_names
+    task.batch = batch
+
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.FRAGMENT_STATUS_BATCH_REQ
+
+    repair_socket.send_multipart([b"all_nodes",
+                                  header.SerializeToString(),
+                                  task.SerializeToString()])
+#
+
+
+def get_fragment_status(fragment_names, node_count, repair_socket, repair_response_socket):
+    """
+    Ask all storage nodes which of the given fragments they store, and how many
+    subfragments of each. The names are sent in batches of STATUS_BATCH_SIZE, and up to
+    STATUS_BATCHES_IN_FLIGHT batches are pipelined, so a scan needs a handful of round
+    trips per node instead of one per fragment.
+    If no response arrives for STATUS_TIMEOUT ms, the nodes that have not responded at all
+    are treated as unavailable, and the batches are only waited for from the others. If
+    that happens again, the nodes that still owe responses are treated as unavailable too.
+
+    :param fragment_names: Names of the fragments to check
+    :param node_count: Number of storage nodes
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: The ids of the nodes that responded, and for each fragment name a dictionary
+             with the subfragment count on each node that stores the fragment
+    """
+
+    fragment_names = list(fragment_names)
+    batches = [fragment_names[i:i + STATUS_BATCH_SIZE]
+               for i in range(0, len(fragment_names), STATUS_BATCH_SIZE)]
+    status = {name: dict() for name in fragment_names}
+    nodes = set()
+
+    # The nodes that responded to each batch in flight
+    pending = dict()
+    # The nodes whose responses are waited for, None until the first timeout: any node_count nodes
+    expected_nodes = None
+    # The nodes that stopped responding after they responded at first
+    unavailable_nodes = set()
+    next_batch = 0
+
+    def batch_done(batch):
+        if expected_nodes is None:
+            return len(pending[batch]) >= node_count
+        return expected_nodes <= pending[batch]
+
+    while next_batch < len(batches) or pending:
+        # Keep the pipeline full
+        while next_batch < len(batches) and len(pending) < STATUS_BATCHES_IN_FLIGHT:
+            __send_status_batch(batches[next_batch], next_batch, repair_socket)
+            pending[next_batch] = set()
+            next_batch += 1
+
+        if not repair_response_socket.poll(STATUS_TIMEOUT):
+            if not nodes:
+                raise TimeoutError("No storage node responded within %d ms" % STATUS_TIMEOUT)
+            if expected_nodes is None:
+                print("Only %d of %d storage nodes responded to the status requests"
+                      % (len(nodes), node_count))
+                # Don't wait for the missing nodes again
+                expected_nodes = set(nodes)
+            else:
+                # The nodes that still owe responses stopped responding
+                for responded in pending.values():
+                    unavailable_nodes.update(expected_nodes - responded)
+                    expected_nodes &= responded
+                if not expected_nodes:
+                    raise TimeoutError("The storage nodes stopped responding for %d ms" % STATUS_TIMEOUT)
+                print("Storage nodes stopped responding to the status requests, %d of %d left"
+                      % (len(expected_nodes), node_count))
+            for batch in [batch for batch in pending if batch_done(batch)]:
+                del pending[batch]
+            continue
+
+        response = messages_pb2.fragment_status_batch_response()
+        response.ParseFromString(repair_response_socket.recv())
+        if response.batch >= len(batches):
+            continue
+
+        nodes.add(response.node_id)
+        __node_addresses[response.node_id] = response.node_address
+        for name, count in zip(batches[response.batch], response.counts):
+            if count > 0:
+                status[name][response.node_id] = count
+
+        if response.batch in pending:
+            pending[response.batch].add(response.node_id)
+            if batch_done(response.batch):
+                del pending[response.batch]
+
+    return nodes - unavailable_nodes, status
+#
+
+
+def node_address(node_id):
+    """
+    :param node_id: The id of a storage node
+    :return: The address the node reported in its last status response (see get_fragment_status),
+             which the storage nodes use to send messages to each other
+    """
+    return __node_addresses[node_id]
+#
+
+
+def get_inventory_digests(node_count, repair_socket, repair_response_socket):
+    """
+    Ask all storage nodes for their inventory digests, and combine them with XOR
+
+    :param node_count: Number of storage nodes
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: The ids of the nodes that responded, and the combined digest of every bucket
+    """
+
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.INVENTORY_DIGEST_REQ
+    repair_socket.send_multipart([b"all_nodes",
+                                  header.SerializeToString(),
+                                  messages_pb2.inventory_digest_request().SerializeToString()])
+
+    nodes = set()
+    digests = [0] * INVENTORY_BUCKETS
+    while len(nodes) < node_count and repair_response_socket.poll(STATUS_TIMEOUT):
+        response = messages_pb2.inventory_digest_response()
+        response.ParseFromString(repair_response_socket.recv())
+        if response.node_id in nodes or len(response.digests) != INVENTORY_BUCKETS:
+            continue
+
+        nodes.add(response.node_id)
+        for bucket, digest in enumerate(response.digests):
+            digests[bucket] ^= digest
+
+    if not nodes:
+        raise TimeoutError("No storage node responded within %d ms" % STATUS_TIMEOUT)
+    return nodes, digests
+#
+
+
+def fragment_counts(file):
+    """
+    :param file: A file from the catalogue as a dictionary (see File.to_dict)
+    :return: The expected subfragment count of each fragment of the file
+    """
+    storage_details = file["storage_details"]
+    if file["storage_mode"] == 'erasure_coding_rs_striped':
+        return {name: 1 for stripe in storage_details["stripes"] for name in stripe}
+    # RLNC stores several subfragments per fragment, Reed Solomon one
+    count = storage_details.get("subfragments_per_node") or 1
+    return {name: count for name in storage_details["coded_fragments"]}
+#
+
+
+def find_damaged_buckets(expected_counts, node_count, repair_socket, repair_response_socket):
+    """
+    Anti-entropy check of the storage nodes against the catalogue. Each node keeps a digest
+    of the fragments it stores per bucket of fragment names. Every fragment is stored on
+    exactly one node, so the XOR of the digests of all nodes must equal the digests computed
+    from the catalogue, unless fragments in the bucket are lost or damaged.
+
+    :param expected_counts: The expected subfragment count of every fragment in the catalogue
+    :param node_count: Number of storage nodes
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :return: The ids of the nodes that responded, and the buckets that don't match the catalogue
+    """
+
+    nodes, node_digests = get_inventory_digests(node_count, repair_socket, repair_response_socket)
+
+    # The digests the buckets should have according to the catalogue
+    expected_digests = [0] * INVENTORY_BUCKETS
+    for name, count in expected_counts.items():
+        expected_digests[inventory_bucket(name)] ^= inventory_digest(name, count)
+
+    damaged_buckets = set(bucket for bucket in range(INVENTORY_BUCKETS)
+                          if node_digests[bucket] != expected_digests[bucket])
+    print("Inventory digests: %d of %d buckets differ from the catalogue"
+          % (len(damaged_buckets), INVENTORY_BUCKETS))
+    return nodes, damaged_buckets
+#
+
+
+def check_files(files, node_count, repair_socket, repair_response_socket, expected_counts=None):
+    """
+    Find the files that may have lost fragments, and get the status of their fragments.
+    The inventory digests of the nodes are compared with the catalogue first, and only
+    the files with a fragment in a bucket that doesn't match are checked with
+    get_fragment_status, so intact parts of the catalogue cost no per-fragment requests.
+
+    :param files: The files to check, as dictionaries (see File.to_dict)
+    :param node_count: Number of storage nodes
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param expected_counts: The expected subfragment count of every fragment stored on the
+                            nodes (see fragment_counts). Defaults to the fragments of 'files',
+                            which makes every bucket differ if other files are stored too.
+    :return: The ids of the nodes that responded, the files to check, and for each of their
+             fragments a dictionary with the subfragment count on each node that stores it
+    """
+
+    if expected_counts is None:
+        expected_counts = dict()
+        for file in files:
+            expected_counts.update(fragment_counts(file))
+
+    nodes, damaged_buckets = find_damaged_buckets(expected_counts, node_count,
+                                                  repair_socket, repair_response_socket)
+
+    files = [file for file in files
+             if any(inventory_bucket(name) in damaged_buckets for name in fragment_counts(file))]
+    if not files:
+        return nodes, files, dict()
+
+    status_nodes, status = get_fragment_status(
+        [name for file in files for name in fragment_counts(file)],
+        len(nodes), repair_socket, repair_response_socket)
+    return nodes | status_nodes, files, status
+#
+
+
+def stripe_files(file):
+    """
+    Split a file stored in stripes into one file per stripe. Every stripe is an
+    independent Reed Solomon generation, so it can be checked and repaired like a file
+    stored with 'erasure_coding_rs'. Files stored without stripes are returned as they are.
+
+    :param file: A file from the catalogue as a dictionary (see File.to_dict)
+    :return: A list of files as dictionaries
+    """
+    if file["storage_mode"] != 'erasure_coding_rs_striped':
+        return [file]
+
+    storage_details = file["storage_details"]
+    stripe_size = storage_details["stripe_size"]
+    files = []
+    for i, stripe in enumerate(storage_details["stripes"]):
+        details = {key: value for key, value in storage_details.items()
+                   if key not in ('stripes', 'stripe_size')}
+        details["coded_fragments"] = stripe
+        files.append({
+            "id": "%s/%d" % (file["id"], i),
+            "storage_mode": 'erasure_coding_rs',
+            # The last stripe may be shorter
+            "size": min(stripe_size, file["size"] - i * stripe_size),
+            "storage_details": details
+        })
+    return files
+#
+
+
+def missing_subfragments(file, fragment_status):
+    """
+    :param file: A file from the catalogue as a dictionary (see File.to_dict)
+    :param fragment_status: For each fragment of the file, the subfragment count on each
+                            node that stores it (see get_fragment_status)
+    :return: How many subfragments of the file are missing from the storage nodes
+    """
+    return sum(max(count - sum(fragment_status.get(name, dict()).values()), 0)
+               for name, count in fragment_counts(file).items())
+#
+
+
+def remaining_redundancy(file, fragment_status):
+    """
+    How many more fragments of a file can be lost before it can no longer be decoded.
+    For RLNC partially lost fragments count as a fraction of a fragment.
+    A negative value means the file is already lost.
+
+    :param file: A file from the catalogue as a dictionary (see File.to_dict)
+    :param fragment_status: For each fragment of the file, the subfragment count on each
+                            node that stores it (see get_fragment_status)
+    :return: The number of fragments that can still be lost
+    """
+    if file["storage_mode"] == 'erasure_coding_rs_striped':
+        # Every stripe is decoded on its own, so the file is lost with its weakest stripe
+        return min(remaining_redundancy(stripe, fragment_status) for stripe in stripe_files(file))
+
+    storage_details = file["storage_details"]
+    subfragments_per_node = storage_details.get("subfragments_per_node") or 1
+    coded_fragments = storage_details["coded_fragments"]
+    needed = (len(coded_fragments) - storage_details["max_erasures"]) * subfragments_per_node
+    present = sum(min(sum(fragment_status.get(name, dict()).values()), count)
+                  for name, count in fragment_counts(file).items())
+    return (present - needed) / subfragments_per_node
+#
+
+
+def wait_for_acknowledgements(fragment_names, repair_response_socket, timeout):
+    """
+    Wait until the storage nodes acknowledge that they stored the given fragments.
+    If no acknowledgement arrives for 'timeout' ms, the remaining fragments are left
+    unrepaired, so a node that fails during a repair does not block it forever.
+
+    :param fragment_names: Names of the fragments sent to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param timeout: How long to wait for the next acknowledgement in milliseconds
+    :return: The names of the acknowledged fragments
+    """
+    pending = set(fragment_names)
+    stored = set()
+    while pending:
+        if not repair_response_socket.poll(timeout):
+            print("%d fragments were not acknowledged within %d ms" % (len(pending), timeout))
+            break
+        name = repair_response_socket.recv_string()
+        if name in pending:
+            pending.remove(name)
+            stored.add(name)
+            print('Repaired fragment: %s' % name)
+    return stored
+#
+
+
+def start_coding_pool():
+    """
+    Start the process pool of run_coding. The workers are started by a forkserver,
+    a fresh process that holds no threads, locks or ZMQ contexts of the caller, so
+    the pool is safe to use from a multithreaded server. Call this at startup before
+    any threads are started. The main module is imported by the workers, so its
+    startup code must be behind an "if __name__ == '__main__'" guard.
+    """
+    global __coding_pool
+    with __coding_pool_lock:
+        if __coding_pool is None:
+            __coding_pool = concurrent.futures.ProcessPoolExecutor(
+                CODING_PROCESSES, mp_context=multiprocessing.get_context('forkserver'))
+#
+
+
+def run_coding(function, *args):
+    """
+    Run a CPU bound coding function in the process pool shared by all repairs, so
+    concurrent repairs decode and encode on all cores instead of contending for the GIL.
+    The arguments and the result are pickled, so they can't be memoryviews.
+    The pool is started on first use if start_coding_pool was not called.
+
+    :param function: A module level function
+    :param args: The arguments of the function
+    :return: The result of the function
+    """
+    start_coding_pool()
+    return __coding_pool.submit(function, *args).result()
+#
+
+
+def repair_files(files, repair_file, nodes, fragment_status, repair_socket, repair_dispatcher,
+                 max_in_flight=REPAIRS_IN_FLIGHT):
+    """
+    Repair several files at the same time, so the round trips of one repair overlap with
+    the transfers and the coding of the others. Every repair receives the responses to its
+    requests through its own channel of the dispatcher.
+
+    :param files: The files to repair, as dictionaries (see File.to_dict)
+    :param repair_file: The repair_file function of the coding module of the files
+    :param nodes: The ids of the available storage nodes
+    :param fragment_status: For each fragment of the files, the subfragment count on each
+                            node that stores it (see get_fragment_status)
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_dispatcher: The ResponseDispatcher of the socket the storage nodes respond on
+    :param max_in_flight: Maximum number of files repaired at the same time
+    :return: the total number of missing fragments, the total number of repaired fragments
+    """
+
+    def repair(file):
+        with repair_dispatcher.channel() as channel:
+            return repair_file(file, nodes, fragment_status,
+                               channel.socket(repair_socket, header_frame=1), channel)
+
+    missing_total = 0
+    repaired_total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_in_flight) as executor:
+        for missing, repaired in executor.map(repair, files):
+            missing_total += missing
+            repaired_total += repaired
+    return missing_total, repaired_total
+#
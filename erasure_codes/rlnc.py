@@ -1,15 +1,22 @@
-import kodo
 import math
 import random
-import copy # for deepcopy
-from utils import random_string
+from utils import random_string, STORAGE_NODES_NUM
 from models import messages_pb2
-import json
-
-STORAGE_NODES_NUM = 4
+from erasure_codes.codec import get_codec
+from erasure_codes.repair import check_files, repair_files, run_coding, wait_for_acknowledgements
+import metrics
+
+# How many fragments are requested on top of the ones needed to decode, so a slow or
+# unavailable node does not stall a read. None requests all fragments.
+READ_SPARES = 1
+# How long to wait for the next fragment (in milliseconds) before requesting
+# alternate fragments, and before giving up when there are none left
+FRAGMENT_TIMEOUT = 2000
+# Number of bytes of each subfragment that are recoded at once by recode_stream
+RECODE_CHUNK_SIZE = 1024 * 1024
 
 def store_file(file_data, max_erasures, subfragments_per_node,
-               send_task_socket, response_socket):
+               send_task_socket, response_socket, fragment_count=STORAGE_NODES_NUM):
     """
     Store a file using RLNC, protecting it against 'max_erasures' unavailable storage nodes.
     Alternatively, protect against a total of 'max_erasures' * 'subfragments_per_node'
@@ -18,41 +25,33 @@ def store_file(file_data, max_erasures, subfragments_per_node,
     :param file_data: The file contents to be stored as a Python bytearray 
     :param max_erasures: How many storage node failures should the data survive
     :param subfragments_per_node: How many sugfragments are stored per fragment on a node
-    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes, wrapped with RequestChannel.socket
     :param response_socket: A ZMQ PULL socket where the storage nodes respond
+    :param fragment_count: The number of coded fragments (n), at most STORAGE_NODES_NUM
     :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
     """
 
-    # Make sure we can realize max_erasures with 4 storage nodes
+    # Every coded fragment is stored on a different node
+    assert(fragment_count <= STORAGE_NODES_NUM)
+    # Make sure we can realize max_erasures with the given number of fragments
     assert(max_erasures >= 0)
-    assert(max_erasures < STORAGE_NODES_NUM)
+    assert(max_erasures < fragment_count)
 
     # At least one subfragment per node
     assert(subfragments_per_node > 0)
 
     # How many coded subfragments (=symbols) will be required to reconstruct the encoded data. 
-    symbols = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
+    symbols = (fragment_count - max_erasures) * subfragments_per_node
     # The size of one coded subfragment (total size/number of symbols, rounded up)
     symbol_size = math.ceil(len(file_data)/symbols)
-    # Kodo RLNC encoder using 2^8 finite field
-    field = kodo.FiniteField.binary8
-    encoder = kodo.block.Encoder(field)
-    encoder.configure(symbols, symbol_size)
-    encoder.set_symbols_storage(file_data)
-    # Preallocate array for a coded symbol (avoid allocation in a loop)
-    symbol = bytearray(encoder.symbol_bytes)
-
-    # Random coefficient generator 
-    generator = kodo.block.generator.RandomUniform(field)
-    generator.configure(encoder.symbols)
-    # Preallocate array for coefficients (avoid allocation in a loop)
-    coefficients = bytearray(generator.max_coefficients_bytes)
+    codec = get_codec()
 
     # Store the generated fragment names
     fragment_names = []
+    messages = []
 
     # Generate several coded subfragments for each Storage Node
-    for i in range(STORAGE_NODES_NUM):
+    for i in range(fragment_count):
 
         # Generate a random name for them and save
         name = random_string(8)
@@ -62,24 +61,31 @@ def store_file(file_data, max_erasures, subfragments_per_node,
         # fragment name and all subfragments.
         frames = [] 
 
-        # First frame: a Protobuf STORE DATA message
+        # First frame: the header, second frame: a Protobuf STORE DATA message
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+        frames.append(header.SerializeToString())
+
         task = messages_pb2.storedata_request()
         task.filename = name
         frames.append(task.SerializeToString())
 
-        for j in range(subfragments_per_node):
-            # Generate a fresh set of coefficients
-            generator.generate(coefficients)
-            # Generate a coded symbol with these coefficients 
-            encoder.encode_symbol(symbol, coefficients)
-            # Add to the message frames
-            frames.append(coefficients + bytearray(symbol))
-
-        # Send all frames as a multipart message
-        send_task_socket.send_multipart(frames)
- 
+        # Generate a fresh set of coefficients for each subfragment
+        coefficient_vectors = [codec.random_coefficients(symbols)
+                               for j in range(subfragments_per_node)]
+        # Generate the coded symbols with these coefficients in one pass,
+        # each one written into a single buffer behind its coefficients
+        frames.extend(codec.encode(file_data, coefficient_vectors, symbols, symbol_size,
+                                   with_coefficients=True))
+
+        messages.append(frames)
+
+    # Send the fragments back to back, so each one is stored on a different node
+    # (see TaggedSocket.send_batch), without copying the subfragments
+    send_task_socket.send_batch(messages, copy=False)
+
     # Wait until we receive a response for every message
-    for task_nbr in range(STORAGE_NODES_NUM):
+    for task_nbr in range(fragment_count):
         resp = response_socket.recv_string()
         print('Received: %s' % resp)
 
@@ -90,7 +96,7 @@ def store_file(file_data, max_erasures, subfragments_per_node,
 def __decode_file(symbols):
     """
     Decode a file using RLNC decoder and the provided coded symbols.
-    The number of symbols must be the same as (STORAGE_NODES_NUM - max_erasures) *
+    The number of symbols must be the same as (number of coded fragments - max_erasures) *
     subfragments_per_node. 
     The implementation is almost identical to the Reed-Solomon equivalent function.
 
@@ -101,26 +107,19 @@ def __decode_file(symbols):
     # Reconstruct the original data with a decoder
     symbols_num = len(symbols)
     symbol_size = len(symbols[0]['data']) - symbols_num #subtract the coefficients' size
-    decoder = kodo.block.Decoder(kodo.FiniteField.binary8)
-    decoder.configure(symbols_num, symbol_size)
-    data_out = bytearray(decoder.block_bytes)
-    decoder.set_symbols_storage(data_out)
-
-    for symbol in symbols:
-        # Separate the coefficients from the symbol data 
-        # (we know they are in the front and there are 'symbols_num' of them)
-        coefficients = symbol['data'][:symbols_num]
-        symbol_data = symbol['data'][symbols_num:]
-        # Feed it to the decoder
-        decoder.decode_symbol(symbol_data, coefficients)
-        print(f"Decoder rank: {decoder.rank}")
-    
+
+    # Separate the coefficients from the symbol data 
+    # (we know they are in the front and there are 'symbols_num' of them)
+    coefficients = [symbol['data'][:symbols_num] for symbol in symbols]
+    symbol_data = [symbol['data'][symbols_num:] for symbol in symbols]
+    data_out, rank = get_codec().decode(coefficients, symbol_data, symbols_num, symbol_size)
+    print(f"Decoder rank: {rank}")
     
     # Check that the decoder successfully reconstructed the file
-    if(decoder.is_complete()):
+    if rank == symbols_num:
         print("File decoded successfully")
     else:
-        print(f"Decoding file failed! Decoder rank {decoder.rank} after {len(symbols)} symbols")
+        print(f"Decoding file failed! Decoder rank {rank} after {len(symbols)} symbols")
         # In a real system we might add more complex error handling
 
     return data_out
@@ -131,7 +130,8 @@ def recode(symbols, symbol_count, output_symbol_count):
     """
     Recode a file using an RLNC recoder and the provided coded symbols.
     The symbols are fed into the recoder where output_symbol_count symbols are created
-    by generating new linear combinations.
+    by generating new linear combinations. The recoding is done by the configured
+    codec backend (see erasure_codes/codec.py).
     Examples of different techiques to recode using Kodo can be found here:
     https://github.com/steinwurf/kodo-python/blob/master/examples/pure_recode_symbol_api.py
     https://github.com/steinwurf/kodo-python/blob/master/examples/pure_recode_payload_api.py
@@ -143,86 +143,114 @@ def recode(symbols, symbol_count, output_symbol_count):
     :return: the recoded symbols
     """
 
-    symbol_size = len(symbols[0]) - symbol_count #subtract the coefficients' size
-    field = kodo.FiniteField.binary8
-    # Set up the recoder
-    recoder = kodo.block.Decoder(field)
-    recoder.configure(symbol_count, symbol_size)
-    recoder_internal_storage = bytearray(recoder.block_bytes)
-    recoder.set_symbols_storage(recoder_internal_storage)
-
-    # Random coefficient generator, will be used for the recoded symbols
-    generator = kodo.block.generator.RandomUniform(field)
-    generator.configure(symbol_count)
-
-    # Allocate buffers for where the recoded symbols (coeffs and data) will be produced
-    # Recoding requires 2 coefficient buffers
-    recoding_coefficients = bytearray(generator.max_coefficients_bytes)
-    coefficients_out = bytearray(generator.max_coefficients_bytes)
-    recoded_symbol = bytearray(symbol_size)
-
-    # Feed the provided symbols to the Recoder
-    for symbol in symbols:
-        # Separate the coefficients from the symbol data
-        coefficients = symbol[:symbol_count]
-        symbol_data = symbol[symbol_count:]
-        # Feed it to the recoder
-        recoder.decode_symbol(symbol_data, coefficients)
-
-    # Generate new recoded symbols
-    output_symbols = []
-    for i in range(output_symbol_count):
-        # Generate fresh recoding multipliers
-        generator.generate_recode(recoding_coefficients, recoder)
-        # Perform recoding, capture the final coefficients that produced the recoded symbol
-        recoder.recode_symbol(recoded_symbol, coefficients_out, recoding_coefficients)
-        # Save the new recoded symbol and its coeffs to output_symbols
-        output_symbols.append(coefficients_out + recoded_symbol)
-    #
+    return get_codec().recode(symbols, symbol_count, output_symbol_count)
+#
+
+
+def recode_stream(symbols, output_symbol_count, chunk_size=RECODE_CHUNK_SIZE):
+    """
+    Recode stored symbols into new random linear combinations, like recode, but chunk by
+    chunk: the same recoding coefficients are applied to 'chunk_size' bytes of every
+    symbol at a time. With memory-mapped symbols only a chunk of each is read at once,
+    so large fragments are never fully loaded into memory.
+
+    :param symbols: coded symbols that contain both the coefficients and symbol data
+    :param output_symbol_count: number of symbols to create
+    :param chunk_size: number of bytes of each symbol that are combined at once
+    :return: the recoded symbols
+    """
+
+    codec = get_codec()
+    recoding_coefficients = [codec.random_coefficients(len(symbols))
+                             for _ in range(output_symbol_count)]
+
+    symbol_size = len(symbols[0])
+    output_symbols = [bytearray(symbol_size) for _ in range(output_symbol_count)]
+    for start in range(0, symbol_size, chunk_size):
+        chunks = [symbol[start:start + chunk_size] for symbol in symbols]
+        for output_symbol, combined in zip(output_symbols,
+                                           codec.combine(recoding_coefficients, chunks)):
+            output_symbol[start:start + len(combined)] = combined
 
     return output_symbols
 #
 
 
 def get_file(coded_fragments, max_erasures, file_size,
-             data_req_socket, response_socket):
+             data_req_socket, response_socket, spares=READ_SPARES):
     """
     Implements retrieving a file that is stored with RLNC erasure coding. Only works
     if there are no missing fragments.
-    The implementation is similar to the Reed-Solomon equivalent function.
+    The implementation is similar to the Reed-Solomon equivalent function: more
+    fragments than needed are requested, the file is decoded from the first
+    n-max_erasures fragments that arrive, and alternate fragments are requested
+    when no fragment arrives within FRAGMENT_TIMEOUT.
 
     :param coded_fragments: Names of the coded fragments
     :param max_erasures: Max erasures setting that was used when storing the file
     :param file_size: The original data size.
     :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param spares: How many extra fragments to request (None: all of them)
     :return: The decoded file
     """
 
-    # We need fragments from 4-max_erasures nodes to reconstruct the file, select this many
-    # by randomly removing 'max_erasures' elements from the given chunk names.
-    fragnames = copy.deepcopy(coded_fragments)
-    for i in range(max_erasures):
-        fragnames.remove(random.choice(fragnames))
+    # We need fragments from n-max_erasures nodes to reconstruct the file, 
+    # randomly select this many plus the spares from the given chunk names.
+    fragments_needed = len(coded_fragments) - max_erasures
+    if spares is None:
+        spares = max_erasures
+    fragnames = random.sample(coded_fragments, min(fragments_needed + spares, len(coded_fragments)))
 
-    # Request the coded fragments in parallel. Nodes return all their subfragments
-    for name in fragnames:
+    def request_fragment(name):
         task = messages_pb2.getdata_request()
         task.filename = name
-        data_req_socket.send(task.SerializeToString())
 
-    # Receive all chunks and insert them into the symbols array
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.FRAGMENT_DATA_REQ
+
+        data_req_socket.send_multipart([header.SerializeToString(),
+                                        task.SerializeToString()])
+
+    # Request the coded fragments in parallel. Nodes return all their subfragments
+    for name in fragnames:
+        request_fragment(name)
+
+    # Receive the first chunks and insert them into the symbols array, 
+    # ignore responses for fragments that were not requested or arrived already
     symbols = []
-    for _ in range(len(fragnames)):
-        result = response_socket.recv_multipart()
+    received = set()
+    while len(received) < fragments_needed:
+        if not response_socket.poll(FRAGMENT_TIMEOUT):
+            # Deadline missed, request fragments we have not asked for yet instead
+            metrics.increment('fragment_deadline_misses')
+            alternates = [name for name in coded_fragments if name not in fragnames]
+            alternates = alternates[:fragments_needed - len(received)]
+            if not alternates:
+                metrics.increment('read_timeouts')
+                raise TimeoutError("Coded fragments did not arrive within %d ms" % FRAGMENT_TIMEOUT)
+            metrics.increment('degraded_reads')
+            for name in alternates:
+                print(f'Fragment deadline missed, requesting alternate fragment: {name}')
+                fragnames.append(name)
+                request_fragment(name)
+            continue
+
+        # The subfragment data is used from the received buffers without copying
+        result = response_socket.recv_multipart(copy=False)
+        name = result[0].bytes.decode('utf-8')
+        if name not in fragnames or name in received:
+            continue
+        received.add(name)
         for i in range(1, len(result)):
-            symbols.append({"data": bytearray(result[i])})
+            symbols.append({"data": result[i].buffer})
     print("All coded fragments received successfully")
 
-    #Reconstruct the original file data
+    #Reconstruct the original file data, and drop the padding in place
     file_data = __decode_file(symbols)
+    del file_data[file_size:]
 
-    return file_data[:file_size]
+    return file_data
 #
 
 
@@ -242,6 +270,8 @@ def __store_repair_fragments(missing_fragments, partially_missing_fragments,
     '''
 
     number_of_repaired_subfragments = 0
+    # The number of subfragments sent for each fragment
+    subfragments_sent = dict()
 
     # 1. Full missing fragments (arbitrary choice to have this first as all repair packets
     # are functionally equivalent)
@@ -261,12 +291,12 @@ def __store_repair_fragments(missing_fragments, partially_missing_fragments,
             frames.append(bytearray(repair_symbols[i]))
 
         number_of_repaired_subfragments += subfragments_per_node
+        subfragments_sent[fragment["name"]] = subfragments_per_node
         repair_socket.send_multipart(frames)
 
     # Wait until we receive a response for every fragment
-    for task_nbr in range(len(missing_fragments)):
-        resp = repair_response_socket.recv_string()
-        print('Repaired fully missing fragment: %s' % resp)
+    stored = wait_for_acknowledgements([fragment["name"] for fragment in missing_fragments],
+                                       repair_response_socket, FRAGMENT_TIMEOUT)
     # End store fully missing fragments
 
     # 2. Partially missing fragments
@@ -286,164 +316,238 @@ def __store_repair_fragments(missing_fragments, partially_missing_fragments,
             frames.append(bytearray(repair_symbols[i]))
 
         number_of_repaired_subfragments += fragment["subfragments_lost"]
+        subfragments_sent[fragment["name"]] = fragment["subfragments_lost"]
         repair_socket.send_multipart(frames)
 
     # Wait until we receive a response for every fragment
-    for task_nbr in range(len(partially_missing_fragments)):
-        resp = repair_response_socket.recv_string()
-        print('Repaired partially missing fragment: %s' % resp)
+    stored |= wait_for_acknowledgements([fragment["name"] for fragment in partially_missing_fragments],
+                                        repair_response_socket, FRAGMENT_TIMEOUT)
 
-    return number_of_repaired_subfragments
+    # Only the subfragments the storage nodes acknowledged are repaired
+    return sum(subfragments_sent[name] for name in stored)
 #
 
 
-def start_repair_process(files, repair_socket, repair_response_socket):
+def plan_recode(counts, symbol_count, missing):
+    """
+    Plans a bandwidth minimal RLNC repair: how many recoded subfragments to request from
+    each surviving fragment. The repair symbols are recoded from the received symbols, so
+    they can add at most as much rank to a set of fragments as the received symbols of
+    the other fragments carry. For every set of fragments, the received symbols of the
+    fragments outside the set must therefore carry as much rank as the repair symbols must
+    add: the missing rank (symbol_count minus the rank of the set), at most 'missing'.
+    Every fragment is asked for the same number of symbols (at most what it stores), and
+    the smallest number that satisfies the condition for every set is chosen. With more
+    surviving fragments than needed to decode, this is less than what decoding needs.
+
+    :param counts: For each surviving fragment, how many subfragments are stored
+    :param symbol_count: number of symbols needed to decode the file
+    :param missing: number of subfragments to repair
+    :return: For each surviving fragment, how many recoded subfragments to request
+    """
+
+    fragments = list(counts)
+    # How many more symbols are stored than needed to decode
+    surplus = sum(counts.values()) - symbol_count
+
+    def plan(share):
+        requested = {fragment: min(share, counts[fragment]) for fragment in fragments}
+        # With 'outside' the fragments outside a set, the condition is: the symbols requested
+        # from 'outside' are at least min(missing, symbols stored on 'outside' - surplus).
+        # It fails for some set if fewer than 'missing' symbols are requested from 'outside',
+        # and more than 'surplus' symbols of 'outside' are not requested. Find the most
+        # unrequested symbols with fewer than 'missing' requested ones, a 0/1 knapsack
+        # over the fragments, in O(fragments * missing) instead of checking every set.
+        unrequested = [0] * missing # by the number of requested symbols (at most)
+        for fragment in fragments:
+            weight = requested[fragment]
+            value = counts[fragment] - weight
+            for capacity in range(missing - 1, weight - 1, -1):
+                unrequested[capacity] = max(unrequested[capacity],
+                                            unrequested[capacity - weight] + value)
+        if unrequested[missing - 1] > surplus:
+            return None
+        return requested
+
+    # Binary search for the smallest share, requesting everything always satisfies the
+    # condition as long as the fragments can still be decoded
+    low = math.ceil(missing / len(fragments))
+    high = max(counts.values())
+    while low < high:
+        share = (low + high) // 2
+        if plan(share) is None:
+            low = share + 1
+        else:
+            high = share
+    return plan(high) or dict(counts)
+#
+
+
+def start_repair_process(files, repair_socket, repair_dispatcher, expected_counts=None):
     """
     Implements the repair process for RLNC-based erasure coding. It receives a list
-    of files that are to be checked. For each file, it sends queries to the Storage
-    nodes to check how many coded subfragments are stored safely. If it finds a missing
-    subfragment, it determines which Storage node was supposed to store it and repairs it.
-    Based on how many subfragments are missing, it instructs the storage nodes to send over
-    a certain number of recoded subfragments. It then recodes over these creating as many
-    subfragments as were missing, sending the appropriate number to each of the nodes.
+    of files that are to be checked. It compares the inventories of the Storage nodes with
+    the catalogue, and queries the Storage nodes in batches to check how many coded
+    subfragments of the suspicious files are stored safely. The files with missing
+    subfragments are then repaired with repair_file, several at the same time
+    (see repair.repair_files).
 
     :param files: List of files to be checked
     :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_dispatcher: The ResponseDispatcher of the socket the storage nodes respond on
+    :param expected_counts: The expected subfragment count of every fragment in the catalogue
+                            (see repair.check_files)
+    :return: the number of missing subfragments, the number of repaired subfragments
+    """
+
+    # Compare the node inventories with the catalogue, and check the subfragment
+    # counts of the files in the buckets that differ
+    with repair_dispatcher.channel() as channel:
+        nodes, files, fragment_status = check_files(files, STORAGE_NODES_NUM,
+                                                    channel.socket(repair_socket, header_frame=1),
+                                                    channel, expected_counts)
+
+    return repair_files(files, repair_file, nodes, fragment_status, repair_socket, repair_dispatcher)
+#
+
+
+def repair_file(file, nodes, fragment_status, repair_socket, repair_response_socket):
+    """
+    Repairs the missing subfragments of a file stored with RLNC. It determines which
+    Storage node was supposed to store each missing subfragment. Based on how many
+    subfragments are missing, it instructs the storage nodes to send over a certain number
+    of recoded subfragments. It then recodes over these creating as many subfragments as
+    were missing, sending the appropriate number to each of the nodes.
+
+    :param file: The file to repair, as a dictionary (see File.to_dict)
+    :param nodes: The ids of the available storage nodes
+    :param fragment_status: For each coded fragment of the file, the subfragment count on
+                            each node that stores it (see repair.get_fragment_status)
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
     :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
     :return: the number of missing subfragments, the number of repaired subfragments
     """
 
-    total_missing_subfragment_count = 0
-    total_repaired_subfragment_count = 0
-
-    #Check each file for missing fragments to repair
-    for file in files:
-        print("Checking file with id: %s" % file["id"])
-        #We parse the JSON into a python dictionary
-        storage_details = json.loads(file["storage_details"])
-        max_erasures = storage_details["max_erasures"]
-        subfragments_per_node = storage_details["subfragments_per_node"]
-        symbol_count = (STORAGE_NODES_NUM - max_erasures) * subfragments_per_node
-
-        '''
-        Iterate over each node's coded subfragments to check what is missing.
-        Because this is a distributed system where the central Controller has no knowledge
-        of what is stored on each Strorage node, we build several lists and sets to get an
-        accurate picture. Through these lists and sets we determine:
-        - which nodes respond to our queries
-        - which nodes have a partially missing fragment (and how many subfragments are missing)
-        - which nodes have fully lost their fragment
-        This information will be key in determining where and how many repaired subfragments
-        to send later.
-        '''
-        nodes = set() # list of all storage nodes
-        nodes_with_fragment = set() # list of storage nodes with at least partial fragments
-        coded_fragments = storage_details["coded_fragments"] # list of all coded fragments
-        missing_fragments = [] # list of coded fragments that are fully missing
-        partially_missing_fragments = [] # list of coded fragments that are partially missing
-        existing_fragments = [] # list of coded fragments that are at least in part intact
-        missing_subfragment_count = 0
-
-        for fragment in coded_fragments:
-            fragment_found = False 
-
-            task = messages_pb2.fragment_status_request()
-            task.fragment_name = fragment
-            header = messages_pb2.header()
-            header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
-
-            repair_socket.send_multipart([b"all_nodes",
+    print("Checking file with id: %s" % file["id"])
+    storage_details = file["storage_details"]
+    max_erasures = storage_details["max_erasures"]
+    subfragments_per_node = storage_details["subfragments_per_node"]
+    symbol_count = (len(storage_details["coded_fragments"]) - max_erasures) * subfragments_per_node
+
+    '''
+    Iterate over each node's coded subfragments to check what is missing.
+    Because this is a distributed system where the central Controller has no knowledge
+    of what is stored on each Strorage node, we build several lists and sets to get an
+    accurate picture. Through these lists and sets we determine:
+    - which nodes respond to our queries
+    - which nodes have a partially missing fragment (and how many subfragments are missing)
+    - which nodes have fully lost their fragment
+    This information will be key in determining where and how many repaired subfragments
+    to send later.
+    '''
+    nodes_with_fragment = set() # list of storage nodes with at least partial fragments
+    coded_fragments = storage_details["coded_fragments"] # list of all coded fragments
+    missing_fragments = [] # list of coded fragments that are fully missing
+    partially_missing_fragments = [] # list of coded fragments that are partially missing
+    existing_fragments = [] # list of coded fragments that are at least in part intact
+    missing_subfragment_count = 0
+
+    for fragment in coded_fragments:
+        fragment_found = False 
+
+        # The nodes that store at least one subfragment of the fragment
+        for node_id, count in fragment_status[fragment].items():
+            nodes_with_fragment.add(node_id)
+            existing_fragments.append(fragment)
+            fragment_found = True
+
+            # Check for partially missing fragments
+            if count < subfragments_per_node:
+                subfragments_lost = subfragments_per_node - count
+                print("Partial (%s of %s) RLNC fragments lost for %s from node %s"
+                      % (subfragments_lost, subfragments_per_node, fragment, node_id))
+                #Register it as a partial fragment loss
+                partially_missing_fragments.append({"name": fragment,
+                                                    "subfragments_lost": subfragments_lost,
+                                                    "node_id": node_id})
+                missing_subfragment_count += subfragments_lost
+            else:
+                print("Fragment %s OK" % fragment)
+
+        # If neither node responded with a positive message, the fragment is fully missing
+        if fragment_found == False:
+            print("RLNC all parts of fragment %s missing" % fragment)
+            #Register it as a full lost fragment, we cannot yet determine which node had it
+            missing_fragments.append({"name": fragment,
+                                      "node_id": "?"})
+            missing_subfragment_count += subfragments_per_node
+
+    # Perform the actual repair, if necessary
+    if missing_subfragment_count == 0:
+        return 0, 0
+
+    # Check that enough fragments still remain to be able to reconstruct the data
+    if missing_subfragment_count > max_erasures * subfragments_per_node:
+        print("Too many lost fragments: %s. Unable to repair file. " % missing_subfragment_count)
+        return missing_subfragment_count, 0
+
+    # We can now determine which nodes had a full missing fragment by subtracting the two
+    # sets from eachother.
+    nodes_without_fragment = list(set(nodes).difference(nodes_with_fragment))
+    if len(missing_fragments) > len(nodes_without_fragment):
+        print("Not enough available nodes to store %s lost fragments" % len(missing_fragments))
+        return missing_subfragment_count, 0
+
+    # Assign each full missing fragment to a node that has not fragments stored on it
+    for missing_fragment, node in zip(missing_fragments, nodes_without_fragment):
+        missing_fragment["node_id"] = node
+
+    # Request only as many recoded subfragments from each node as the repair needs
+    counts = {fragment: sum(fragment_status[fragment].values()) for fragment in existing_fragments}
+    plan = plan_recode(counts, symbol_count, missing_subfragment_count)
+    print("Requesting %s of %s stored subfragments for the repair"
+          % (sum(plan.values()), sum(counts.values())))
+
+    requests = 0
+    for fragment, output_fragment_count in plan.items():
+        if output_fragment_count == 0:
+            continue
+        task = messages_pb2.recode_fragments_request()
+        task.fragment_name = fragment
+        task.symbol_count = symbol_count
+        task.output_fragment_count = output_fragment_count
+
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.RECODE_FRAGMENTS_REQ
+
+        for node_id in fragment_status[fragment]:
+            #Use the node_id as the topic
+            repair_socket.send_multipart([node_id.encode('UTF-8'),
                                           header.SerializeToString(),
                                           task.SerializeToString()])
-
-            # Wait until we receive a response from each node
-            for task_nbr in range(STORAGE_NODES_NUM):
-                msg = repair_response_socket.recv()
-                response = messages_pb2.fragment_status_response()
-                response.ParseFromString(msg)
-                
-                nodes.add(response.node_id) # Build a set of nodes
-                if response.is_present == True:
-                    nodes_with_fragment.add(response.node_id)
-                    existing_fragments.append(fragment)
-                    fragment_found = True
-
-                    # Check for partially missing fragments
-                    if response.count < subfragments_per_node:
-                        subfragments_lost = subfragments_per_node - response.count
-                        print("Partial (%s of %s) RLNC fragments lost for %s from node %s"
-                              % (subfragments_lost, subfragments_per_node, fragment, response.node_id))
-                        #Register it as a partial fragment loss
-                        partially_missing_fragments.append({"name": fragment,
-                                                            "subfragments_lost": subfragments_lost,
-                                                            "node_id": response.node_id})
-                        missing_subfragment_count += subfragments_lost
-                    else:
-                        print("Fragment %s OK" % fragment)
-
-            # If neither node responded with a positive message, the fragment is fully missing
-            if fragment_found == False:
-                print("RLNC all parts of fragment %s missing" % fragment)
-                #Register it as a full lost fragment, we cannot yet determine which node had it
-                missing_fragments.append({"name": fragment,
-                                          "node_id": "?"})
-                missing_subfragment_count += subfragments_per_node
-
-        # We can now determine which nodes had a full missing fragment by subtracting the two
-        # sets from eachother.
-        nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
-        assert(len(nodes_without_fragment) == len(missing_fragments))
-
-        # Assign each full missing fragment to a node that has not fragments stored on it
-        i = 0
-        for node in nodes_without_fragment:
-            missing_fragments[i]["node_id"] = node
-            i += 1
-
-
-        # Perform the actual repair, if necessary
-        if missing_subfragment_count > 0:
-            # Check that enough fragments still remain to be able to reconstruct the data
-            if missing_subfragment_count > max_erasures * subfragments_per_node:
-                print("Too many lost fragments: %s. Unable to repair file. " % missing_subfragment_count)
-                continue # Move onto the next file
-
-            #Retrieve sufficient fragments and recode
-            for fragment in coded_fragments:
-                task = messages_pb2.recode_fragments_request()
-                task.fragment_name = fragment
-                task.symbol_count = symbol_count
-                # Request as many fragments as the node originally had stored.
-                # Quite wasteful, surely we can do better
-                task.output_fragment_count = subfragments_per_node
-
-                header = messages_pb2.header()
-                header.request_type = messages_pb2.RECODE_FRAGMENTS_REQ
-                
-                repair_socket.send_multipart([b"all_nodes",
-                                              header.SerializeToString(),
-                                              task.SerializeToString()])
-
-            # Wait until we receive a response from each node that has at least one subfragment
-            recoded_symbols = []
-            for task_nbr in range(len(nodes_with_fragment)):
-                response = repair_response_socket.recv_multipart()
-                for i in range(len(response)):
-                    recoded_symbols.append(bytearray(response[i]))
-
-
-            # Recreate sufficient repair symbols by recoding over the retrieved symbols again
-            repair_symbols = recode(recoded_symbols, symbol_count, missing_subfragment_count)
-            print("Retrieved %s recoded symbols from Storage nodes. Created %s new recoded symbols"
-                  % (len(recoded_symbols), len(repair_symbols)))
-
-            # Send the repair symbols to the storage nodes based on the lists we previously built
-            repaired_subfragment_count = __store_repair_fragments(missing_fragments, partially_missing_fragments,
-                                                                  repair_symbols, subfragments_per_node,
-                                                                  repair_socket, repair_response_socket)
-
-        # Add the per-file counters to the total tally
-        total_missing_subfragment_count += missing_subfragment_count
-        total_repaired_subfragment_count += repaired_subfragment_count
-
-    return total_missing_subfragment_count, total_repaired_subfragment_count
+            requests += 1
+
+    # Wait until we receive a response for every request
+    recoded_symbols = []
+    for task_nbr in range(requests):
+        if not repair_response_socket.poll(FRAGMENT_TIMEOUT):
+            # The planned symbols are all needed, a node failed during the repair
+            print("Recoded symbols did not arrive within %d ms, unable to repair file" % FRAGMENT_TIMEOUT)
+            return missing_subfragment_count, 0
+        response = repair_response_socket.recv_multipart()
+        for i in range(len(response)):
+            recoded_symbols.append(bytearray(response[i]))
+
+    # Recreate sufficient repair symbols by recoding over the retrieved symbols again
+    # in the coding processes
+    repair_symbols = run_coding(recode, recoded_symbols, symbol_count, missing_subfragment_count)
+    print("Retrieved %s recoded symbols from Storage nodes. Created %s new recoded symbols"
+          % (len(recoded_symbols), len(repair_symbols)))
+
+    # Send the repair symbols to the storage nodes based on the lists we previously built
+    repaired_subfragment_count = __store_repair_fragments(missing_fragments, partially_missing_fragments,
+                                                          repair_symbols, subfragments_per_node,
+                                                          repair_socket, repair_response_socket)
+
+    return missing_subfragment_count, repaired_subfragment_count
+#
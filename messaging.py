@@ -0,0 +1,198 @@
+import collections
+import itertools
+import threading
+
+import zmq
+
+from models import messages_pb2
+
+
+class RequestChannel:
+    """
+    The messaging endpoint of a single request. Requests sent through the sockets
+    returned by socket() carry the channel's request id in their header, and the
+    responses of the storage nodes to those requests can be received from the
+    channel, which can be used in place of the shared ZMQ PULL socket.
+    """
+
+    def __init__(self, dispatcher, request_id):
+        self.dispatcher = dispatcher
+        self.request_id = request_id
+        self.__responses = collections.deque()
+        self.__condition = threading.Condition()
+
+    def socket(self, socket, header_frame=0):
+        """
+        :param socket: A ZMQ socket shared by all requests (PUSH or PUB)
+        :param header_frame: Index of the header frame in sent messages, e.g. 1 when
+                             the first frame is a PUB/SUB topic
+        :return: A wrapper of the socket that tags sent requests with the request id
+        """
+        return TaggedSocket(socket, self.dispatcher.send_lock(socket), self.request_id, header_frame)
+
+    def deliver(self, frames):
+        """
+        Called by the dispatcher when a response to this request arrives
+
+        :param frames: The frames of the response as zmq.Frames, without the header frame
+        """
+        with self.__condition:
+            self.__responses.append(frames)
+            self.__condition.notify()
+
+    def poll(self, timeout=None):
+        """
+        Wait until a response is available, like zmq.Socket.poll
+
+        :param timeout: How long to wait in milliseconds (None: forever)
+        :return: zmq.POLLIN if a response can be received, otherwise 0
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__responses,
+                                      None if timeout is None else timeout / 1000)
+            return zmq.POLLIN if self.__responses else 0
+
+    def recv_multipart(self, copy=True):
+        """
+        :param copy: Like in zmq.Socket.recv_multipart: if False, the frames are returned
+                     as zmq.Frames, whose buffers can be used without copying the data
+        :return: The frames of the next response to this request
+        """
+        with self.__condition:
+            while not self.__responses:
+                self.__condition.wait()
+            frames = self.__responses.popleft()
+
+        if copy:
+            return [frame.bytes for frame in frames]
+        return frames
+
+    def recv(self, copy=True):
+        """
+        :return: The first frame of the next response to this request
+        """
+        return self.recv_multipart(copy)[0]
+
+    def recv_string(self, encoding='utf-8'):
+        """
+        :return: The first frame of the next response to this request as a string
+        """
+        return self.recv().decode(encoding)
+
+    def close(self):
+        """
+        Stop receiving responses. Responses that arrive later are dropped.
+        """
+        self.dispatcher.unregister(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+#
+
+
+class TaggedSocket:
+    """
+    Wrapper of a shared ZMQ socket that writes a request id into the header frame
+    (the first frame, unless there is a topic frame before it) of every sent message.
+    ZMQ sockets are not thread safe, so sending is serialized with a lock shared by
+    all wrappers of the same socket.
+    """
+
+    def __init__(self, socket, lock, request_id, header_frame=0):
+        self.__socket = socket
+        self.__lock = lock
+        self.request_id = request_id
+        self.header_frame = header_frame
+
+    def send_multipart(self, frames, **kwargs):
+        self.send_batch([frames], **kwargs)
+
+    def send_batch(self, messages, **kwargs):
+        """
+        Send several messages without messages of other threads in between. A PUSH socket
+        distributes messages round-robin, so the messages of a batch (e.g. the fragments
+        of a file) go to different peers, as long as there are enough peers.
+
+        :param messages: List of messages, each a list of frames
+        """
+        tagged = []
+        for frames in messages:
+            frames = list(frames)
+            header = messages_pb2.header()
+            header.ParseFromString(frames[self.header_frame])
+            header.request_id = self.request_id
+            frames[self.header_frame] = header.SerializeToString()
+            tagged.append(frames)
+
+        with self.__lock:
+            for frames in tagged:
+                self.__socket.send_multipart(frames, **kwargs)
+#
+
+
+class ResponseDispatcher:
+    """
+    Owns the ZMQ PULL socket where the storage nodes respond, and routes every response
+    to the channel of the request it belongs to, based on the request id the storage
+    nodes echo in the header frame. This lets concurrent requests share the sockets
+    without receiving each other's responses.
+    """
+
+    def __init__(self, response_socket):
+        """
+        :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+                                It must not be used by anyone else afterwards.
+        """
+        self.__response_socket = response_socket
+        self.__channels = dict()
+        self.__send_locks = dict()
+        self.__lock = threading.Lock()
+        self.__request_ids = itertools.count(1)
+
+        self.__thread = threading.Thread(target=self.__run, name='response-dispatcher', daemon=True)
+        self.__thread.start()
+
+    def channel(self):
+        """
+        :return: A new RequestChannel with a unique request id
+        """
+        with self.__lock:
+            channel = RequestChannel(self, next(self.__request_ids))
+            self.__channels[channel.request_id] = channel
+        return channel
+
+    def unregister(self, channel):
+        with self.__lock:
+            self.__channels.pop(channel.request_id, None)
+
+    def send_lock(self, socket):
+        """
+        :param socket: A ZMQ socket shared between threads
+        :return: The lock that serializes sending on the socket
+        """
+        with self.__lock:
+            return self.__send_locks.setdefault(socket, threading.Lock())
+
+    def __run(self):
+        while True:
+            try:
+                # Keep the received frames in zmq's buffers, the channels decide
+                # whether they are copied (see RequestChannel.recv_multipart)
+                frames = self.__response_socket.recv_multipart(copy=False)
+            except zmq.ContextTerminated:
+                break
+
+            header = messages_pb2.header()
+            header.ParseFromString(frames[0].bytes)
+
+            with self.__lock:
+                channel = self.__channels.get(header.request_id)
+
+            if channel is None:
+                # The request has already finished (or timed out), drop the late response
+                continue
+            channel.deliver(frames[1:])
+#
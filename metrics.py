@@ -0,0 +1,29 @@
+import collections
+import threading
+
+# Counters shared by all threads of the process, e.g. {'fragment_deadline_misses': 3}
+__counters = collections.Counter()
+__lock = threading.Lock()
+
+
+def increment(name, value=1):
+    """
+    Increment the counter with the given name
+
+    :param name: Name of the counter
+    :param value: How much to add to the counter
+    """
+    with __lock:
+        __counters[name] += value
+#
+
+
+def snapshot():
+    """
+    Returns the current value of every counter
+
+    :return: A dictionary with the counter names and values
+    """
+    with __lock:
+        return dict(__counters)
+#
@@ -3,14 +3,43 @@ from mongoengine import *
 from utils import mongo_to_dict_helper
 
 
+class StorageDetails(EmbeddedDocument):
+    """
+    Where and how the contents of a file are stored. Which fields are set depends on the storage mode.
+    """
+    # Names of the coded fragments (not striped storage modes)
+    coded_fragments = ListField(StringField())
+    # Names of the coded fragments of each stripe (striped storage modes)
+    stripes = ListField(ListField(StringField()))
+    stripe_size = IntField()
+    max_erasures = IntField()
+    # Number of coded fragments (n) and of fragments needed to decode (k = n - max_erasures)
+    # of a file or a stripe. Not set for files stored by earlier versions, which used
+    # the fixed coefficients of 4 storage nodes (see reedsolomon.coefficient_vectors).
+    n = IntField()
+    k = IntField()
+    subfragments_per_node = IntField()
+    meta = {'strict': False}
+
+    def to_dict(self):
+        return mongo_to_dict_helper(self)
+
+
 class File(Document):
     fileName = StringField(required=True)
     size = IntField(required=True)
     content_type = StringField()
     storage_mode = StringField()
-    storage_details = StringField()
-    created = DateField()
-    meta = {'collection': 'files'}
+    storage_details = EmbeddedDocumentField(StorageDetails)
+    # SHA-256 of the file contents (hex)
+    content_hash = StringField()
+    # When the file was stored (UTC)
+    created = DateTimeField()
+    # Repair jobs select files by storage mode, listings page by id (indexed by default)
+    meta = {
+        'collection': 'files',
+        'indexes': ['storage_mode', '-created', 'content_hash']
+    }
 
     def to_dict(self):
         return mongo_to_dict_helper(self)
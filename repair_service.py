@@ -0,0 +1,317 @@
+import concurrent.futures
+import heapq
+import json
+import math
+import os
+import threading
+import time
+
+import mongoengine
+
+import metrics
+from erasure_codes import reedsolomon, repair, rlnc
+from repositories import file_repository
+from storage.fragment_index import inventory_bucket
+
+# The repair function of each storage mode that can be repaired
+REPAIRERS = {
+    'erasure_coding_rs': reedsolomon.repair_file,
+    'erasure_coding_rs_systematic': reedsolomon.repair_file,
+    'erasure_coding_rs_striped': reedsolomon.repair_file_striped,
+    'erasure_coding_rlnc': rlnc.repair_file,
+}
+
+# How many files are read from the catalogue per scan step
+SCAN_PAGE_SIZE = 1000
+
+
+def expected_fragment_counts():
+    """
+    Returns the expected subfragment count of every fragment in the catalogue, which
+    the repair processes compare with the inventories of the storage nodes
+    """
+    expected_counts = dict()
+    for file in file_repository.find_files(fields=['storage_mode', 'storage_details']):
+        expected_counts.update(repair.fragment_counts(file))
+    return expected_counts
+#
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter. Tokens are added at 'rate' per second, up to
+    'burst' tokens. Taking more tokens than are available blocks until they are refilled.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: How many tokens are added per second
+        :param burst: Maximum number of tokens in the bucket
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def take(self, amount):
+        """
+        Take tokens from the bucket, waiting until enough are available. Requests larger
+        than the bucket leave it in debt, so they are paid for by the requests after them.
+
+        :param amount: Number of tokens to take
+        :return: How long the caller had to wait in seconds
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.__updated) * self.rate, self.burst)
+            self.__updated = now
+            wait = max(min(amount, self.burst) - self.tokens, 0) / self.rate
+            self.tokens -= amount
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+#
+
+
+class RepairService(threading.Thread):
+    """
+    Background thread that keeps the stored files repaired. Each cycle it compares the
+    inventories of the storage nodes with the catalogue (see repair.find_damaged_buckets),
+    and pages through the catalogue checking the fragments of the suspicious files.
+    Damaged files are queued by their remaining redundancy, so the files closest to being
+    lost are repaired first. Up to 'max_in_flight' files are repaired at the same time,
+    each through its own channel of the repair dispatcher. Repair traffic is limited by a bandwidth and an IOPS budget,
+    so it does not starve the foreground reads.
+    The scan position and the queue are checkpointed to a JSON file after every step,
+    so a restarted service resumes where it stopped.
+    """
+
+    def __init__(self, repair_socket, repair_dispatcher, node_count, checkpoint_path,
+                 bandwidth, iops, interval, max_in_flight=repair.REPAIRS_IN_FLIGHT):
+        """
+        :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+        :param repair_dispatcher: The ResponseDispatcher of the repair response socket
+        :param node_count: Number of storage nodes
+        :param checkpoint_path: Path of the JSON file the progress is saved to
+        :param bandwidth: Repair bandwidth budget in bytes per second
+        :param iops: Repair budget in fragment reads and writes per second
+        :param interval: Seconds between the end of a cycle and the start of the next one
+        :param max_in_flight: Maximum number of files repaired at the same time
+        """
+        super().__init__(name='repair-service', daemon=True)
+        self.repair_socket = repair_socket
+        self.repair_dispatcher = repair_dispatcher
+        self.node_count = node_count
+        self.checkpoint_path = checkpoint_path
+        self.interval = interval
+        # Allow bursts of one second worth of traffic
+        self.bandwidth = TokenBucket(bandwidth, bandwidth)
+        self.iops = TokenBucket(iops, iops)
+
+        # Id of the last file scanned in the current cycle, '' at the start of a cycle,
+        # None between cycles
+        self.scan_after = None
+        # Heap of [remaining redundancy, file id]
+        self.queue = []
+        # File id -> remaining redundancy of the files being repaired
+        self.repairing = dict()
+        self.max_in_flight = max_in_flight
+        self.__in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_in_flight,
+                                                                thread_name_prefix='repair')
+        self.last_cycle = None
+        self.__damaged_buckets = None
+        self.__lock = threading.Lock()
+        self.__checkpoint_lock = threading.Lock()
+        self.__stopped = threading.Event()
+
+    def run(self):
+        self.__load_checkpoint()
+        while not self.__stopped.is_set():
+            try:
+                if self.scan_after is not None:
+                    self.__scan_page()
+                elif self.queue:
+                    # Start the next repair when one of the repairs in flight is done
+                    self.__in_flight.acquire()
+                    self.__start_next_repair()
+                else:
+                    self.__wait_for_repairs()
+                    # Checkpoint the end of the cycle, so a restart waits for the next one
+                    self.__save_checkpoint()
+                    self.last_cycle = time.time()
+                    if self.__stopped.wait(self.interval):
+                        break
+                    self.scan_after = ''
+            except TimeoutError as e:
+                print("Repair service: storage nodes did not respond: %s" % e)
+                metrics.increment('repair_service_timeouts')
+                self.__stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Stop the service after the current step
+        """
+        self.__stopped.set()
+
+    def status(self):
+        """
+        :return: The progress of the service and the files waiting for repair
+        """
+        with self.__lock:
+            queue = sorted(self.queue)
+            repairing = dict(self.repairing)
+        return {
+            'scanning': self.scan_after is not None,
+            'scan_after': self.scan_after or None,
+            'last_cycle': self.last_cycle,
+            'queued_files': len(queue),
+            'repairing': repairing,
+            'queue': [{'id': file_id, 'remaining_redundancy': redundancy}
+                      for redundancy, file_id in queue[:100]]
+        }
+
+    def __scan_page(self):
+        """
+        Check the next page of the catalogue, and queue the damaged files
+        """
+        if self.__damaged_buckets is None:
+            with self.repair_dispatcher.channel() as channel:
+                _, self.__damaged_buckets = repair.find_damaged_buckets(
+                    expected_fragment_counts(), self.node_count,
+                    channel.socket(self.repair_socket, header_frame=1), channel)
+
+        files = list(file_repository.find_files(after=self.scan_after,
+                                                fields=['size', 'storage_mode', 'storage_details'],
+                                                limit=SCAN_PAGE_SIZE))
+        if not files:
+            print("Repair service: scan finished, %d files queued" % len(self.queue))
+            self.scan_after = None
+            self.__damaged_buckets = None
+            self.__save_checkpoint()
+            return
+
+        suspects = [file for file in files
+                    if file['storage_mode'] in REPAIRERS and
+                    any(inventory_bucket(name) in self.__damaged_buckets
+                        for name in repair.fragment_counts(file))]
+        if suspects:
+            with self.repair_dispatcher.channel() as channel:
+                _, fragment_status = repair.get_fragment_status(
+                    [name for file in suspects for name in repair.fragment_counts(file)],
+                    self.node_count, channel.socket(self.repair_socket, header_frame=1), channel)
+
+            with self.__lock:
+                queued = set(file_id for _, file_id in self.queue)
+                for file in suspects:
+                    if file['id'] in queued or not repair.missing_subfragments(file, fragment_status):
+                        continue
+                    redundancy = repair.remaining_redundancy(file, fragment_status)
+                    if redundancy < 0:
+                        # Too many fragments are lost to decode the file
+                        print("Repair service: file %s can no longer be repaired" % file['id'])
+                        metrics.increment('repair_service_files_lost')
+                        continue
+                    heapq.heappush(self.queue, [redundancy, file['id']])
+                    metrics.increment('repair_service_files_queued')
+
+        metrics.increment('repair_service_files_scanned', len(files))
+        self.scan_after = files[-1]['id']
+        self.__save_checkpoint()
+
+    def __start_next_repair(self):
+        """
+        Start repairing the queued file with the lowest remaining redundancy.
+        The caller holds a slot of the in-flight limit, which the repair releases.
+        """
+        with self.__lock:
+            redundancy, file_id = heapq.heappop(self.queue)
+            self.repairing[file_id] = redundancy
+        self.__executor.submit(self.__repair, file_id, redundancy)
+
+    def __repair(self, file_id, redundancy):
+        try:
+            file = file_repository.get_file(file_id).to_dict()
+            repair_file = REPAIRERS[file['storage_mode']]
+            with self.repair_dispatcher.channel() as channel:
+                sockets = (channel.socket(self.repair_socket, header_frame=1), channel)
+                # The status may have changed since the file was queued
+                nodes, fragment_status = repair.get_fragment_status(
+                    repair.fragment_counts(file), self.node_count, *sockets)
+
+                # Reading k fragments and writing the missing ones, of every damaged stripe
+                operations = 0
+                traffic = 0
+                for stripe in repair.stripe_files(file):
+                    storage_details = stripe['storage_details']
+                    subfragments_per_node = storage_details.get('subfragments_per_node') or 1
+                    symbols = len(storage_details['coded_fragments']) - storage_details['max_erasures']
+                    missing = math.ceil(repair.missing_subfragments(stripe, fragment_status) / subfragments_per_node)
+                    if missing:
+                        operations += symbols + missing
+                        traffic += stripe['size'] * (symbols + missing) / symbols
+                waited = self.iops.take(operations)
+                waited += self.bandwidth.take(traffic)
+                metrics.increment('repair_service_throttled_ms', int(waited * 1000))
+
+                print("Repair service: repairing file %s (remaining redundancy %s)" % (file_id, redundancy))
+                fragments_missing, fragments_repaired = repair_file(
+                    file, nodes, fragment_status, *sockets)
+
+            metrics.increment('repair_service_files_repaired')
+            metrics.increment('repair_service_fragments_missing', fragments_missing)
+            metrics.increment('repair_service_fragments_repaired', fragments_repaired)
+        except mongoengine.DoesNotExist:
+            # Deleted since it was queued
+            pass
+        except TimeoutError as e:
+            # The file is checked again in the next cycle
+            print("Repair service: storage nodes did not respond: %s" % e)
+            metrics.increment('repair_service_timeouts')
+        except Exception as e:
+            print("Repair service: repair of file %s failed: %s" % (file_id, e))
+            metrics.increment('repair_service_failures')
+        finally:
+            with self.__lock:
+                del self.repairing[file_id]
+            self.__in_flight.release()
+            self.__save_checkpoint()
+
+    def __wait_for_repairs(self):
+        """
+        Wait until all repairs in flight are done
+        """
+        for _ in range(self.max_in_flight):
+            self.__in_flight.acquire()
+        for _ in range(self.max_in_flight):
+            self.__in_flight.release()
+
+    def __load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.scan_after = checkpoint['scan_after']
+        self.queue = checkpoint['queue']
+        heapq.heapify(self.queue)
+        print("Repair service: resuming with %d queued files" % len(self.queue))
+
+    def __save_checkpoint(self):
+        """
+        Write the checkpoint to a temporary file and rename it, so a crash never leaves
+        a partially written checkpoint behind
+        """
+        # The repairs save checkpoints concurrently, the last snapshot must be written last
+        with self.__checkpoint_lock:
+            with self.__lock:
+                # Repairs in flight are saved as queued, so they are redone after a restart
+                checkpoint = {'scan_after': self.scan_after,
+                              'queue': list(self.queue) + [[redundancy, file_id] for file_id, redundancy
+                                                           in self.repairing.items()]}
+            temp_path = self.checkpoint_path + '.tmp'
+            with open(temp_path, 'w') as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file)
+            os.replace(temp_path, self.checkpoint_path)
+#
@@ -1,21 +1,67 @@
 import datetime
+import json
 
 from mongoengine import connect
 import bson
 
+from caching import TTLCache
 from models.file import File
 
 connectionString = "mongodb://127.0.0.1:27017/files"
 connect(host=connectionString)
 
+# Read-through cache of File documents by id, so downloads don't need a database
+# round trip for every request. Writes through this module invalidate the cache.
+METADATA_CACHE_SIZE = 10000
+METADATA_CACHE_TTL = 60 # seconds
+__metadata_cache = TTLCache('metadata_cache', METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+# The storage modes repaired by the Reed Solomon repair process
+RS_STORAGE_MODES = ['erasure_coding_rs', 'erasure_coding_rs_systematic', 'erasure_coding_rs_striped']
+
 
 def get_files():
     files =  File.objects
     return list(files)
 
 
+def find_files(after=None, fields=None, limit=None):
+    """
+    Query the files ordered by id, for paging through the catalogue. The files are read
+    straight from the database cursor as plain dictionaries, without loading File documents.
+
+    :param after: Only return files with a greater id, e.g. the last id of the previous page
+    :param fields: Names of the fields to return (default: all of them)
+    :param limit: Maximum number of files to return (default: no limit)
+    :return: A generator of dictionaries, with the file id as a string under 'id'
+    """
+    files = File.objects
+    if after:
+        files = files(id__gt=bson.objectid.ObjectId(after))
+    files = files.order_by('id')
+    if fields:
+        files = files.only(*fields)
+    if limit:
+        files = files.limit(limit)
+
+    for record in files.as_pymongo():
+        yield __record_to_dict(record)
+
+
+def __record_to_dict(record):
+    """
+    Convert a raw files collection record to a JSON serializable dictionary
+    """
+    file = {'id': str(record.pop('_id'))}
+    for field_name, value in record.items():
+        if isinstance(value, datetime.date):
+            value = value.isoformat()
+        file[field_name] = value
+    return file
+
+
 def get_rs_files():
-    files = File.objects(storage_mode__exact='erasure_coding_rs')
+    files = File.objects(storage_mode__in=RS_STORAGE_MODES)
     return list(files)
 
 
@@ -24,21 +70,119 @@ def get_rlnc_files():
     return list(files)
 
 
+def get_files_by_content_hash(content_hash: str):
+    files = File.objects(content_hash=content_hash)
+    return list(files)
+
+
 def get_file(id: str):
-    file = File.objects.get(id=bson.objectid.ObjectId(id))
+    file = __metadata_cache.get(id)
+    if file is None:
+        # Not cached if the file is changed or deleted while it is loaded
+        generation = __metadata_cache.generation()
+        file = File.objects.get(id=bson.objectid.ObjectId(id))
+        __metadata_cache.put(id, file, generation)
     return file
 
 
 def add_file(file: File):
-    return file.save()
+    file = file.save()
+    __metadata_cache.invalidate(str(file.id))
+    return file
 
 
 def remove_file_by_id(id: str):
     file = get_file(id)
-    return file.delete()
+    return remove_file(file)
 
 
 def remove_file(file: File):
-    return file.delete()
-
-
+    result = file.delete()
+    __metadata_cache.invalidate(str(file.id))
+    return result
+
+
+def migrate_storage_details():
+    """
+    Convert the storage details of files stored before they became an embedded
+    document from JSON strings to documents. Uses the raw collection, because
+    these records can't be loaded with the current File model.
+
+    :return: The number of migrated files
+    """
+    collection = File._get_collection()
+    migrated = 0
+    for record in collection.find({'storage_details': {'$type': 'string'}},
+                                  {'storage_details': 1}):
+        collection.update_one({'_id': record['_id']},
+                              {'$set': {'storage_details': json.loads(record['storage_details'])}})
+        migrated += 1
+    return migrated
+
+
+def migrate_created():
+    """
+    Files stored while 'created' was a date only have the day they were stored, which
+    leaves their order within a day undefined. Their creation time is restored from the
+    file id, which contains the time the file was stored (in seconds).
+
+    :return: The number of migrated files
+    """
+    collection = File._get_collection()
+    midnight = {'$and': [{'$eq': [{'$' + unit: '$created'}, 0]}
+                         for unit in ['hour', 'minute', 'second', 'millisecond']]}
+    migrated = 0
+    for record in collection.find({'$or': [{'created': None}, {'$expr': midnight}]}, {'_id': 1}):
+        collection.update_one({'_id': record['_id']},
+                              {'$set': {'created': record['_id'].generation_time.replace(tzinfo=None)}})
+        migrated += 1
+    return migrated
+
+
+def ensure_indexes():
+    """
+    Create the indexes declared in the File model if they don't exist yet
+    """
+    File.ensure_indexes()
+
+
+def explain_queries():
+    """
+    Report the query plans MongoDB chooses for the queries of this repository,
+    to check that they are backed by indexes.
+
+    :return: For each query: the stages of the winning plan, the indexes it uses,
+             and whether it avoids a full collection scan
+    """
+    queries = {
+        'get_rs_files': File.objects(storage_mode__in=RS_STORAGE_MODES),
+        'get_rlnc_files': File.objects(storage_mode__exact='erasure_coding_rlnc'),
+        'get_files_by_content_hash': File.objects(content_hash=''),
+        'find_files': File.objects(id__gt=bson.objectid.ObjectId('0' * 24)).order_by('id'),
+        'recent_files': File.objects.order_by('-created'),
+    }
+
+    plans = dict()
+    for name, query in queries.items():
+        stages = []
+        indexes = []
+        plan = query.explain()['queryPlanner']['winningPlan']
+        # With the slot based execution engine the plan is nested in 'queryPlan'
+        plan = plan.get('queryPlan', plan)
+        # Walk the plan from the root stage to the leaves
+        pending = [plan]
+        while pending:
+            stage = pending.pop()
+            stages.append(stage.get('stage'))
+            if 'indexName' in stage:
+                indexes.append(stage['indexName'])
+            pending += stage.get('inputStages', [])
+            if 'inputStage' in stage:
+                pending.append(stage['inputStage'])
+
+        plans[name] = {
+            'stages': stages,
+            'indexes': indexes,
+            'index_backed': 'COLLSCAN' not in stages
+        }
+    return plans
@@ -1,52 +1,171 @@
 import csv
+import datetime
+import hashlib
 import json
 from random import randint
 
+import bson
 import zmq
 import time
 import io
 import logging
-
-from flask import Flask, make_response, g, request, send_file
-from erasure_codes import  reedsolomon
+import threading
+
+from flask import Flask, Response, make_response, g, request, send_file
+from werkzeug.http import parse_options_header
+from erasure_codes import  reedsolomon, repair, rlnc
+import metrics
+from caching import ByteLRUCache
+from messaging import ResponseDispatcher
 from models import messages_pb2
-from models.file import File
+from models.file import File, StorageDetails
+from repair_service import RepairService, expected_fragment_counts
 from repositories import file_repository
-from utils import is_raspberry_pi
-
-STORAGE_NODES_NO = 4
-
-# Initiate ZMQ sockets
-context = zmq.Context()
+from utils import HashingReader, MultipartReader, is_raspberry_pi, STORAGE_NODES_NUM
 
-# Socket to send tasks to storage nodes
-send_task_socket = context.socket(zmq.PUSH)
-send_task_socket.bind("tcp://*:5555")
+STORAGE_NODES_NO = STORAGE_NODES_NUM
 
-# Socket to receive messages from Storage Nodes
-response_socket = context.socket(zmq.PULL)
-response_socket.bind("tcp://*:5556")
+# Decoded files are cached in memory, bounded by the total size of the cached files.
+# Files larger than FILE_CACHE_MAX_ITEM_BYTES are never cached.
+FILE_CACHE_BYTES = 256 * 1024 * 1024
+FILE_CACHE_MAX_ITEM_BYTES = 8 * 1024 * 1024
 
-# Publisher socket for data request broadcasts
-data_req_socket = context.socket(zmq.PUB)
-data_req_socket.bind("tcp://*:5557")
+# Default and maximum number of files on a page of the file list
+FILES_PAGE_SIZE = 100
+FILES_MAX_PAGE_SIZE = 1000
 
-# Wait for all workers to start and connect.
-time.sleep(1)
+# Budget of the background repair service, so repairs don't starve the foreground reads
+REPAIR_BANDWIDTH = 20 * 1024 * 1024 # bytes per second
+REPAIR_IOPS = 100 # fragment reads and writes per second
+# Seconds between two scans of the catalogue
+REPAIR_INTERVAL = 600
+REPAIR_CHECKPOINT_PATH = 'repair_checkpoint.json'
 
 # Instantiate the Flask app (must be before the endpoint functions)
 app = Flask(__name__)
 
-file_handle = open('results.csv', 'w')
-csv_writer = csv.writer(file_handle)
-fields = ['event', 'file_size', 'storage_mode', 'max_erasures', 'time']
-csv_writer.writerow(fields)
+csv_lock = threading.Lock()
+
+# The coding processes of the repairs import this module, the server is only started
+# when it is run as a script
+if __name__ == '__main__':
+    # Start the coding processes of the repairs before any threads are started
+    repair.start_coding_pool()
+
+    # Initiate ZMQ sockets
+    context = zmq.Context()
+
+    # Socket to send tasks to storage nodes
+    send_task_socket = context.socket(zmq.PUSH)
+    send_task_socket.bind("tcp://*:5555")
+
+    # Socket to receive messages from Storage Nodes
+    response_socket = context.socket(zmq.PULL)
+    response_socket.bind("tcp://*:5556")
+
+    # Publisher socket for data request broadcasts
+    data_req_socket = context.socket(zmq.PUB)
+    data_req_socket.bind("tcp://*:5557")
+
+    # Publisher socket for repair requests, the topic selects the storage nodes
+    repair_socket = context.socket(zmq.PUB)
+    repair_socket.bind("tcp://*:5558")
+
+    # Socket to receive repair results from the storage nodes
+    repair_response_socket = context.socket(zmq.PULL)
+    repair_response_socket.bind("tcp://*:5559")
+
+    # Route the responses of the storage nodes to the requests they belong to,
+    # so concurrent HTTP requests can share the sockets
+    dispatcher = ResponseDispatcher(response_socket)
+    repair_dispatcher = ResponseDispatcher(repair_response_socket)
+
+    # Cache of decoded file contents by file id
+    file_cache = ByteLRUCache('file_cache', FILE_CACHE_BYTES, FILE_CACHE_MAX_ITEM_BYTES)
+
+    # Create the indexes of the files collection
+    file_repository.ensure_indexes()
+
+    # Files stored by earlier versions have their storage details as JSON strings
+    migrated_files = file_repository.migrate_storage_details()
+    if migrated_files:
+        print("Migrated the storage details of %d files" % migrated_files)
+
+    # Files stored by earlier versions only have the day they were created
+    migrated_files = file_repository.migrate_created()
+    if migrated_files:
+        print("Migrated the creation time of %d files" % migrated_files)
+
+    # Wait for all workers to start and connect.
+    time.sleep(1)
+
+    # Keep the stored files repaired in the background
+    repair_service = RepairService(repair_socket, repair_dispatcher, STORAGE_NODES_NO,
+                                   REPAIR_CHECKPOINT_PATH, REPAIR_BANDWIDTH, REPAIR_IOPS,
+                                   REPAIR_INTERVAL)
+    repair_service.start()
+
+    file_handle = open('results.csv', 'w')
+    csv_writer = csv.writer(file_handle)
+    fields = ['event', 'file_size', 'storage_mode', 'max_erasures', 'time']
+    csv_writer.writerow(fields)
+
+
+def write_result(row):
+    """
+    Write a row to the results CSV file (requests are handled concurrently)
+    """
+    with csv_lock:
+        csv_writer.writerow(row)
+
+
+def get_channel():
+    """
+    Returns the messaging channel of the current HTTP request, creating it on first use.
+    Responses from the storage nodes are received through the channel, and requests
+    are sent through the shared sockets wrapped with channel.socket().
+    """
+    if 'channel' not in g:
+        g.channel = dispatcher.channel()
+    return g.channel
+
+
+@app.teardown_request
+def close_channel(exception):
+    channel = g.pop('channel', None)
+    if channel is not None:
+        channel.close()
+
 
 @app.route('/files',  methods=['GET'])
 def list_files():
-    files = file_repository.get_files()
-    files = list(map(lambda f: f.to_dict(), files))
-    return make_response({"files": json.dumps(files)})
+    """
+    List the files one page at a time, ordered by id. Query parameters:
+    - limit: page size (default: FILES_PAGE_SIZE, at most FILES_MAX_PAGE_SIZE)
+    - after: the 'next' value of the previous page
+    - fields: comma separated names of the fields to return (default: all)
+    - format: 'ndjson' streams all files after 'after' as newline delimited JSON instead
+    """
+    after = request.args.get('after')
+    fields = [field for field in request.args.get('fields', '').split(',') if field]
+    unknown_fields = set(fields) - set(File._fields)
+    if unknown_fields:
+        return make_response("Unknown fields: %s" % ', '.join(sorted(unknown_fields)), 400)
+    if after and not bson.objectid.ObjectId.is_valid(after):
+        return make_response("Invalid 'after' file id", 400)
+
+    if request.args.get('format') == 'ndjson':
+        # Stream the rows as they are read from the database cursor
+        files = file_repository.find_files(after, fields)
+        return Response((json.dumps(file) + '\n' for file in files),
+                        mimetype='application/x-ndjson')
+
+    limit = request.args.get('limit', FILES_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, FILES_MAX_PAGE_SIZE))
+    files = list(file_repository.find_files(after, fields, limit))
+    # The cursor of the next page, if there may be one
+    next_page = files[-1]['id'] if len(files) == limit else None
+    return make_response({"files": files, "next": next_page})
 
 
 @app.route('/files/<string:file_id>',  methods=['GET'])
@@ -56,77 +175,245 @@ def download_file(file_id):
 
     print(f"File requested: {file.fileName}")
     
-    # Parse the storage details JSON string
-    storage_details = json.loads(file.storage_details)
-
-    if file.storage_mode == 'erasure_coding_rs':
-        
-        coded_fragments = storage_details['coded_fragments']
-        max_erasures = storage_details['max_erasures']
-
-        file_data = reedsolomon.get_file(
-            coded_fragments,
-            max_erasures,
-            file.size,
-            data_req_socket, 
-            response_socket
-        )
+    storage_details = file.storage_details
+
+    # Only a part of the file is needed if the client sent a Range header. Multiple
+    # ranges and other units than bytes are not supported, the whole file is sent then.
+    file_range = None
+    if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        file_range = request.range.range_for_length(file.size)
+        if file_range is None:
+            return make_response("Requested range not satisfiable", 416,
+                                 {"Content-Range": "bytes */%d" % file.size})
+    start, end = file_range or (0, file.size)
+
+    if file.storage_mode in ['erasure_coding_rs', 'erasure_coding_rs_systematic']:
+        channel = get_channel()
+
+        # Hot files are served from the cache without contacting the storage nodes
+        file_data = file_cache.get(file_id)
+        if file_data is None:
+            coded_fragments = storage_details.coded_fragments
+            max_erasures = storage_details.max_erasures
+
+            file_data = reedsolomon.get_file(
+                coded_fragments,
+                max_erasures,
+                file.size,
+                channel.socket(data_req_socket), 
+                channel,
+                systematic=file.storage_mode == 'erasure_coding_rs_systematic'
+            )
+            file_cache.put(file_id, file_data)
+    elif file.storage_mode == 'erasure_coding_rs_striped':
+        # Decode the file stripe by stripe and send each one as soon as it is ready
+        stripes = stream_file(storage_details, file.size, start, end)
+        if file_range:
+            return partial_response(stripes, start, end, file.size, file.content_type)
+        return Response(stripes, mimetype=file.content_type)
     elif file.storage_mode == 'erasure_coding_rs_random_worker':
         raise NotImplementedError('Need to implement assigning the decode part to worker')
     else:
         raise NotImplementedError('Unsupported storage mode')
 
+    if file_range:
+        return partial_response(bytes(file_data[start:end]), start, end, file.size, file.content_type)
+
     return send_file(io.BytesIO(file_data), mimetype=file.content_type)
 
 
+def stream_file(storage_details, size, start, end):
+    """
+    Generator of the bytes [start, end) of a striped file, decoded stripe by stripe.
+    The request context is torn down when the view returns, before the response body
+    is sent, so the generator receives the fragments through a channel of its own,
+    which is closed when the response is done (or the client disconnects).
+
+    :param storage_details: The storage details of the file
+    :param size: The size of the file
+    :param start: First byte to send
+    :param end: End of the bytes to send (exclusive)
+    """
+    with dispatcher.channel() as channel:
+        yield from reedsolomon.get_file_stream(
+            storage_details.stripes,
+            storage_details.max_erasures,
+            size,
+            storage_details.stripe_size,
+            channel.socket(data_req_socket),
+            channel,
+            start,
+            end
+        )
+
+
+@app.route('/files/<string:file_id>',  methods=['DELETE'])
+def delete_file(file_id):
+
+    file = file_repository.get_file(file_id)
+
+    print(f"File deleted: {file.fileName}")
+
+    storage_details = file.storage_details
+    if file.storage_mode == 'erasure_coding_rs_striped':
+        fragment_names = [name for stripe in storage_details.stripes for name in stripe]
+    else:
+        fragment_names = storage_details.coded_fragments
+
+    # Deletes are broadcast, only the nodes storing a fragment delete it. Nodes don't
+    # respond, a fragment left behind by a node that is down can be removed later.
+    delete_fragments(fragment_names, get_channel().socket(data_req_socket))
+
+    file_repository.remove_file(file)
+    file_cache.invalidate(file_id)
+    return make_response({"id": file_id}, 200)
+
+
+def delete_fragments(fragment_names, data_req_socket):
+    """
+    Ask the storage nodes to delete fragments
+
+    :param fragment_names: The names of the fragments to delete
+    :param data_req_socket: A ZMQ PUB socket to broadcast the requests
+    """
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.DELETE_FRAGMENT_REQ
+
+    for name in fragment_names:
+        task = messages_pb2.deletedata_request()
+        task.filename = name
+        data_req_socket.send_multipart([
+            header.SerializeToString(),
+            task.SerializeToString()
+        ])
+
+
+def partial_response(body, start, end, size, mimetype):
+    """
+    Build a 206 Partial Content response for the byte range [start, end) of a file
+
+    :param body: The requested bytes, or a generator yielding them
+    :param start: First byte of the range
+    :param end: End of the range (exclusive)
+    :param size: The size of the whole file
+    :param mimetype: The content type of the file
+    :return: The Flask response
+    """
+    response = Response(body, status=206, mimetype=mimetype)
+    response.headers['Content-Range'] = "bytes %d-%d/%d" % (start, end - 1, size)
+    response.headers['Content-Length'] = end - start
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
 @app.route('/files_mp', methods=['POST'])
 def add_files_multipart():
     start_time = time.time()
 
-    # Flask separates files from the other form fields
-    payload = request.form
-    files = request.files
-    
-    # Make sure there is a file in the request
-    if not files or not files.get('file'):
-        logging.error("No file was uploaded in the request!")
-        return make_response("File missing!", 400)
-    
-    # Reference to the file under 'file' key
-    file = files.get('file')
-    # The sender encodes a the file name and type together with the file contents
-    filename = file.filename
-    content_type = file.mimetype
-    # Load the file contents into a bytearray and measure its size
-    data = bytearray(file.read())
-    size = len(data)
-    print("File received: %s, size: %d bytes, type: %s" % (filename, size, content_type))
-    
-    # Read the requested storage mode from the form (default value: 'raid1')
+    # The body is parsed from the request stream instead of request.form and request.files,
+    # which would spool the whole upload first
+    if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
+        return make_response("Expected a multipart/form-data upload", 400)
+    upload = MultipartReader(request.stream, request.mimetype_params['boundary'])
+
+    try:
+        # The form fields sent before the file
+        payload, file = upload.read_fields()
+        while file is not None and file.name != 'file':
+            fields, file = upload.read_fields()
+            payload.update(fields)
+
+        # Make sure there is a file in the request
+        if file is None:
+            logging.error("No file was uploaded in the request!")
+            return make_response("File missing!", 400)
+
+        # The sender encodes a the file name and type together with the file contents
+        filename = file.filename
+        content_type = parse_options_header(file.headers.get('Content-Type', ''))[0]
+
+        if payload.get('storage') == 'erasure_coding_rs_striped':
+            # The file is read from the request stream stripe by stripe, and hashed on the way.
+            # The form fields of a striped upload must be sent before the file.
+            data = None
+            size = None
+            content_hash = hashlib.sha256()
+            print("File received: %s, type: %s" % (filename, content_type))
+        else:
+            # Load the file contents into a bytearray and measure its size
+            data = bytearray(upload.read())
+            size = len(data)
+            content_hash = hashlib.sha256(data)
+            print("File received: %s, size: %d bytes, type: %s" % (filename, size, content_type))
+            # The form fields may also follow the file
+            payload.update(upload.read_fields()[0])
+    except ValueError as e:
+        logging.error("Invalid multipart upload: %s" % e)
+        return make_response("Invalid multipart upload", 400)
+
+    # Read the requested storage mode from the form (default value: 'erasure_coding_rs')
     storage_mode = payload.get('storage', 'erasure_coding_rs')
     print("Storage mode: %s" % storage_mode)
 
-    if storage_mode == 'erasure_coding_rs':
-        # Reed Solomon code
-        # Parse max_erasures (everything is a string in request.form, 
-        # we need to convert to int manually), set default value to 1
+    channel = get_channel()
+
+    # Parse max_erasures and the number of coded fragments n (everything is a string in
+    # the form, we need to convert to int manually), set default values to 1 and
+    # one fragment per storage node. The worker always stores one fragment per node.
+    try:
         max_erasures = int(payload.get('max_erasures', 1))
-        
-        # Store the file contents with Reed Solomon erasure coding
-        fragment_names = reedsolomon.store_file(data, max_erasures, send_task_socket, response_socket)
+        fragment_count = STORAGE_NODES_NO
+        if storage_mode != 'erasure_coding_rs_random_worker':
+            fragment_count = int(payload.get('n', STORAGE_NODES_NO))
+    except ValueError:
+        max_erasures = fragment_count = -1
+    if not 0 <= max_erasures < fragment_count <= STORAGE_NODES_NO:
+        return make_response("Invalid n or max_erasures: 0 <= max_erasures < n <= %d" % STORAGE_NODES_NO, 400)
+
+    if storage_mode in ['erasure_coding_rs', 'erasure_coding_rs_systematic']:
+        # Reed Solomon code
+        # Store the file contents with Reed Solomon erasure coding. The systematic
+        # variant stores the plain data in the first fragments, so healthy reads need no decoding
+        fragment_names = reedsolomon.store_file(data, max_erasures, channel.socket(send_task_socket), channel,
+                                                systematic=storage_mode == 'erasure_coding_rs_systematic',
+                                                fragment_count=fragment_count)
+
+        end_time = time.time()
+        total_time = end_time - start_time
+        write_result(['erasure_write', size, storage_mode, max_erasures, total_time])
+
+        storage_details = StorageDetails(
+            coded_fragments=fragment_names,
+            max_erasures=max_erasures
+        )
+    elif storage_mode == 'erasure_coding_rs_striped':
+        # Reed Solomon code applied to fixed-size stripes of the file
+        stripe_size = int(payload.get('stripe_size', reedsolomon.STRIPE_SIZE))
+
+        # Encode and store the file stripe by stripe while it is read from the request
+        stream = upload
+        if data is not None:
+            # The storage mode was sent after the file, which has been loaded already
+            stream = io.BytesIO(data)
+            content_hash = hashlib.sha256()
+        stripes, size = reedsolomon.store_file_stream(HashingReader(stream, content_hash),
+                                                      max_erasures, stripe_size,
+                                                      channel.socket(send_task_socket), channel,
+                                                      fragment_count)
+        print("File stored: %s, size: %d bytes, stripes: %d" % (filename, size, len(stripes)))
 
         end_time = time.time()
         total_time = end_time - start_time
-        csv_writer.writerow(['erasure_write', size, storage_mode, max_erasures, total_time])
+        write_result(['erasure_write', size, storage_mode, max_erasures, total_time])
 
-        storage_details = {
-            "coded_fragments": fragment_names,
-            "max_erasures": max_erasures
-        }
+        storage_details = StorageDetails(
+            stripes=stripes,
+            stripe_size=stripe_size,
+            max_erasures=max_erasures
+        )
     elif storage_mode == 'erasure_coding_rs_random_worker':
         # Make random worker encode and store file on nodes
         # Build task
-        max_erasures = int(payload.get('max_erasures', 1))
         task = messages_pb2.worker_store_file_request()
         task.max_erasures = max_erasures
 
@@ -135,7 +422,7 @@ def add_files_multipart():
         header.request_type = messages_pb2.WORKER_STORE_FILE_REQ
 
         # Send task to random node
-        send_task_socket.send_multipart([
+        channel.socket(send_task_socket).send_multipart([
             header.SerializeToString(),
             task.SerializeToString(),
             data
@@ -143,48 +430,116 @@ def add_files_multipart():
 
         end_time = time.time()
         total_time = end_time - start_time
-        csv_writer.writerow(['erasure_write', size, storage_mode, max_erasures, total_time])
+        write_result(['erasure_write', size, storage_mode, max_erasures, total_time])
 
         # Await response from worker node
-        msg = response_socket.recv_multipart()
+        msg = channel.recv_multipart()
 
         end_time = time.time()
         total_time = end_time - start_time
-        csv_writer.writerow(['erasure_write_worker_response', size, storage_mode, max_erasures, total_time])
+        write_result(['erasure_write_worker_response', size, storage_mode, max_erasures, total_time])
 
         task = messages_pb2.worker_store_file_response()
         task.ParseFromString(msg[0])
 
-        storage_details = {
-            "coded_fragments": list(task.fragments),
-            "max_erasures": max_erasures
-        }
+        storage_details = StorageDetails(
+            coded_fragments=list(task.fragments),
+            max_erasures=max_erasures
+        )
     else:
         logging.error("Unexpected storage mode: %s" % storage_mode)
         return make_response("Wrong storage mode", 400)
 
+    # Record (n, k), which select the coefficients when the file is repaired
+    storage_details.n = fragment_count
+    storage_details.k = fragment_count - max_erasures
+
     # Insert the File record in the DB
 
     file = File(fileName=filename,
                 size=size, content_type=content_type,
                 storage_mode=storage_mode,
-                storage_details=json.dumps(storage_details))
+                storage_details=storage_details,
+                content_hash=content_hash.hexdigest(),
+                created=datetime.datetime.utcnow())
 
     file_repository.add_file(file)
     file = file.to_dict()
 
     end_time = time.time()
     total_time = end_time - start_time
-    csv_writer.writerow(['finished', size, storage_mode, max_erasures, total_time])
+    write_result(['finished', size, storage_mode, max_erasures, total_time])
     return make_response({"id": file['id'] }, 201)
 
 
+@app.route('/services/rs_repair',  methods=['GET'])
+def rs_repair():
+    # Retrieve the list of files stored using Reed Solomon from the database
+    files = [file.to_dict() for file in file_repository.get_rs_files()]
+
+    # With ?mode=chained the storage nodes rebuild the fragments among themselves
+    fragments_missing, fragments_repaired = reedsolomon.start_repair_process(
+        files,
+        repair_socket,
+        repair_dispatcher,
+        expected_fragment_counts(),
+        chained=request.args.get('mode') == 'chained'
+    )
+
+    return make_response({"fragments_missing": fragments_missing,
+                          "fragments_repaired": fragments_repaired})
+
+
+@app.route('/services/rlnc_repair',  methods=['GET'])
+def rlnc_repair():
+    # Retrieve the list of files stored using RLNC from the database
+    files = [file.to_dict() for file in file_repository.get_rlnc_files()]
+
+    fragments_missing, fragments_repaired = rlnc.start_repair_process(
+        files,
+        repair_socket,
+        repair_dispatcher,
+        expected_fragment_counts()
+    )
+
+    return make_response({"fragments_missing": fragments_missing,
+                          "fragments_repaired": fragments_repaired})
+
+
+@app.route('/services/repair_status',  methods=['GET'])
+def get_repair_status():
+    """
+    Reports the progress of the background repair service
+    """
+    return make_response(repair_service.status())
+
+
+@app.route('/admin/query_plans',  methods=['GET'])
+def get_query_plans():
+    """
+    Reports whether the queries of the file repository are backed by indexes
+    """
+    return make_response(file_repository.explain_queries())
+
+
+@app.route('/metrics',  methods=['GET'])
+def get_metrics():
+    return make_response(metrics.snapshot())
+
+
+@app.errorhandler(TimeoutError)
+def timeout_error(e):
+    logging.error("Storage nodes did not respond in time: %s", e)
+    return make_response({"error": str(e)}, 503)
+
+
 @app.errorhandler(500)
 def server_error(e):
     logging.exception("Internal error: %s", e)
     return make_response({"error": str(e)}, 500)
 
-# Start the Flask app (must be after the endpoint functions) 
-host_local_computer = "localhost" # Listen for connections on the local computer
-host_local_network = "0.0.0.0" # Listen for connections on the local network
-app.run(host=host_local_network if is_raspberry_pi() else host_local_computer, port=9000)
+if __name__ == '__main__':
+    # Start the Flask app (must be after the endpoint functions) 
+    host_local_computer = "localhost" # Listen for connections on the local computer
+    host_local_network = "0.0.0.0" # Listen for connections on the local network
+    app.run(host=host_local_network if is_raspberry_pi() else host_local_computer, port=9000, threaded=True)
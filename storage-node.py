@@ -2,22 +2,27 @@
 import time
 import zmq
 import erasure_codes.reedsolomon
-from erasure_codes import reedsolomon
+from erasure_codes import reedsolomon, rlnc
 from models import messages_pb2
 import sys
 import os
 
-from utils import random_string, write_file, is_raspberry_pi
+from storage.file_store import FileStore
+from storage.segment_store import SegmentStore
+from utils import random_string, is_raspberry_pi, STORAGE_NODES_NUM
 
-#region Folder initialization
-MAX_CHUNKS_PER_FILE = 10
+# Ports the storage nodes bind to talk to each other on the local computer:
+# the port of a node is the base port plus the node number
+STORAGE_NODE_PUSH_PORT = 6000
+STORAGE_NODE_RESPONSE_PORT = 7000
 
+#region Folder initialization
 # Read the folder name where chunks should be stored from the first program argument
 # (or use the current folder if none was given)
 node_no = sys.argv[1]
 
-if not (node_no == "0" or node_no == "1" or node_no == "2" or node_no == "3"):
-    raise Exception("Node number needs to be between 1-4")
+if not (node_no.isdigit() and int(node_no) < STORAGE_NODES_NUM):
+    raise Exception("Node number needs to be between 0-%d" % (STORAGE_NODES_NUM - 1))
 
 # Try to create the folder
 try:
@@ -40,6 +45,19 @@ except FileNotFoundError:
     with open(node_no+'/.id', "w") as id_file:
         id_file.write(node_id)
         print("New ID generated and saved to file: %s" % node_id)
+
+# The storage engine can be selected with the second program argument:
+# 'files' stores every subfragment in its own file (default), 'segments' appends them
+# to large log-structured segment files. Both keep an in-memory index of the stored
+# fragments, so requests for fragments stored elsewhere don't touch the disk.
+storage_engine = sys.argv[2] if len(sys.argv) > 2 else 'files'
+if storage_engine == 'files':
+    store = FileStore(node_no)
+elif storage_engine == 'segments':
+    store = SegmentStore(node_no)
+else:
+    raise Exception("Storage engine needs to be 'files' or 'segments'")
+print("Storage engine: %s, fragments found in data folder: %d" % (storage_engine, len(store.names())))
 #endregion
 
 #region ZMQ address initialization
@@ -57,9 +75,11 @@ if is_raspberry_pi():
     lead_pull_address = "tcp://192.168.0." + lead_address + ":5555"
     lead_push_address = "tcp://192.168.0." + lead_address + ":5556"
     lead_subscriber_address = "tcp://192.168.0." + lead_address + ":5557"
+    repair_subscriber_address = "tcp://192.168.0." + lead_address + ":5558"
+    repair_sender_address = "tcp://192.168.0." + lead_address + ":5559"
 
     # Addresses to talk to communicate with other storage nodes
-    for i in range(3):
+    for i in range(STORAGE_NODES_NUM - 1):
         other_storage_node_addresses.append(int(input("Storage Node address: 192.168.0.___ ")))
 
     # Setup addresses to pull and push to other storage nodes
@@ -78,9 +98,11 @@ else:
     lead_pull_address = "tcp://localhost:5555"
     lead_push_address = "tcp://localhost:5556"
     lead_subscriber_address = "tcp://localhost:5557"
+    repair_subscriber_address = "tcp://localhost:5558"
+    repair_sender_address = "tcp://localhost:5559"
 
-    # On local host we instead of reading the address from user input we just set it from 0-4
-    for i in range(4):
+    # On local host we instead of reading the address from user input we just use the node numbers
+    for i in range(STORAGE_NODES_NUM):
         other_storage_node_addresses.append(i)
 
     # We dont want to listen to our own socket
@@ -88,11 +110,11 @@ else:
 
     # Setup addresses to pull and push to other storage nodes
     for address in other_storage_node_addresses:
-        storage_node_pull_addresses[address] = f'tcp://localhost:556{address}'
-        storage_node_response_push_addresses[address] = f'tcp://localhost:557{address}'
+        storage_node_pull_addresses[address] = f'tcp://localhost:{STORAGE_NODE_PUSH_PORT + address}'
+        storage_node_response_push_addresses[address] = f'tcp://localhost:{STORAGE_NODE_RESPONSE_PORT + address}'
 
-    storage_node_push_socket_address = f"tcp://*:556{node_no}"
-    storage_node_response_pull_socket_address = f"tcp://*:557{node_no}"
+    storage_node_push_socket_address = f"tcp://*:{STORAGE_NODE_PUSH_PORT + node_address}"
+    storage_node_response_pull_socket_address = f"tcp://*:{STORAGE_NODE_RESPONSE_PORT + node_address}"
 #endregion
 
 #region ZMQ socket initialization
@@ -115,6 +137,17 @@ lead_subscriber.connect(lead_subscriber_address)
 # Receive every message (empty subscription)
 lead_subscriber.setsockopt(zmq.SUBSCRIBE, b'')
 
+# Socket to receive repair requests from the controller. Requests are sent with
+# a topic: 'all_nodes' for every node, or the node id for this node only
+repair_subscriber = context.socket(zmq.SUB)
+repair_subscriber.connect(repair_subscriber_address)
+repair_subscriber.setsockopt(zmq.SUBSCRIBE, b'all_nodes')
+repair_subscriber.setsockopt(zmq.SUBSCRIBE, node_id.encode('UTF-8'))
+
+# Socket to send repair results to the controller
+repair_sender = context.socket(zmq.PUSH)
+repair_sender.connect(repair_sender_address)
+
 # Create push sockets to send messages to other storage nodes
 storage_node_push_socket = context.socket(zmq.PUSH)
 storage_node_push_socket.bind(storage_node_push_socket_address)
@@ -134,34 +167,160 @@ time.sleep(1)
 #endregion
 
 #region helper methods
+def recv_frames(socket, topic=False):
+    """
+    Receive a multipart message without copying the data frames
+
+    :param socket: The ZMQ socket to receive from
+    :param topic: Whether the message starts with a PUB/SUB topic frame, which is dropped
+    :return: The header and task frames as bytes, followed by the data frames as memoryviews
+    """
+    frames = socket.recv_multipart(copy=False)
+    if topic:
+        frames = frames[1:]
+    return [frame.bytes for frame in frames[:2]] + [frame.buffer for frame in frames[2:]]
+
+
 def handle_store_data_req(msg, response_socket):
     # Parse the Protobuf message from the first frame
     task = messages_pb2.storedata_request()
     task.ParseFromString(msg[1])
 
-    # The data starts with the second frame, iterate and store all frames
-    for i in range(0, len(msg) - 2):
-        data = msg[2 + i]
+    # The data starts with the third frame, store all frames from the received buffers
+    store.put(task.filename, msg[2:])
+
+    # Send response (the request header and the file name)
+    response_socket.send_multipart([msg[0], task.filename.encode('utf-8')])
+
+
+def handle_fragment_data_req(msg, response_socket):
+    task = messages_pb2.getdata_request()
+    task.ParseFromString(msg[1])
+    print("Data chunk request: %s" % task.filename)
+
+    # Requests are broadcast to all nodes, most of them are for fragments
+    # stored elsewhere: check the index before touching the disk
+    if task.filename in store:
+        # Load all subfragments with this name
+        # First frame is the request header, second frame is the filename,
+        # subsequent frames will contain the chunks' data
+        frames = [msg[0], bytes(task.filename, 'utf-8')] + store.get(task.filename)
+
+        # Only send a result if at least one chunk was found. The chunks are
+        # memory-mapped, send them from the mappings without copying
+        if (len(frames) > 2):
+            print("Found chunk %s, sending it back" % task.filename)
+            response_socket.send_multipart(frames, copy=False)
+
+
+def handle_recode_fragments_req(msg, response_socket):
+    task = messages_pb2.recode_fragments_request()
+    task.ParseFromString(msg[1])
+
+    # Only the node storing the fragment responds
+    if task.fragment_name not in store:
+        return
+
+    subfragments = store.get(task.fragment_name)
+    if task.output_fragment_count >= len(subfragments):
+        # Combinations of the stored subfragments carry nothing they don't, send them as they are
+        symbols = subfragments
+    else:
+        # Recode chunk by chunk from the memory-mapped subfragments
+        symbols = rlnc.recode_stream(subfragments, task.output_fragment_count)
+    print("Recoded %d of %d subfragments of %s"
+          % (len(symbols), len(subfragments), task.fragment_name))
+
+    # First frame is the request header, the recoded symbols follow
+    response_socket.send_multipart([msg[0]] + symbols, copy=False)
+
+
+def handle_chain_repair_req(msg):
+    """
+    Handle a step of a chained repair (see reedsolomon.repair_file_chained). The partial
+    combination of the previous nodes is in the third frame, unless this is the first hop.
+    """
+    task = messages_pb2.chain_repair_request()
+    task.ParseFromString(msg[1])
+
+    if not task.hops:
+        # This node is the destination: store the rebuilt fragment and notify the lead node
+        store.put(task.fragment_name, msg[2:])
+        print("Stored repaired fragment %s" % task.fragment_name)
+        repair_sender.send_multipart([msg[0], task.fragment_name.encode('utf-8')])
+        return
+
+    # Add this node's scaled fragment to the partial combination
+    hop = task.hops[0]
+    fragment = store.get(hop.fragment_name)
+    if not fragment:
+        # Deleted or lost since the lead node checked it, the lead node retries later
+        print("Dropping the chained repair of %s, fragment %s not found"
+              % (task.fragment_name, hop.fragment_name))
+        return
+    partial = msg[2] if len(msg) > 2 else None
+    combination = reedsolomon.chain_combine(fragment[0], hop.coefficient, partial)
+    print("Added %s to the chained repair of %s" % (hop.fragment_name, task.fragment_name))
+
+    # Forward it to the next hop, or to the destination after the last hop
+    del task.hops[0]
+    next_address = task.hops[0].node_address if task.hops else task.destination_address
+    frames = [msg[0], task.SerializeToString(), combination]
+    if next_address == node_address:
+        # The next step is on this node as well
+        handle_chain_repair_req(frames)
+    elif next_address in storage_node_response_push_sockets:
+        storage_node_response_push_sockets[next_address].send_multipart(frames, copy=False)
+    else:
+        print("Dropping the chained repair of %s, unknown node address %d"
+              % (task.fragment_name, next_address))
+
+
+def handle_fragment_status_req(msg, response_socket):
+    task = messages_pb2.fragment_status_request()
+    task.ParseFromString(msg[1])
+
+    # Answered from the index of the store, without touching the disk
+    response = messages_pb2.fragment_status_response()
+    response.fragment_name = task.fragment_name
+    response.node_id = node_id
+    response.count = store.count(task.fragment_name)
+    response.is_present = response.count > 0
 
-        print('Chunk to save: %s, size: %d bytes' %
-              (task.filename + "." + str(i), len(data)))
+    response_socket.send_multipart([msg[0], response.SerializeToString()])
 
-        # Store the chunk with the given filename
-        chunk_local_path = node_no + '/' + task.filename + "." + str(i)
-        write_file(data, chunk_local_path)
-        print("Chunk saved to %s" % chunk_local_path)
 
-    # Send response (just the file name)
-    response_socket.send_string(task.filename)
+def handle_fragment_status_batch_req(msg, response_socket):
+    task = messages_pb2.fragment_status_batch_request()
+    task.ParseFromString(msg[1])
+
+    # Answered from the index of the store, without touching the disk
+    response = messages_pb2.fragment_status_batch_response()
+    response.node_id = node_id
+    response.batch = task.batch
+    response.node_address = node_address
+    response.counts[:] = [store.count(name) for name in task.fragment_names]
+
+    response_socket.send_multipart([msg[0], response.SerializeToString()])
+
+
+def handle_inventory_digest_req(msg, response_socket):
+    # The digests are maintained by the index of the store as fragments are added and removed
+    response = messages_pb2.inventory_digest_response()
+    response.node_id = node_id
+    response.digests[:] = store.digests()
+
+    response_socket.send_multipart([msg[0], response.SerializeToString()])
 #endregion
 
 # Use a Poller to monitor all sockets at the same time
 poller = zmq.Poller()
 poller.register(lead_receiver, zmq.POLLIN)
 poller.register(lead_subscriber, zmq.POLLIN)
-poller.register(storage_node_pull_sockets[other_storage_node_addresses[0]], zmq.POLLIN)
-poller.register(storage_node_pull_sockets[other_storage_node_addresses[1]], zmq.POLLIN)
-poller.register(storage_node_pull_sockets[other_storage_node_addresses[2]], zmq.POLLIN)
+poller.register(repair_subscriber, zmq.POLLIN)
+poller.register(storage_node_response_pull_socket, zmq.POLLIN)
+for storage_node_pull_socket in storage_node_pull_sockets.values():
+    poller.register(storage_node_pull_socket, zmq.POLLIN)
 
 while True:
     try:
@@ -175,7 +334,7 @@ while True:
 
     # Task received from lead node
     if lead_receiver in socks:
-        msg = lead_receiver.recv_multipart()
+        msg = recv_frames(lead_receiver)
         header = messages_pb2.header()
         header.ParseFromString(msg[0])
 
@@ -192,7 +351,7 @@ while True:
             # Store a fragment on current node
             task = tasks.pop()
             fragment = fragments.pop()
-            write_file(fragment, f'{node_no}/{task.filename}')
+            store.put(task.filename, [fragment])
             print(f"Stored {task.filename} on this node")
 
             print("Sending store data requests to other nodes")
@@ -204,11 +363,19 @@ while True:
                     header.SerializeToString(),
                     task.SerializeToString(),
                     fragment
-                ])
+                ], copy=False)
             print("Awaiting responses from other nodes")
-            for task_nbr in range(3):
-                resp = storage_node_response_pull_socket.recv()
-                print('Received: %s' % resp)
+            received = 0
+            while received < len(tasks):
+                resp = recv_frames(storage_node_response_pull_socket)
+                resp_header = messages_pb2.header()
+                resp_header.ParseFromString(resp[0])
+                if resp_header.request_type == messages_pb2.CHAIN_REPAIR_REQ:
+                    # Chained repairs arrive on the same socket as the acknowledgements
+                    handle_chain_repair_req(resp)
+                    continue
+                print('Received: %s' % resp[1])
+                received += 1
 
             print("File stored on nodes")
 
@@ -217,7 +384,9 @@ while True:
             print(fragment_names)
             task.fragments[:] = fragment_names
 
+            # Echo the request header so the lead node can match the response
             lead_sender.send_multipart([
+                msg[0],
                 task.SerializeToString()
             ])
         elif header.request_type == messages_pb2.STORE_FRAGMENT_DATA_REQ:
@@ -233,62 +402,63 @@ while True:
         header.ParseFromString(msg[0])
 
         if header.request_type == messages_pb2.FRAGMENT_DATA_REQ:
-            task = messages_pb2.getdata_request()
-            task.ParseFromString(msg[1])
-            print("Data chunk request: %s" % task.filename)
-
-            # Try to load all fragments with this name
-            # First frame is the filename
-            frames = [bytes(task.filename, 'utf-8')]
-            # Subsequent frames will contain the chunks' data
-            for i in range(0, MAX_CHUNKS_PER_FILE):
-                try:
-                    with open(node_no + '/' + task.filename + "." + str(i), "rb") as in_file:
-                        print("Found chunk %s, sending it back" % task.filename)
-                        # Add chunk as a new frame
-                        frames.append(in_file.read())
-
-                except FileNotFoundError:
-                    # This is OK here
-                    break
-
-            # Only send a result if at least one chunk was found
-            if (len(frames) > 1):
-                lead_sender.send_multipart(frames)
-
+            handle_fragment_data_req(msg, lead_sender)
 
+        elif header.request_type == messages_pb2.FRAGMENT_STATUS_REQ:
+            handle_fragment_status_req(msg, lead_sender)
 
+        elif header.request_type == messages_pb2.DELETE_FRAGMENT_REQ:
+            task = messages_pb2.deletedata_request()
+            task.ParseFromString(msg[1])
 
+            # Deletes are broadcast to all nodes, the nodes storing the fragment delete it
+            if task.filename in store:
+                print("Deleting chunk %s" % task.filename)
+                store.delete(task.filename)
 
         else:
             raise NotImplementedError("Unknown header type")
 
-    # Task received from other storage node
-    if storage_node_pull_sockets[other_storage_node_addresses[0]] in socks:
-        msg = storage_node_pull_sockets[other_storage_node_addresses[0]].recv_multipart()
+    # Repair task received from lead node
+    if repair_subscriber in socks:
+        # The first frame is the topic, the request starts after it
+        msg = recv_frames(repair_subscriber, topic=True)
         header = messages_pb2.header()
         header.ParseFromString(msg[0])
 
-        if header.request_type == messages_pb2.STORE_FRAGMENT_DATA_REQ:
-            task = messages_pb2.storedata_request()
-            task.ParseFromString(msg[1])
-            handle_store_data_req(msg, storage_node_response_push_sockets[task.node_return_address])
-
+        if header.request_type == messages_pb2.FRAGMENT_STATUS_REQ:
+            handle_fragment_status_req(msg, repair_sender)
+        elif header.request_type == messages_pb2.FRAGMENT_STATUS_BATCH_REQ:
+            handle_fragment_status_batch_req(msg, repair_sender)
+        elif header.request_type == messages_pb2.INVENTORY_DIGEST_REQ:
+            handle_inventory_digest_req(msg, repair_sender)
+        elif header.request_type == messages_pb2.FRAGMENT_DATA_REQ:
+            handle_fragment_data_req(msg, repair_sender)
+        elif header.request_type == messages_pb2.STORE_FRAGMENT_DATA_REQ:
+            handle_store_data_req(msg, repair_sender)
+        elif header.request_type == messages_pb2.RECODE_FRAGMENTS_REQ:
+            handle_recode_fragments_req(msg, repair_sender)
+        elif header.request_type == messages_pb2.CHAIN_REPAIR_REQ:
+            handle_chain_repair_req(msg)
+        else:
+            print("Unknown repair request type: %d" % header.request_type)
 
-    # Task received from other storage node
-    if storage_node_pull_sockets[other_storage_node_addresses[1]] in socks:
-        msg = storage_node_pull_sockets[other_storage_node_addresses[1]].recv_multipart()
+    # Chained repair step received from other storage node
+    if storage_node_response_pull_socket in socks:
+        msg = recv_frames(storage_node_response_pull_socket)
         header = messages_pb2.header()
         header.ParseFromString(msg[0])
 
-        if header.request_type == messages_pb2.STORE_FRAGMENT_DATA_REQ:
-            task = messages_pb2.storedata_request()
-            task.ParseFromString(msg[1])
-            handle_store_data_req(msg, storage_node_response_push_sockets[task.node_return_address])
+        if header.request_type == messages_pb2.CHAIN_REPAIR_REQ:
+            handle_chain_repair_req(msg)
+        else:
+            print("Unexpected message from other storage node: %d" % header.request_type)
 
-    # Task received from other storage node
-    if storage_node_pull_sockets[other_storage_node_addresses[2]] in socks:
-        msg = storage_node_pull_sockets[other_storage_node_addresses[2]].recv_multipart()
+    # Tasks received from other storage nodes
+    for storage_node_pull_socket in storage_node_pull_sockets.values():
+        if storage_node_pull_socket not in socks:
+            continue
+        msg = recv_frames(storage_node_pull_socket)
         header = messages_pb2.header()
         header.ParseFromString(msg[0])
 
@@ -296,4 +466,4 @@ while True:
             task = messages_pb2.storedata_request()
             task.ParseFromString(msg[1])
             handle_store_data_req(msg, storage_node_response_push_sockets[task.node_return_address])
-#
\ No newline at end of file
+#
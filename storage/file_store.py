@@ -0,0 +1,87 @@
+import mmap
+import os
+
+from storage.fragment_index import FragmentIndex
+from utils import write_file
+
+
+class FileStore:
+    """
+    Stores every subfragment in its own file named '<fragment name>.<subfragment index>'
+    in the data folder of the storage node, and keeps a FragmentIndex of them.
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: The data folder of the storage node
+        """
+        self.folder = folder
+        self.index = FragmentIndex()
+        self.index.scan(folder)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def count(self, name):
+        return self.index.count(name)
+
+    def names(self):
+        return self.index.names()
+
+    def digests(self):
+        return self.index.digests()
+
+    def put(self, name, subfragments):
+        """
+        Store the subfragments of a fragment. If some subfragments of the fragment are
+        already stored (e.g. when a partially lost fragment is repaired), the new ones
+        fill the unused subfragment indexes.
+
+        :param name: The fragment name
+        :param subfragments: The data of each subfragment
+        """
+        for i, data in zip(self.index.free_indexes(name, len(subfragments)), subfragments):
+            print('Chunk to save: %s, size: %d bytes' %
+                  (name + "." + str(i), len(data)))
+
+            # Store the chunk with the given filename
+            chunk_local_path = self.folder + '/' + name + "." + str(i)
+            if write_file(data, chunk_local_path) is not None:
+                self.index.add(name, i, len(data), chunk_local_path)
+                print("Chunk saved to %s" % chunk_local_path)
+
+    def get(self, name):
+        """
+        The subfragment files are memory-mapped instead of read, so they can be sent
+        without copying the data (see zmq's copy=False).
+
+        :param name: The fragment name
+        :return: The data of each stored subfragment
+        """
+        subfragments = []
+        for size, chunk_local_path in self.index.subfragments(name):
+            try:
+                with open(chunk_local_path, "rb") as in_file:
+                    if os.fstat(in_file.fileno()).st_size == 0:
+                        # Empty files can't be mapped
+                        subfragments.append(b'')
+                    else:
+                        # The mapping stays valid after the file is closed
+                        subfragments.append(mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError:
+                # The file was removed behind our back
+                print("Chunk %s is missing from the disk" % chunk_local_path)
+        return subfragments
+
+    def delete(self, name):
+        """
+        Delete a fragment with all its subfragments
+
+        :param name: The fragment name
+        """
+        for size, chunk_local_path in self.index.remove(name):
+            try:
+                os.remove(chunk_local_path)
+            except FileNotFoundError:
+                pass
+#
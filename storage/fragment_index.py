@@ -0,0 +1,150 @@
+import hashlib
+import os
+import threading
+
+# Number of buckets of the inventory digest. Fragments are assigned to buckets by the hash
+# of their name, and every bucket has a digest of the fragments in it (see inventory_digest).
+INVENTORY_BUCKETS = 4096
+
+
+def inventory_bucket(name):
+    """
+    :param name: The fragment name
+    :return: The inventory bucket of the fragment
+    """
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % INVENTORY_BUCKETS
+#
+
+
+def inventory_digest(name, count):
+    """
+    The digest of a bucket is the XOR of the digests of its fragments, so digests can be
+    updated incrementally, and the digests of several nodes can be combined with XOR.
+
+    :param name: The fragment name
+    :param count: The number of stored subfragments of the fragment
+    :return: The digest of the fragment as a 64 bit integer
+    """
+    digest = hashlib.blake2b(('%s:%d' % (name, count)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+#
+
+
+class FragmentIndex:
+    """
+    In-memory index of the fragments stored on a storage node. Every fragment consists
+    of one or more subfragments (numbered from 0), and for each subfragment the index
+    keeps its size and where it is stored. Looking up a fragment that is not stored on
+    the node does not touch the filesystem.
+    The index also keeps the inventory digest of every bucket (see inventory_digest).
+    """
+
+    def __init__(self):
+        # Fragment name -> {subfragment index: (size, location)}
+        self.__fragments = dict()
+        self.__digests = [0] * INVENTORY_BUCKETS
+        self.__lock = threading.Lock()
+
+    def add(self, name, index, size, location):
+        """
+        Register a stored subfragment
+
+        :param name: The fragment name
+        :param index: The subfragment index
+        :param size: The subfragment size in bytes
+        :param location: Where the subfragment is stored (e.g. a file path)
+        """
+        with self.__lock:
+            subfragments = self.__fragments.setdefault(name, dict())
+            if index not in subfragments:
+                self.__update_digest(name, len(subfragments), len(subfragments) + 1)
+            subfragments[index] = (size, location)
+
+    def remove(self, name):
+        """
+        Remove a fragment with all its subfragments
+
+        :param name: The fragment name
+        :return: The (size, location) of each removed subfragment
+        """
+        with self.__lock:
+            subfragments = self.__fragments.pop(name, dict())
+            self.__update_digest(name, len(subfragments), 0)
+            return list(subfragments.values())
+
+    def digests(self):
+        """
+        :return: The inventory digest of every bucket
+        """
+        with self.__lock:
+            return list(self.__digests)
+
+    def __update_digest(self, name, old_count, new_count):
+        bucket = inventory_bucket(name)
+        if old_count:
+            self.__digests[bucket] ^= inventory_digest(name, old_count)
+        if new_count:
+            self.__digests[bucket] ^= inventory_digest(name, new_count)
+
+    def get(self, name, index):
+        """
+        :param name: The fragment name
+        :param index: The subfragment index
+        :return: The (size, location) of the subfragment, or None if it is not stored
+        """
+        return self.__fragments.get(name, dict()).get(index)
+
+    def __contains__(self, name):
+        return name in self.__fragments
+
+    def count(self, name):
+        """
+        :param name: The fragment name
+        :return: The number of stored subfragments of the fragment
+        """
+        return len(self.__fragments.get(name, ()))
+
+    def subfragments(self, name):
+        """
+        :param name: The fragment name
+        :return: The (size, location) of each stored subfragment, ordered by index
+        """
+        subfragments = self.__fragments.get(name, dict())
+        return [subfragments[index] for index in sorted(subfragments)]
+
+    def free_indexes(self, name, count):
+        """
+        :param name: The fragment name
+        :param count: How many indexes are needed
+        :return: The lowest 'count' subfragment indexes that are not in use
+        """
+        used = self.__fragments.get(name, dict())
+        indexes = []
+        index = 0
+        while len(indexes) < count:
+            if index not in used:
+                indexes.append(index)
+            index += 1
+        return indexes
+
+    def names(self):
+        """
+        :return: The names of all stored fragments
+        """
+        with self.__lock:
+            return list(self.__fragments)
+
+    def scan(self, folder):
+        """
+        Add every subfragment file in a folder to the index. Subfragments are stored
+        in files named '<fragment name>.<subfragment index>'.
+
+        :param folder: The data folder of the storage node
+        """
+        for entry in os.scandir(folder):
+            name, _, index = entry.name.rpartition('.')
+            if not name or not index.isdigit() or not entry.is_file():
+                continue
+            self.add(name, int(index), entry.stat().st_size, entry.path)
+#
@@ -0,0 +1,283 @@
+import mmap
+import os
+import struct
+
+from storage.fragment_index import FragmentIndex
+
+# Every record starts with a header: magic, record type, name length, subfragment index
+# and data length. It is followed by the fragment name and the subfragment data.
+RECORD_HEADER = struct.Struct('<4sBHIQ')
+RECORD_MAGIC = b'FRAG'
+PUT_RECORD = 0
+DELETE_RECORD = 1
+# Maximum number of buffers in one vectored write
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+
+class SegmentStore:
+    """
+    Log-structured fragment store. Subfragments are appended to large segment files
+    named '<segment id>.seg' in the data folder, so writes are sequential appends and
+    reads are a single pread at the offset kept in the FragmentIndex. Deleting a
+    fragment appends a tombstone record. Segments where the share of live data drops
+    below COMPACTION_THRESHOLD are compacted by copying their live records to the
+    active segment and removing the segment file.
+    The index is rebuilt at startup by replaying the segments in order.
+    """
+
+    # A new segment is started when the active one grows beyond this size
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # Sealed segments with less live data than this share are compacted
+    COMPACTION_THRESHOLD = 0.5
+
+    def __init__(self, folder, segment_size=SEGMENT_SIZE):
+        """
+        :param folder: The data folder of the storage node
+        :param segment_size: Size at which a new segment is started
+        """
+        self.folder = folder
+        self.segment_size = segment_size
+        self.index = FragmentIndex()
+        # Segment id -> file descriptor
+        self.__fds = dict()
+        # Segment id -> size of the segment, and size of the live data in it
+        self.__segment_bytes = dict()
+        self.__live_bytes = dict()
+        # Segment id -> names of the fragments deleted by tombstones in the segment
+        self.__tombstones = dict()
+
+        segment_ids = sorted(int(entry.name[:-len('.seg')]) for entry in os.scandir(folder)
+                             if entry.name.endswith('.seg') and entry.name[:-len('.seg')].isdigit())
+        for segment_id in segment_ids:
+            self.__replay(segment_id)
+
+        self.__active = segment_ids[-1] if segment_ids else self.__create_segment(1)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def count(self, name):
+        return self.index.count(name)
+
+    def names(self):
+        return self.index.names()
+
+    def digests(self):
+        return self.index.digests()
+
+    def put(self, name, subfragments):
+        """
+        Append the subfragments of a fragment to the active segment. If some subfragments
+        of the fragment are already stored, the new ones fill the unused subfragment indexes.
+
+        :param name: The fragment name
+        :param subfragments: The data of each subfragment
+        """
+        indexes = self.index.free_indexes(name, len(subfragments))
+        # All subfragments are appended together, with as few writes as possible
+        data_offsets = self.__append_records([(PUT_RECORD, name, i, data)
+                                              for i, data in zip(indexes, subfragments)])
+        for i, data, data_offset in zip(indexes, subfragments, data_offsets):
+            self.__add(name, i, len(data), self.__active, data_offset)
+            print('Chunk saved: %s, size: %d bytes, segment %d' %
+                  (name + "." + str(i), len(data), self.__active))
+
+    def get(self, name):
+        """
+        The subfragments are memory-mapped from the segments instead of read, so they
+        can be sent without copying the data (see zmq's copy=False).
+
+        :param name: The fragment name
+        :return: The data of each stored subfragment
+        """
+        return [self.__map(segment_id, offset, size)
+                for size, (segment_id, offset) in self.index.subfragments(name)]
+
+    def __map(self, segment_id, offset, size):
+        """
+        :return: A read-only memoryview of 'size' bytes at 'offset' in a segment
+        """
+        if size == 0:
+            return b''
+        # Mappings must start at a multiple of the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mapping = mmap.mmap(self.__fds[segment_id], offset - start + size,
+                            access=mmap.ACCESS_READ, offset=start)
+        return memoryview(mapping)[offset - start:]
+
+    def delete(self, name):
+        """
+        Delete a fragment with all its subfragments, and compact the segments
+        that are left with too little live data.
+
+        :param name: The fragment name
+        """
+        if name not in self.index:
+            return
+        self.__append(DELETE_RECORD, name, 0)
+        self.__tombstones[self.__active].add(name)
+        self.__remove(name)
+        self.compact()
+
+    def compact(self):
+        """
+        Compact every sealed segment whose share of live data is below COMPACTION_THRESHOLD
+        """
+        for segment_id in sorted(self.__fds):
+            if segment_id == self.__active:
+                continue
+            segment_bytes = self.__segment_bytes[segment_id]
+            if segment_bytes and self.__live_bytes[segment_id] / segment_bytes >= self.COMPACTION_THRESHOLD:
+                continue
+            self.__compact_segment(segment_id)
+
+    def __compact_segment(self, segment_id):
+        print("Compacting segment %d (%d of %d bytes live)" %
+              (segment_id, self.__live_bytes[segment_id], self.__segment_bytes[segment_id]))
+        fd = self.__fds[segment_id]
+
+        # Copy the live records to the active segment
+        for kind, name, index, data_offset, data_length in self.__records(segment_id):
+            if kind == PUT_RECORD and self.index.get(name, index) == (data_length, (segment_id, data_offset)):
+                data = os.pread(fd, data_length, data_offset)
+                self.__remove_subfragment(name, index)
+                new_offset = self.__append(PUT_RECORD, name, index, data)
+                self.__add(name, index, data_length, self.__active, new_offset)
+
+        # Tombstones are only needed while older segments may still contain the deleted data
+        if min(self.__fds) < segment_id:
+            for name in self.__tombstones[segment_id]:
+                self.__append(DELETE_RECORD, name, 0)
+                self.__tombstones[self.__active].add(name)
+
+        os.close(fd)
+        os.remove(self.__segment_path(segment_id))
+        for segments in [self.__fds, self.__segment_bytes, self.__live_bytes, self.__tombstones]:
+            del segments[segment_id]
+
+    def __segment_path(self, segment_id):
+        return '%s/%08d.seg' % (self.folder, segment_id)
+
+    def __open_segment(self, segment_id):
+        self.__fds[segment_id] = os.open(self.__segment_path(segment_id),
+                                         os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.__segment_bytes[segment_id] = 0
+        self.__live_bytes[segment_id] = 0
+        self.__tombstones[segment_id] = set()
+
+    def __create_segment(self, segment_id):
+        self.__open_segment(segment_id)
+        return segment_id
+
+    def __records(self, segment_id):
+        """
+        Read the records of a segment in order. Stops at the first incomplete or invalid record.
+
+        :param segment_id: The segment to read
+        :return: A generator of (record type, name, subfragment index, data offset, data length)
+        """
+        fd = self.__fds[segment_id]
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset + RECORD_HEADER.size <= size:
+            magic, kind, name_length, index, data_length = RECORD_HEADER.unpack(
+                os.pread(fd, RECORD_HEADER.size, offset))
+            data_offset = offset + RECORD_HEADER.size + name_length
+            if magic != RECORD_MAGIC or data_offset + data_length > size:
+                break
+            name = os.pread(fd, name_length, offset + RECORD_HEADER.size).decode('utf-8')
+            yield kind, name, index, data_offset, data_length
+            offset = data_offset + data_length
+
+    def __replay(self, segment_id):
+        """
+        Rebuild the index from the records of a segment
+        """
+        self.__open_segment(segment_id)
+        end = 0
+        for kind, name, index, data_offset, data_length in self.__records(segment_id):
+            if kind == PUT_RECORD:
+                self.__remove_subfragment(name, index)
+                self.__add(name, index, data_length, segment_id, data_offset)
+            else:
+                self.__remove(name)
+                self.__tombstones[segment_id].add(name)
+            end = data_offset + data_length
+
+        fd = self.__fds[segment_id]
+        if end < os.fstat(fd).st_size:
+            # Incomplete record at the end, e.g. after a crash during a write
+            print("Truncating segment %d at %d bytes" % (segment_id, end))
+            os.ftruncate(fd, end)
+        self.__segment_bytes[segment_id] = end
+
+    def __append(self, kind, name, index, data=b''):
+        """
+        Append a record to the active segment, starting a new segment if it is full
+
+        :return: The offset of the record's data in the active segment
+        """
+        return self.__append_records([(kind, name, index, data)])[0]
+
+    def __append_records(self, records):
+        """
+        Append records to the active segment with vectored writes of up to IOV_MAX
+        buffers, starting a new segment first if the active one is full
+
+        :param records: List of (record type, name, subfragment index, data)
+        :return: The offset of each record's data in the active segment
+        """
+        if self.__segment_bytes[self.__active] >= self.segment_size:
+            self.__active = self.__create_segment(self.__active + 1)
+
+        buffers = []
+        data_offsets = []
+        offset = self.__segment_bytes[self.__active]
+        for kind, name, index, data in records:
+            name_bytes = name.encode('utf-8')
+            header = RECORD_HEADER.pack(RECORD_MAGIC, kind, len(name_bytes), index, len(data))
+            buffers += [header, name_bytes, data]
+            data_offsets.append(offset + len(header) + len(name_bytes))
+            offset += len(header) + len(name_bytes) + len(data)
+
+        # The data buffers are written as they are, without joining them first
+        self.__write_buffers(self.__fds[self.__active], buffers)
+
+        self.__segment_bytes[self.__active] = offset
+        return data_offsets
+
+    @staticmethod
+    def __write_buffers(fd, buffers):
+        """
+        Write all buffers to a file, continuing after partial writes
+
+        :param fd: The file descriptor
+        :param buffers: List of bytes-like objects
+        """
+        buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+        first = 0
+        while first < len(buffers):
+            written = os.writev(fd, buffers[first:first + IOV_MAX])
+            # Skip the written buffers, and the written part of a partially written one
+            while first < len(buffers) and written >= len(buffers[first]):
+                written -= len(buffers[first])
+                first += 1
+            if written:
+                buffers[first] = buffers[first][written:]
+
+    def __add(self, name, index, size, segment_id, offset):
+        self.index.add(name, index, size, (segment_id, offset))
+        self.__live_bytes[segment_id] += size
+
+    def __remove_subfragment(self, name, index):
+        # Only the live data counter is updated, the index entry is replaced by __add
+        entry = self.index.get(name, index)
+        if entry is None:
+            return
+        size, (segment_id, offset) = entry
+        self.__live_bytes[segment_id] -= size
+
+    def __remove(self, name):
+        for size, (segment_id, offset) in self.index.remove(name):
+            self.__live_bytes[segment_id] -= size
+#
@@ -3,7 +3,13 @@ import string
 import os
 
 import bson
-from mongoengine import StringField, FloatField, IntField, ListField, DateField, ObjectIdField
+from mongoengine import StringField, FloatField, IntField, ListField, DateTimeField, ObjectIdField, \
+    EmbeddedDocumentField
+from werkzeug.sansio.multipart import Epilogue, Field, File, MultipartDecoder, NeedData
+
+# Number of storage nodes in the cluster. The lead node and all storage nodes must
+# be started with the same value of the STORAGE_NODES_NUM environment variable.
+STORAGE_NODES_NUM = int(os.environ.get('STORAGE_NODES_NUM', 4))
 
 
 def random_string(length=8):
@@ -60,13 +66,113 @@ def mongo_to_dict_helper(obj):
         if isinstance(obj._fields[field_name], StringField):
             return_data.append((field_name, str(data)))
         elif isinstance(obj._fields[field_name], FloatField):
-            return_data.append((field_name, float(data)))
+            return_data.append((field_name, float(data) if data is not None else None))
         elif isinstance(obj._fields[field_name], IntField):
-            return_data.append((field_name, int(data)))
+            return_data.append((field_name, int(data) if data is not None else None))
         elif isinstance(obj._fields[field_name], ListField):
             return_data.append((field_name, data))
-        elif isinstance(obj._fields[field_name], DateField):
+        elif isinstance(obj._fields[field_name], DateTimeField):
             return_data.append((field_name, str(data)))
+        elif isinstance(obj._fields[field_name], EmbeddedDocumentField):
+            return_data.append((field_name, mongo_to_dict_helper(data) if data is not None else None))
         elif isinstance(obj._fields[field_name], ObjectIdField):
             return_data.append((field_name, bson.objectid.ObjectId(data).__str__()))
-    return dict(return_data)
\ No newline at end of file
+    return dict(return_data)#
+
+class HashingReader:
+    """
+    Wraps a file-like object and hashes all data that is read from it
+    """
+
+    def __init__(self, stream, hash):
+        """
+        :param stream: The file-like object to read from
+        :param hash: A hashlib hash object, updated with the data that is read
+        """
+        self.stream = stream
+        self.hash = hash
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+#
+
+class MultipartReader:
+    """
+    Incremental parser of a multipart/form-data request body. Flask spools the whole body
+    to memory or a temporary file before request.form and request.files can be used,
+    this reads it from the request stream as it arrives: the form fields are returned
+    as they are reached, and the contents of a file field are read like a file.
+    """
+
+    # How many bytes are read from the request stream at a time
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, boundary):
+        """
+        :param stream: The request stream
+        :param boundary: The boundary parameter of the multipart/form-data content type
+        """
+        self.stream = stream
+        self.__decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self.__buffer = bytearray()
+        self.__in_file = False
+        self.__end_of_stream = False
+
+    def __next_event(self):
+        while True:
+            event = self.__decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            if self.__end_of_stream:
+                raise ValueError("The multipart body ended unexpectedly")
+            chunk = self.stream.read(self.CHUNK_SIZE)
+            self.__end_of_stream = not chunk
+            self.__decoder.receive_data(chunk or None)
+
+    def read_fields(self):
+        """
+        Read the form fields up to the next file field. The rest of the current file is skipped.
+
+        :return: A dictionary of the form fields, and the File event of the next file field,
+                 with its 'name', 'filename' and 'headers' (None at the end of the body)
+        """
+        self.__in_file = False
+        self.__buffer.clear()
+        fields = dict()
+        while True:
+            event = self.__next_event()
+            if isinstance(event, File):
+                self.__in_file = True
+                return fields, event
+            if isinstance(event, Epilogue):
+                return fields, None
+            if isinstance(event, Field):
+                value = bytearray()
+                data = self.__next_event()
+                value += data.data
+                while data.more_data:
+                    data = self.__next_event()
+                    value += data.data
+                fields[event.name] = value.decode('utf-8')
+            # Anything else is the preamble or the data of a skipped file
+
+    def read(self, size=-1):
+        """
+        Read from the contents of the current file field (see read_fields)
+
+        :param size: How many bytes to read, -1 reads until the end of the file
+        :return: The bytes read, fewer than 'size' only at the end of the file
+        """
+        while self.__in_file and (size < 0 or len(self.__buffer) < size):
+            data = self.__next_event()
+            self.__buffer += data.data
+            self.__in_file = data.more_data
+
+        if size < 0:
+            size = len(self.__buffer)
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+#